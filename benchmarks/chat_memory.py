@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Memory footprint of concurrent chats in bondly_v1.6.
+
+Builds N chats (default 100,000) three ways and reports bytes per chat:
+the nested-dict layout the chat manager used to store, the slotted
+ChatSession records, and ChatSession through ProfessionalChatManager
+(shard maps and expiry heap included). Profile dicts are created up front
+and shared by every layout, as the user cache shares them at runtime, so
+only per-chat state is counted. Stat deltas are left out too: the
+StatsAggregator flushes them to the database every few seconds.
+
+    python benchmarks/chat_memory.py --chats 100000 [--json]
+"""
+
+import argparse
+import json
+import time
+import tracemalloc
+from datetime import datetime
+
+from common import load_bot
+
+
+def legacy_chat(user1, data1, user2, data2):
+    """The per-chat dict create_chat built before ChatSession"""
+    now = datetime.now().isoformat()
+    return {
+        'user1': {'id': user1, 'data': data1, 'messages_sent': 0, 'last_active': now},
+        'user2': {'id': user2, 'data': data2, 'messages_sent': 0, 'last_active': now},
+        'active': True,
+        'created': now,
+        'messages_sent_user1': 0,
+        'messages_sent_user2': 0,
+        'media_sent': 0,
+        'last_message': None
+    }
+
+
+def measure(build, count):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    started = time.perf_counter()
+    
+    keep = [build(i) for i in range(count)]
+    
+    elapsed = time.perf_counter() - started
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del keep
+    return {'bytes_per_chat': round(used / count, 1), 'total_mb': round(used / 2**20, 1),
+            'build_us_per_chat': round(elapsed / count * 1e6, 2)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--chats', type=int, default=100000)
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args()
+    
+    bot = load_bot('1.6')
+    count = args.chats
+    profiles = [
+        {'nickname': f'user{i}', 'gender': 'male' if i % 2 else 'female', 'search_filter': 'random'}
+        for i in range(2 * count)
+    ]
+    
+    results = {'chats': count}
+    results['legacy_dict'] = measure(
+        lambda i: legacy_chat(2 * i, profiles[2 * i], 2 * i + 1, profiles[2 * i + 1]), count)
+    results['chat_session'] = measure(
+        lambda i: bot.ChatSession(f'chat_{i}', 2 * i, profiles[2 * i], 2 * i + 1, profiles[2 * i + 1]), count)
+    
+    bot.stats_buffer.add = lambda *args, **kwargs: None
+    manager = bot.ProfessionalChatManager()
+    results['chat_manager'] = measure(
+        lambda i: manager.create_chat(2 * i, 2 * i + 1, profiles[2 * i], profiles[2 * i + 1]), count)
+    
+    # Hot path: one record_message per chat
+    chat_ids = [chat_id for chat_id, _ in manager.chat_items()]
+    started = time.perf_counter()
+    for chat_id in chat_ids:
+        manager.record_message(chat_id, int(chat_id.rsplit('_', 1)[1]) * 2 - 2)
+    results['record_message_us'] = round((time.perf_counter() - started) / len(chat_ids) * 1e6, 2)
+    
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    
+    print(f"{count:,} concurrent chats")
+    for name in ('legacy_dict', 'chat_session', 'chat_manager'):
+        r = results[name]
+        print(f"  {name:<14} {r['bytes_per_chat']:>8.1f} B/chat  {r['total_mb']:>7.1f} MB  "
+              f"{r['build_us_per_chat']:>6.2f} us/chat")
+    print(f"  record_message {results['record_message_us']:.2f} us/call")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+"""Shared helpers for the benchmark scripts.
+
+The bots are single-file scripts, so they are loaded by path. BOT_TOKEN only
+has to be non-empty for a module to import, and DATABASE_URL is blanked so
+v1.6 runs without Postgres; nothing here talks to Telegram. FakeStorage
+stands in for Postgres once the module is loaded.
+"""
+
+import importlib.util
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_bot(version: str = '1.6'):
+    """Import bondly_v<version>.py as a module (once per process)"""
+    name = 'bondly_v' + version.replace('.', '_')
+    if name in sys.modules:
+        return sys.modules[name]
+    
+    os.environ.setdefault('BOT_TOKEN', '123456:benchmark')
+    os.environ['DATABASE_URL'] = ''
+    
+    spec = importlib.util.spec_from_file_location(name, os.path.join(ROOT, f'bondly_v{version}.py'))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+class FakeStorage:
+    """Replaces ProfessionalDB._execute: one call is one Postgres round trip"""
+    
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.ops = 0
+        self.by_statement = Counter()
+    
+    def execute(self, sql, params=(), fetch=None, default=None, batch=None, raise_errors=False):
+        with self.lock:
+            self.ops += 1
+            self.by_statement[sql.split(None, 1)[0].upper()] += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if fetch == 'all':
+            return []
+        if fetch == 'one':
+            return None
+        return len(batch) if batch is not None else 1
@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+"""
+Load test for bondly_v1.6: thousands of simulated users, no network.
+
+Every user registers with /start, searches, chats with whoever they are
+matched with and now and then presses Next, Leave or Block. Updates go
+through the bot's own update processor and handlers. A fake Bot API answers
+every call after --api-latency ms. Storage is a stand-in for Postgres that
+counts round trips and sleeps --db-latency ms on the DB worker threads.
+
+Reported: matches per second, relay latency p50/p99 (update dispatched ->
+partner's copy delivered), event-loop lag, Bot API calls and storage
+round trips per relayed message.
+
+    python benchmarks/loadtest.py --users 2000 --duration 30 --rate 0.5 [--json]
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import statistics
+import time
+from collections import Counter
+
+from common import FakeStorage, load_bot
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+class FakeUser:
+    def __init__(self, user_id: int):
+        self.id = user_id
+        self.is_bot = False
+        self.username = f"load{user_id}"
+        self.first_name = f"Load{user_id}"
+        self.last_name = None
+        self.full_name = self.first_name
+
+
+class FakeChat:
+    def __init__(self, chat_id: int):
+        self.id = chat_id
+        self.type = 'private'
+
+
+class FakeMessage:
+    """The parts of telegram.Message the handlers touch"""
+    
+    def __init__(self, harness, user, message_id, text=None):
+        self.harness = harness
+        self.from_user = user
+        self.chat = FakeChat(user.id)
+        self.chat_id = user.id
+        self.message_id = message_id
+        self.text = text
+        self.entities = None
+        self.caption = None
+        self.caption_entities = None
+        self.media_group_id = None
+        self.photo = self.video = self.animation = self.document = None
+        self.audio = self.voice = self.sticker = self.video_note = None
+    
+    async def reply_text(self, text, **kwargs):
+        await self.harness.api_call('sendMessage')
+        return FakeMessage(self.harness, self.from_user, next(self.harness.message_ids), text)
+    
+    async def edit_text(self, text, **kwargs):
+        await self.harness.api_call('editMessageText')
+        return self
+
+
+class FakeCallbackQuery:
+    def __init__(self, harness, user, data):
+        self.harness = harness
+        self.from_user = user
+        self.data = data
+        self.message = FakeMessage(harness, user, next(harness.message_ids))
+    
+    async def answer(self, *args, **kwargs):
+        await self.harness.api_call('answerCallbackQuery')
+    
+    async def edit_message_text(self, text, **kwargs):
+        await self.harness.api_call('editMessageText')
+
+
+class FakeUpdate:
+    def __init__(self, user, message=None, callback_query=None):
+        self.effective_user = user
+        self.effective_chat = FakeChat(user.id)
+        self.message = message
+        self.effective_message = message
+        self.callback_query = callback_query
+
+
+class FakeContext:
+    def __init__(self, bot):
+        self.bot = bot
+        self.args = []
+
+
+class FakeBot:
+    """Bot API stand-in; relays are timed when the partner's copy is 'delivered'"""
+    
+    def __init__(self, harness):
+        self.harness = harness
+    
+    async def send_message(self, chat_id, text, **kwargs):
+        await self.harness.api_call('sendMessage')
+        token = text.rsplit(' ', 1)[-1]
+        if token.startswith('#'):
+            self.harness.delivered(int(token[1:]))
+    
+    async def copy_message(self, chat_id, from_chat_id, message_id, **kwargs):
+        await self.harness.api_call('copyMessage')
+        self.harness.delivered(message_id)
+    
+    async def send_chat_action(self, chat_id, action, **kwargs):
+        await self.harness.api_call('sendChatAction')
+    
+    async def send_media_group(self, chat_id, media, **kwargs):
+        await self.harness.api_call('sendMediaGroup')
+        return []
+
+
+class LoadTest:
+    def __init__(self, bot, args):
+        self.bot_module = bot
+        self.args = args
+        self.api_latency = args.api_latency / 1000
+        self.message_ids = itertools.count(1)
+        self.fake_bot = FakeBot(self)
+        self.context = FakeContext(self.fake_bot)
+        self.storage = FakeStorage(args.db_latency / 1000)
+        
+        self.api_calls = Counter()
+        self.sent_at = {}
+        self.relay_latencies = []
+        self.loop_lags = []
+        self.matches = 0
+        self.stopping = False
+        
+        # Route every storage call through the counting stand-in
+        bot.db.db_pool = object()
+        bot.db._execute = self.storage.execute
+        
+        create_chat = bot.cm.create_chat
+        
+        def counting_create_chat(*a, **kw):
+            self.matches += 1
+            return create_chat(*a, **kw)
+        
+        bot.cm.create_chat = counting_create_chat
+    
+    async def api_call(self, method: str):
+        self.api_calls[method] += 1
+        if self.api_latency:
+            await asyncio.sleep(self.api_latency)
+    
+    def delivered(self, message_id: int):
+        started = self.sent_at.pop(message_id, None)
+        if started is not None:
+            self.relay_latencies.append(time.perf_counter() - started)
+    
+    async def dispatch(self, user, handler, message=None, callback_data=None):
+        query = FakeCallbackQuery(self, user, callback_data) if callback_data else None
+        update = FakeUpdate(user, message or FakeMessage(self, user, next(self.message_ids)), query)
+        await self.bot_module.update_processor.process_update(update, handler(update, self.context))
+    
+    async def send_text(self, user):
+        message_id = next(self.message_ids)
+        message = FakeMessage(self, user, message_id, f"hello #{message_id}")
+        self.sent_at[message_id] = time.perf_counter()
+        await self.dispatch(user, self.bot_module.handle_text, message=message)
+    
+    async def user_loop(self, user_id: int):
+        bot = self.bot_module
+        user = FakeUser(user_id)
+        rng = random.Random(self.args.seed + user_id)
+        a = self.args
+        
+        await asyncio.sleep(rng.random() * a.ramp_up)
+        await self.dispatch(user, bot.start)
+        
+        while not self.stopping:
+            if user_id not in bot.cm.waiting and not bot.cm.partner_id(user_id):
+                await self.dispatch(user, bot.search)
+            
+            waited = 0.0
+            while not self.stopping and not bot.cm.partner_id(user_id) and waited < a.match_timeout:
+                await asyncio.sleep(0.05)
+                waited += 0.05
+            if not bot.cm.partner_id(user_id):
+                if user_id in bot.cm.waiting:
+                    await self.dispatch(user, bot.callback_handler, callback_data='cancel_search')
+                continue
+            
+            while not self.stopping and bot.cm.partner_id(user_id):
+                await asyncio.sleep(rng.expovariate(a.rate))
+                if self.stopping or not bot.cm.partner_id(user_id):
+                    break
+                
+                roll = rng.random()
+                if roll < a.next_prob:
+                    await self.dispatch(user, bot.callback_handler, callback_data='next')
+                elif roll < a.next_prob + a.leave_prob:
+                    await self.dispatch(user, bot.leave)
+                elif roll < a.next_prob + a.leave_prob + a.block_prob:
+                    await self.dispatch(user, bot.callback_handler, callback_data='block')
+                else:
+                    await self.send_text(user)
+    
+    async def lag_monitor(self, interval: float = 0.05):
+        while not self.stopping:
+            started = time.perf_counter()
+            await asyncio.sleep(interval)
+            self.loop_lags.append(max(0.0, time.perf_counter() - started - interval))
+    
+    async def run(self):
+        bot = self.bot_module
+        app = type('App', (), {'bot': self.fake_bot, 'bot_data': {}})()
+        await bot.post_init(app)
+        
+        monitor = asyncio.create_task(self.lag_monitor())
+        users = [asyncio.create_task(self.user_loop(1_000_000 + i)) for i in range(self.args.users)]
+        
+        started = time.perf_counter()
+        await asyncio.sleep(self.args.duration)
+        self.stopping = True
+        elapsed = time.perf_counter() - started
+        
+        await asyncio.gather(*users, return_exceptions=True)
+        await monitor
+        await bot.post_stop(app)
+        await bot.post_shutdown(app)
+        return self.report(elapsed)
+    
+    def report(self, elapsed: float) -> dict:
+        relays = len(self.relay_latencies)
+        lags = self.loop_lags
+        return {
+            'users': self.args.users,
+            'duration_s': round(elapsed, 1),
+            'matches': self.matches,
+            'matches_per_s': round(self.matches / elapsed, 1),
+            'relays': relays,
+            'relays_per_s': round(relays / elapsed, 1),
+            'relay_p50_ms': round(percentile(self.relay_latencies, 50) * 1000, 1),
+            'relay_p99_ms': round(percentile(self.relay_latencies, 99) * 1000, 1),
+            'loop_lag_p50_ms': round(percentile(lags, 50) * 1000, 2),
+            'loop_lag_p99_ms': round(percentile(lags, 99) * 1000, 2),
+            'loop_lag_max_ms': round(max(lags, default=0) * 1000, 2),
+            'api_calls': sum(self.api_calls.values()),
+            'api_calls_per_relay': round(sum(self.api_calls.values()) / relays, 2) if relays else None,
+            'storage_ops': self.storage.ops,
+            'storage_ops_per_relay': round(self.storage.ops / relays, 3) if relays else None,
+            'storage_by_statement': dict(self.storage.by_statement),
+            'undelivered_relays': len(self.sent_at),
+            'relay_mean_ms': round(statistics.fmean(self.relay_latencies) * 1000, 1) if relays else 0.0,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--users', type=int, default=1000, help='simulated users')
+    parser.add_argument('--duration', type=float, default=30, help='seconds of load after start')
+    parser.add_argument('--rate', type=float, default=0.5, help='messages per second per chatting user')
+    parser.add_argument('--ramp-up', type=float, default=5, help='seconds over which users arrive')
+    parser.add_argument('--match-timeout', type=float, default=10, help='seconds a user waits before cancelling')
+    parser.add_argument('--next-prob', type=float, default=0.03, help='chance an action is Next')
+    parser.add_argument('--leave-prob', type=float, default=0.02, help='chance an action is Leave')
+    parser.add_argument('--block-prob', type=float, default=0.002, help='chance an action is Block')
+    parser.add_argument('--api-latency', type=float, default=30, help='fake Bot API latency, ms')
+    parser.add_argument('--db-latency', type=float, default=2, help='fake storage latency, ms')
+    parser.add_argument('--send-rate', type=float, default=1000,
+                        help='outbound global rate (SEND_GLOBAL_RATE); Telegram allows ~30/s for free bots')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args()
+    
+    os.environ['SEND_GLOBAL_RATE'] = str(args.send_rate)
+    bot = load_bot('1.6')
+    
+    results = asyncio.run(LoadTest(bot, args).run())
+    
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    
+    print(f"\n{results['users']:,} users for {results['duration_s']}s")
+    print(f"  matches        {results['matches']:>8,}  ({results['matches_per_s']}/s)")
+    print(f"  relays         {results['relays']:>8,}  ({results['relays_per_s']}/s)")
+    print(f"  relay latency  p50 {results['relay_p50_ms']} ms  p99 {results['relay_p99_ms']} ms")
+    print(f"  loop lag       p50 {results['loop_lag_p50_ms']} ms  p99 {results['loop_lag_p99_ms']} ms  "
+          f"max {results['loop_lag_max_ms']} ms")
+    print(f"  per relay      {results['api_calls_per_relay']} Bot API calls, "
+          f"{results['storage_ops_per_relay']} storage round trips")
+    print(f"  storage ops    {results['storage_by_statement']}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+"""
+Per-call timings for the storage and chat manager hot paths.
+
+The v1.6 storage path (target "storage") is timed at 100, 10k and
+--max-users stored users, the way the handlers call it: update_stats goes
+through StatsAggregator.add, get_user through UserCache (misses run on the
+AsyncDB worker threads), is_blocked through BlockIndex and save_chat
+through AsyncDB. Postgres is replaced by FakeStorage, so this is the bot's
+own overhead per call. ProfessionalChatManager (bondly_v1.6) is timed at
+10, 1k and --max-waiting waiting users, with as many chats open:
+find_match, create_chat, record_message and end_chat. Every call is timed
+on its own so p99 shows stalls, not just the average.
+
+Results are JSON-friendly. Save a run with --output and compare a later
+one against it with --compare; the script exits with status 1 when any
+p50 got slower by more than --threshold.
+
+    python benchmarks/microbench.py [--max-users 1000000] [--max-waiting 100000]
+                                    [--only storage|chat|db] [--json] [--output run.json]
+                                    [--compare run.json --threshold 1.5]
+
+The "db" target times the same four calls on ProfessionalDB from
+bondly_v1.5 (the JSON/journal store). v1.5 needs python-telegram-bot 13,
+so it is reported as skipped in the v1.6 environment; run it from its own
+virtualenv:
+
+    python -m venv .venv-v15 && .venv-v15/bin/pip install "python-telegram-bot>=13,<14"
+    .venv-v15/bin/python benchmarks/microbench.py --only db
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+
+from common import FakeStorage, load_bot
+
+
+def timed(call, iterations: int, setup=None) -> dict:
+    """Time ``call(*setup(i))`` once per iteration; ``setup`` itself runs untimed"""
+    samples = []
+    clock = time.perf_counter_ns
+    for i in range(iterations):
+        args = setup(i) if setup else ()
+        started = clock()
+        call(*args)
+        samples.append(clock() - started)
+    return summarize(samples)
+
+
+async def timed_async(call, iterations: int, setup=None) -> dict:
+    """``timed`` for coroutine functions; each sample includes the await"""
+    samples = []
+    clock = time.perf_counter_ns
+    for i in range(iterations):
+        args = setup(i) if setup else ()
+        started = clock()
+        await call(*args)
+        samples.append(clock() - started)
+    return summarize(samples)
+
+
+def summarize(samples: list) -> dict:
+    iterations = len(samples)
+    samples.sort()
+    return {
+        'iterations': iterations,
+        'mean_ns': round(sum(samples) / iterations),
+        'p50_ns': samples[iterations // 2],
+        'p99_ns': samples[min(iterations - 1, iterations * 99 // 100)],
+        'max_ns': samples[-1],
+    }
+
+
+# ==================== Storage path (v1.6) ====================
+def bench_storage(bot, stored: int, iterations: int, rng: random.Random) -> dict:
+    """Fresh AsyncDB, UserCache, StatsAggregator and BlockIndex over FakeStorage.
+    
+    The cache is filled as far as USER_CACHE_SIZE allows and every tenth
+    user has blocked someone, so hit rates and index sizes follow ``stored``.
+    """
+    storage = FakeStorage()
+    bot.db.db_pool = object()
+    bot.db._execute = storage.execute
+    
+    adb = bot.AsyncDB(bot.db)
+    cache = bot.UserCache(adb)
+    stats = bot.StatsAggregator(adb)
+    blocks = bot.BlockIndex(adb)
+    
+    profile = {'nickname': 'bench', 'gender': 'male', 'search_filter': 'random'}
+    for uid in range(max(0, stored - cache.max_size), stored):
+        cache._store(uid, profile)
+    for uid in range(0, stored, 10):
+        blocks._add(uid, (uid + 1) % stored, {'nickname': 'bench', 'blocked_at': None})
+    
+    chat = {'user1': {'id': 1, 'data': profile}, 'user2': {'id': 2, 'data': profile},
+            'messages_sent_user1': 12, 'messages_sent_user2': 9, 'media_sent': 1,
+            'created': '2024-01-01T00:00:00', 'ended': '2024-01-01T00:05:00',
+            'reason': 'ended', 'duration': 300}
+    ids = [rng.randrange(stored) for _ in range(iterations)]
+    
+    async def run():
+        return {
+            'update_stats': timed(stats.add, iterations, lambda i: (ids[i], 'messages_sent')),
+            'get_user': await timed_async(cache.get, iterations, lambda i: (ids[i],)),
+            'is_blocked': timed(blocks.is_blocked, iterations, lambda i: (ids[i], ids[-i - 1])),
+            'save_chat': await timed_async(lambda: adb.save_chat(chat), iterations),
+        }
+    
+    try:
+        return asyncio.run(run())
+    finally:
+        adb.shutdown()
+
+
+# ==================== ProfessionalDB (v1.5) ====================
+def bench_db(bot, stored: int, iterations: int, rng: random.Random) -> dict:
+    """A fresh ProfessionalDB in its own directory, filled with ``stored`` users.
+    
+    Rows are put straight into the in-memory dicts and share one profile and
+    one stats dict, so 1M users fit in memory; lookups, journal appends and
+    compaction still see ``stored`` rows.
+    """
+    profile = {'nickname': 'bench', 'gender': 'male', 'search_filter': 'random',
+               'joined': '2024-01-01T00:00:00'}
+    stats = dict(bot.DEFAULT_STATS, last_active='2024-01-01T00:00:00',
+                 last_reset=time.strftime('%Y-%m-%d'))
+    
+    directory = f"db-{stored}"
+    os.makedirs(directory)
+    os.chdir(directory)
+    database = bot.ProfessionalDB()
+    for uid in range(stored):
+        key = str(uid)
+        database.users[key] = profile
+        database.stats[key] = stats
+        if uid % 10 == 0:
+            database.blocked[key] = {str((uid + 1) % stored): {'nickname': 'bench'}}
+    database._rebuild_totals()
+    
+    chat = {'chat_id': 'chat_1', 'user1': 1, 'user2': 2, 'created': '2024-01-01T00:00:00',
+            'ended': '2024-01-01T00:05:00', 'duration': 300, 'reason': 'ended',
+            'messages_sent_user1': 12, 'messages_sent_user2': 9, 'media_sent': 1}
+    ids = [rng.randrange(stored) for _ in range(iterations)]
+    
+    try:
+        return {
+            'update_stats': timed(database.update_stats, iterations, lambda i: (ids[i], 'messages_sent')),
+            'get_user': timed(database.get_user, iterations, lambda i: (ids[i],)),
+            'is_blocked': timed(database.is_blocked, iterations, lambda i: (ids[i], ids[-i - 1])),
+            'save_chat': timed(lambda: database.save_chat(chat), iterations),
+        }
+    finally:
+        database.close()
+        os.chdir('..')
+
+
+# ==================== ProfessionalChatManager (v1.6) ====================
+def bench_chat(bot, waiting: int, iterations: int, rng: random.Random) -> dict:
+    """A fresh manager with ``waiting`` users searching and ``waiting`` chats open.
+    
+    Mutating calls are undone between iterations (untimed) so the pool and
+    chat count stay at their target size.
+    """
+    manager = bot.ProfessionalChatManager()
+    genders = ('male', 'female')
+    filters = ('random', 'random', 'male', 'female')
+    
+    def profile(uid):
+        return {'nickname': f'user{uid}', 'gender': genders[uid % 2], 'search_filter': filters[uid % 4]}
+    
+    waiting_ids = list(range(1, waiting + 1))
+    for uid in waiting_ids:
+        manager.add_to_waiting(uid, profile(uid))
+    
+    chat_ids = []
+    first = waiting + 1
+    for n in range(waiting):
+        user1, user2 = first + 2 * n, first + 2 * n + 1
+        chat_ids.append(manager.create_chat(user1, user2, profile(user1), profile(user2)))
+    
+    results = {}
+    results['find_match'] = timed(manager.find_match, iterations, lambda i: (rng.choice(waiting_ids),))
+    
+    def pick_pair(i):
+        # Undo the previous create_chat so the pool keeps its size
+        if pair[0]:
+            manager.end_chat(pair[0])
+            for uid in pair[1:]:
+                manager.add_to_waiting(uid, profile(uid))
+        user1, user2 = rng.sample(waiting_ids, 2)
+        pair[1:] = [user1, user2]
+        return user1, user2, manager.waiting[user1].data, manager.waiting[user2].data
+    
+    def create(user1, user2, data1, data2):
+        pair[0] = manager.create_chat(user1, user2, data1, data2)
+    
+    pair = [None, None, None]
+    results['create_chat'] = timed(create, iterations, pick_pair)
+    pick_pair(0)
+    
+    def pick_chat(i):
+        index = rng.randrange(len(chat_ids))
+        return chat_ids[index], first + 2 * index + i % 2
+    
+    results['record_message'] = timed(manager.record_message, iterations, pick_chat)
+    
+    def pick_ended(i):
+        # Reopen the chat ended by the previous iteration
+        if ended[0] is not None:
+            index = ended[0]
+            user1, user2 = first + 2 * index, first + 2 * index + 1
+            chat_ids[index] = manager.create_chat(user1, user2, profile(user1), profile(user2))
+        ended[0] = rng.randrange(len(chat_ids))
+        return chat_ids[ended[0]], 'ended'
+    
+    ended = [None]
+    results['end_chat'] = timed(manager.end_chat, iterations, pick_ended)
+    return results
+
+
+# ==================== RUNNER ====================
+def run_target(name, version, sizes, size_label, bench, iterations, seed):
+    rows = []
+    try:
+        bot = load_bot(version)
+    except Exception as e:
+        print(f"skipping {name}: bondly_v{version}.py could not be imported ({type(e).__name__}: {e})",
+              file=sys.stderr)
+        return [{'target': name, 'skipped': f"{type(e).__name__}: {e}"}]
+    
+    for size in sizes:
+        results = bench(bot, size, iterations, random.Random(seed))
+        for op, timing in results.items():
+            rows.append({'target': name, 'op': op, size_label: size, **timing})
+    return rows
+
+
+def compare(rows, baseline_path: str, threshold: float) -> list:
+    """Return ``(key, old_p50, new_p50)`` for every op slower than ``threshold`` x baseline"""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    
+    def key(row):
+        size = row.get('stored_users', row.get('waiting_users'))
+        return f"{row['target']}.{row['op']}@{size}"
+    
+    old = {key(row): row for row in baseline['results'] if 'op' in row}
+    regressions = []
+    for row in rows:
+        if 'op' not in row or key(row) not in old:
+            continue
+        before = old[key(row)]['p50_ns']
+        if before and row['p50_ns'] > before * threshold:
+            regressions.append((key(row), before, row['p50_ns']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--max-users', type=int, default=1_000_000, help='largest stored-user size')
+    parser.add_argument('--max-waiting', type=int, default=100_000, help='largest waiting-user size')
+    parser.add_argument('--iterations', type=int, default=20_000, help='timed calls per op and size')
+    parser.add_argument('--only', choices=('storage', 'chat', 'db'), help='run one target')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    parser.add_argument('--output', help='also write the JSON results to this file')
+    parser.add_argument('--compare', metavar='BASELINE', help='JSON file from an earlier --output')
+    parser.add_argument('--threshold', type=float, default=1.5, help='p50 slowdown that counts as a regression')
+    args = parser.parse_args()
+    
+    output = os.path.abspath(args.output) if args.output else None
+    baseline = os.path.abspath(args.compare) if args.compare else None
+    
+    # v1.5 keeps its files in the working directory
+    os.chdir(tempfile.mkdtemp(prefix='bondly-bench-'))
+    
+    rows = []
+    if args.only in (None, 'storage'):
+        sizes = sorted({100, 10_000, args.max_users})
+        rows += run_target('AsyncDB', '1.6', sizes, 'stored_users', bench_storage,
+                           args.iterations, args.seed)
+    if args.only in (None, 'chat'):
+        sizes = sorted({10, 1_000, args.max_waiting})
+        rows += run_target('ProfessionalChatManager', '1.6', sizes, 'waiting_users', bench_chat,
+                           args.iterations, args.seed)
+    if args.only in (None, 'db'):
+        sizes = sorted({100, 10_000, args.max_users})
+        rows += run_target('ProfessionalDB', '1.5', sizes, 'stored_users', bench_db,
+                           args.iterations, args.seed)
+    
+    report = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'results': rows,
+    }
+    
+    if output:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+    
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(f"{'op':<40} {'size':>9} {'mean':>9} {'p50':>9} {'p99':>9} {'max':>10}  (us)")
+        for row in rows:
+            if 'op' not in row:
+                continue
+            size = row.get('stored_users', row.get('waiting_users'))
+            print(f"{row['target'] + '.' + row['op']:<40} {size:>9,} "
+                  f"{row['mean_ns'] / 1000:>9.2f} {row['p50_ns'] / 1000:>9.2f} "
+                  f"{row['p99_ns'] / 1000:>9.2f} {row['max_ns'] / 1000:>10.1f}")
+    
+    if baseline:
+        regressions = compare(rows, baseline, args.threshold)
+        for key, before, after in regressions:
+            print(f"REGRESSION {key}: p50 {before / 1000:.2f} us -> {after / 1000:.2f} us", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -7,6 +7,9 @@ Python 3.13 Compatible (using python-telegram-bot v13.15)
 
 import os
 import json
+import gzip
+import shutil
+import atexit
 import re
 import threading
 import logging
@@ -75,206 +78,549 @@ logger = logging.getLogger(__name__)
 # Bot version
 BOT_VERSION = "1.5"
 
+# ==================== CHAT HISTORY LOG ====================
+class ChatHistoryLog:
+    """Append-only chat history stored as rotated JSON Lines segments.
+
+    Each ended chat is one line in ``<directory>/chats-YYYYMMDD-NNNN.jsonl``.
+    A new segment is started when the day changes or the active one grows
+    past ``max_bytes``; sealed segments are gzip-compressed in the background.
+    The pre-1.5 ``chat_history.json`` list is still read by ``iter_chats``.
+    """
+    
+    def __init__(self, directory: str = 'chat_history', legacy_file: str = 'chat_history.json',
+                 max_bytes: Optional[int] = None, compress: Optional[bool] = None):
+        if max_bytes is None:
+            max_bytes = int(os.getenv('CHAT_LOG_MAX_BYTES', str(8 * 1024 * 1024)))
+        if compress is None:
+            compress = os.getenv('CHAT_LOG_COMPRESS', '1') != '0'
+        
+        self.directory = directory
+        self.legacy_file = legacy_file
+        self.max_bytes = max_bytes
+        self.compress = compress
+        self.lock = threading.Lock()
+        
+        os.makedirs(self.directory, exist_ok=True)
+        
+        self._day = None
+        self._path = None
+        self._file = None
+        self._open_segment()
+        
+        # Seal anything left uncompressed by an earlier run
+        for name in self._segment_names():
+            path = os.path.join(self.directory, name)
+            if name.endswith('.jsonl') and path != self._path:
+                self._seal(path)
+    
+    def _segment_names(self) -> List[str]:
+        return sorted(
+            name for name in os.listdir(self.directory)
+            if name.startswith('chats-') and (name.endswith('.jsonl') or name.endswith('.jsonl.gz'))
+        )
+    
+    def _open_segment(self):
+        """Open today's newest segment, or start a new one if it is full."""
+        self._day = datetime.now().strftime('%Y%m%d')
+        prefix = f"chats-{self._day}-"
+        
+        todays = [name for name in self._segment_names() if name.startswith(prefix)]
+        number = 1
+        if todays:
+            last = todays[-1]
+            number = int(last[len(prefix):].split('.')[0])
+            last_path = os.path.join(self.directory, last)
+            if last.endswith('.gz') or os.path.getsize(last_path) >= self.max_bytes:
+                number += 1
+        
+        self._path = os.path.join(self.directory, f"{prefix}{number:04d}.jsonl")
+        self._file = open(self._path, 'a')
+    
+    def _rotate(self):
+        sealed = self._path
+        self._file.close()
+        self._open_segment()
+        if sealed != self._path:
+            self._seal(sealed)
+    
+    def _seal(self, path: str):
+        if not self.compress:
+            return
+        threading.Thread(target=self._compress, args=(path,), name="chat-log-gzip", daemon=True).start()
+    
+    @staticmethod
+    def _compress(path: str):
+        try:
+            with open(path, 'rb') as src, gzip.open(f"{path}.gz.tmp", 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+            os.replace(f"{path}.gz.tmp", f"{path}.gz")
+            os.remove(path)
+        except Exception as e:
+            logger.error(f"Could not compress {path}: {e}")
+    
+    def append(self, chat_data: Dict):
+        line = json.dumps(chat_data, default=str) + '\n'
+        
+        with self.lock:
+            if datetime.now().strftime('%Y%m%d') != self._day or self._file.tell() >= self.max_bytes:
+                self._rotate()
+            self._file.write(line)
+            self._file.flush()
+    
+    def iter_chats(self, since: Optional[datetime] = None):
+        """Yield stored chats oldest first without loading the whole history.
+        
+        With ``since``, only chats that ended at or after it are yielded.
+        """
+        for chat in self._read_chats(since.strftime('%Y%m%d') if since else None):
+            if since is None or self._ended(chat) >= since:
+                yield chat
+    
+    @staticmethod
+    def _ended(chat: Dict) -> datetime:
+        try:
+            return datetime.fromisoformat(chat.get('ended') or chat.get('created'))
+        except (AttributeError, TypeError, ValueError):
+            return datetime.min
+    
+    def _read_chats(self, since_day: Optional[str]):
+        if os.path.exists(self.legacy_file):
+            try:
+                with open(self.legacy_file, 'r') as f:
+                    legacy = json.load(f)
+                if isinstance(legacy, list):
+                    yield from legacy
+            except Exception as e:
+                logger.error(f"Could not read {self.legacy_file}: {e}")
+        
+        with self.lock:
+            self._file.flush()
+        
+        names = self._segment_names()
+        listed = set(names)
+        for name in names:
+            if since_day and name.split('-')[1] < since_day:
+                continue
+            if f"{name}.gz" in listed:
+                # Caught mid-compression; the .gz only appears once complete
+                continue
+            
+            path = os.path.join(self.directory, name)
+            opener = gzip.open if name.endswith('.gz') else open
+            try:
+                with opener(path, 'rt') as f:
+                    for line in f:
+                        if line.strip():
+                            yield json.loads(line)
+            except FileNotFoundError:
+                # Compressed away between listing and opening
+                if not name.endswith('.gz') and os.path.exists(f"{path}.gz"):
+                    with gzip.open(f"{path}.gz", 'rt') as f:
+                        for line in f:
+                            if line.strip():
+                                yield json.loads(line)
+    
+    def close(self):
+        with self.lock:
+            self._file.close()
+
 # ==================== PROFESSIONAL DATABASE ====================
+DEFAULT_STATS = {
+    'messages_sent': 0,
+    'messages_received': 0,
+    'media_sent': 0,
+    'chats_started': 0,
+    'chats_today': 0,
+    'total_chat_duration': 0,
+    'ratings_positive': 0,
+    'ratings_negative': 0,
+}
+
+# Stats summed into the global totals shown by /stats
+GLOBAL_STAT_COLUMNS = ('messages_sent', 'messages_received', 'chats_started',
+                       'ratings_positive', 'ratings_negative')
+
 class ProfessionalDB:
-    def __init__(self):
+    """JSON storage kept in memory, made durable by an append-only journal.
+
+    The JSON files are snapshots: they are parsed once at startup and all
+    reads are served from the in-memory dicts. Every user, stats or block
+    mutation is applied in memory and appended as one JSON line to
+    ``db.journal``. Records carry the new values rather than deltas, so
+    replaying a record twice is harmless.
+
+    A background thread compacts the journal every ``flush_interval``
+    seconds, or sooner once ``flush_threshold`` records are pending: the
+    journal is rotated to ``db.journal.old``, the snapshots are rewritten
+    atomically and the old journal is deleted. At startup both journals are
+    replayed onto the snapshots and compacted.
+
+    Rows in the in-memory dicts are replaced on every change rather than
+    updated in place. Compaction therefore only holds the lock for a shallow
+    copy of each dirty dict and serializes it afterwards, so reads and writes
+    are not blocked while a large table is dumped.
+
+    Global totals for /stats are running counters kept in step by ``_apply``,
+    so ``get_global_stats`` is O(1). They are only summed from scratch at
+    startup, before the journals are replayed.
+    """
+    
+    def __init__(self, flush_interval: Optional[float] = None, flush_threshold: Optional[int] = None,
+                 fsync: Optional[bool] = None):
         self.users_file = 'users.json'
         self.blocked_file = 'blocked.json'
         self.stats_file = 'stats.json'
-        self.chats_file = 'chat_history.json'
+        self.chats_dir = 'chat_history'
+        self.journal_file = 'db.journal'
+        self.old_journal_file = 'db.journal.old'
+        
+        if flush_interval is None:
+            flush_interval = float(os.getenv('DB_FLUSH_INTERVAL', '60'))
+        if flush_threshold is None:
+            flush_threshold = int(os.getenv('DB_FLUSH_THRESHOLD', '5000'))
+        if fsync is None:
+            fsync = os.getenv('DB_JOURNAL_FSYNC', '0') == '1'
+        
+        self.flush_interval = flush_interval
+        self.flush_threshold = flush_threshold
+        self.fsync = fsync
+        
         self._ensure_files()
+        
+        self.lock = threading.RLock()
+        # One compaction at a time: they share the tmp files and db.journal.old
+        self.flush_lock = threading.Lock()
+        self.users: Dict[str, Dict] = self._load(self.users_file, {})
+        self.stats: Dict[str, Dict] = self._load(self.stats_file, {})
+        self.blocked: Dict[str, Dict] = self._load(self.blocked_file, {})
+        self.history = ChatHistoryLog(self.chats_dir)
+        
+        self._dirty = set()
+        self._pending = 0
+        self._rebuild_totals()
+        
+        replayed = self._replay(self.old_journal_file) + self._replay(self.journal_file)
+        if replayed:
+            logger.info(f"Replayed {replayed} journal records")
+        
+        self._journal = open(self.journal_file, 'a')
+        self.flush()
+        
+        self._flush_now = threading.Event()
+        self._closed = threading.Event()
+        self._flusher = threading.Thread(target=self._flush_loop, name="db-flusher", daemon=True)
+        self._flusher.start()
+        atexit.register(self.close)
     
     def _ensure_files(self):
-        for file in [self.users_file, self.blocked_file, self.stats_file, self.chats_file]:
+        for file in [self.users_file, self.blocked_file, self.stats_file]:
             if not os.path.exists(file):
                 with open(file, 'w') as f:
                     json.dump({}, f)
     
-    # User management
-    def get_user(self, user_id: int) -> Optional[Dict]:
+    def _load(self, path: str, default):
         try:
-            with open(self.users_file, 'r') as f:
-                users = json.load(f)
-                return users.get(str(user_id))
-        except:
-            return None
-    
-    def save_user(self, user_id: int, user_data: Dict):
+            with open(path, 'r') as f:
+                data = json.load(f)
+            if isinstance(data, type(default)):
+                return data
+        except Exception as e:
+            logger.error(f"Could not load {path}: {e}")
+        return default
+    
+    # Global totals
+    @staticmethod
+    def _as_int(value) -> int:
         try:
-            with open(self.users_file, 'r') as f:
-                users = json.load(f)
-        except:
-            users = {}
+            return int(value)
+        except (TypeError, ValueError):
+            return 0
+    
+    def _rebuild_totals(self):
+        self.totals = {column: 0 for column in GLOBAL_STAT_COLUMNS}
+        for user_stats in self.stats.values():
+            for column in GLOBAL_STAT_COLUMNS:
+                self.totals[column] += self._as_int(user_stats.get(column, 0))
+    
+    # Journal
+    def _apply(self, record: Dict):
+        """Apply one journal record to the in-memory state."""
+        op = record['op']
+        key = str(record['id'])
+        
+        if op == 'user':
+            self.users[key] = record['data']
+            self._dirty.add(self.users_file)
+        elif op == 'delete_user':
+            self.users.pop(key, None)
+            self._dirty.add(self.users_file)
+        elif op == 'stats':
+            user_stats = self.stats.get(key, {})
+            for column in GLOBAL_STAT_COLUMNS:
+                if column in record['set']:
+                    self.totals[column] += (self._as_int(record['set'][column]) -
+                                            self._as_int(user_stats.get(column, 0)))
+            self.stats[key] = {**user_stats, **record['set']}
+            self._dirty.add(self.stats_file)
+        elif op == 'block':
+            blocked = dict(self.blocked.get(key, {}))
+            blocked[str(record['target'])] = record['data']
+            self.blocked[key] = blocked
+            self._dirty.add(self.blocked_file)
+        elif op == 'unblock':
+            if key in self.blocked:
+                blocked = dict(self.blocked[key])
+                blocked.pop(str(record['target']), None)
+                self.blocked[key] = blocked
+            self._dirty.add(self.blocked_file)
+    
+    def _commit(self, record: Dict):
+        """Apply a mutation and append it to the journal. Caller must hold ``self.lock``."""
+        self._apply(record)
         
-        users[str(user_id)] = user_data
+        self._journal.write(json.dumps(record, default=str) + '\n')
+        self._journal.flush()
+        if self.fsync:
+            os.fsync(self._journal.fileno())
         
-        with open(self.users_file, 'w') as f:
-            json.dump(users, f, indent=2)
+        self._pending += 1
+        if self._pending >= self.flush_threshold:
+            self._flush_now.set()
     
-    def delete_user(self, user_id: int):
+    def _replay(self, path: str) -> int:
+        """Apply a journal's records and cut off a torn final line.
+        
+        A record only counts once its newline is on disk. An unterminated
+        last line is left over from a crash mid-append; it is truncated so
+        the next record is not glued onto it and lost at the next replay.
+        """
+        if not os.path.exists(path):
+            return 0
+        
+        count = 0
+        end = 0
+        with open(path, 'rb+') as f:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    logger.warning(f"Dropping torn journal record at the end of {path}")
+                    f.truncate(end)
+                    break
+                
+                try:
+                    self._apply(json.loads(line))
+                    count += 1
+                except Exception:
+                    # Only journals written before torn tails were truncated have these
+                    logger.warning(f"Skipping unreadable journal record in {path}")
+                end += len(line)
+        return count
+    
+    def _flush_loop(self):
+        while not self._closed.is_set():
+            self._flush_now.wait(self.flush_interval)
+            self._flush_now.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Journal compaction failed: {e}")
+    
+    def flush(self):
+        """Compact the journal into fresh snapshots of every dirty file."""
+        with self.flush_lock:
+            self._compact()
+    
+    def _compact(self):
+        files = {
+            self.users_file: self.users,
+            self.stats_file: self.stats,
+            self.blocked_file: self.blocked,
+        }
+        
+        with self.lock:
+            if not self._dirty:
+                return
+            # Rows are replaced, never changed in place, so a shallow copy
+            # matches the rotated journal exactly. Serializing and writing
+            # happen after the lock is released.
+            snapshots = {path: dict(files[path]) for path in self._dirty}
+            self._dirty.clear()
+            self._pending = 0
+            
+            self._journal.close()
+            if os.path.exists(self.old_journal_file):
+                # A previous compaction died; keep its records in the rotated log
+                with open(self.old_journal_file, 'a') as old, open(self.journal_file, 'r') as cur:
+                    old.write(cur.read())
+                os.remove(self.journal_file)
+            else:
+                os.replace(self.journal_file, self.old_journal_file)
+            self._journal = open(self.journal_file, 'a')
+        
+        written = set()
         try:
-            with open(self.users_file, 'r') as f:
-                users = json.load(f)
-        except:
-            users = {}
+            for path, snapshot in snapshots.items():
+                self._write_snapshot(path, snapshot)
+                written.add(path)
+        except Exception:
+            # The rotated journal still holds these files' records; keep it
+            # and rewrite them on the next compaction
+            with self.lock:
+                self._dirty.update(set(snapshots) - written)
+            raise
         
-        users.pop(str(user_id), None)
+        os.remove(self.old_journal_file)
+    
+    @staticmethod
+    def _write_snapshot(path: str, snapshot: Dict):
+        """Atomically replace ``path`` with ``snapshot`` as a JSON object.
+        
+        Rows are encoded one at a time: a single json.dumps of a million-row
+        dict would hold the GIL for seconds and stall every other thread.
+        """
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w') as f:
+            f.write('{')
+            separator = ''
+            for key, row in snapshot.items():
+                f.write(f"{separator}{json.dumps(key)}: {json.dumps(row, default=str)}")
+                separator = ', '
+            f.write('}')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    
+    def close(self):
+        """Stop the compaction thread and write final snapshots."""
+        if self._closed.is_set():
+            return
+        self._closed.set()
+        self._flush_now.set()
+        self._flusher.join(timeout=10)
+        self.flush()
+        with self.lock:
+            self._journal.close()
+        self.history.close()
+    
+    # User management
+    def get_user(self, user_id: int) -> Optional[Dict]:
+        with self.lock:
+            user = self.users.get(str(user_id))
+            return dict(user) if user else None
+    
+    def get_all_users(self) -> Dict:
+        with self.lock:
+            return dict(self.users)
+    
+    def is_nickname_taken(self, nick: str, exclude_user_id: Optional[int] = None) -> bool:
+        nick = nick.lower()
+        exclude = str(exclude_user_id) if exclude_user_id is not None else None
         
-        with open(self.users_file, 'w') as f:
-            json.dump(users, f, indent=2)
+        with self.lock:
+            for uid, data in self.users.items():
+                if uid != exclude and data.get('nickname', '').lower() == nick:
+                    return True
+        return False
+    
+    def save_user(self, user_id: int, user_data: Dict):
+        with self.lock:
+            self._commit({'op': 'user', 'id': user_id, 'data': dict(user_data)})
+    
+    def delete_user(self, user_id: int):
+        with self.lock:
+            if str(user_id) in self.users:
+                self._commit({'op': 'delete_user', 'id': user_id})
     
     # Statistics
+    def _default_stats(self) -> Dict:
+        stats = dict(DEFAULT_STATS)
+        stats['last_active'] = datetime.now().isoformat()
+        stats['last_reset'] = datetime.now().date().isoformat()
+        return stats
+    
     def get_stats(self, user_id: int) -> Dict:
-        try:
-            with open(self.stats_file, 'r') as f:
-                stats = json.load(f)
-                user_stats = stats.get(str(user_id), {})
-                
-                default_stats = {
-                    'messages_sent': 0,
-                    'messages_received': 0,
-                    'media_sent': 0,
-                    'chats_started': 0,
-                    'chats_today': 0,
-                    'total_chat_duration': 0,
-                    'ratings_positive': 0,
-                    'ratings_negative': 0,
-                    'last_active': datetime.now().isoformat(),
-                    'last_reset': datetime.now().date().isoformat()
-                }
-                
-                for key, value in default_stats.items():
-                    if key not in user_stats:
-                        user_stats[key] = value
-                
-                return user_stats
-        except:
-            return {
-                'messages_sent': 0,
-                'messages_received': 0,
-                'media_sent': 0,
-                'chats_started': 0,
-                'chats_today': 0,
-                'total_chat_duration': 0,
-                'ratings_positive': 0,
-                'ratings_negative': 0,
-                'last_active': datetime.now().isoformat(),
-                'last_reset': datetime.now().date().isoformat()
-            }
+        user_stats = self._default_stats()
+        with self.lock:
+            user_stats.update(self.stats.get(str(user_id), {}))
+        return user_stats
     
     def update_stats(self, user_id: int, stat_type: str, value: int = 1):
-        try:
-            with open(self.stats_file, 'r') as f:
-                stats = json.load(f)
-        except:
-            stats = {}
-        
         user_id_str = str(user_id)
-        if user_id_str not in stats:
-            stats[user_id_str] = self.get_stats(user_id)
-        
-        today = datetime.now().date().isoformat()
-        if stats[user_id_str].get('last_reset') != today:
-            stats[user_id_str]['chats_today'] = 0
-            stats[user_id_str]['last_reset'] = today
         
-        if stat_type == 'last_active':
-            stats[user_id_str][stat_type] = datetime.now().isoformat()
-        elif stat_type in stats[user_id_str]:
-            if isinstance(stats[user_id_str][stat_type], (int, float)):
-                stats[user_id_str][stat_type] += value
+        with self.lock:
+            if user_id_str in self.stats:
+                user_stats = self.stats[user_id_str]
+                changes = {}
             else:
-                stats[user_id_str][stat_type] = value
-        
-        with open(self.stats_file, 'w') as f:
-            json.dump(stats, f, indent=2)
+                user_stats = self._default_stats()
+                changes = dict(user_stats)
+            
+            today = datetime.now().date().isoformat()
+            if user_stats.get('last_reset') != today:
+                changes['chats_today'] = 0
+                changes['last_reset'] = today
+            
+            if stat_type == 'last_active':
+                changes[stat_type] = datetime.now().isoformat()
+            elif stat_type in user_stats:
+                current = changes.get(stat_type, user_stats[stat_type])
+                if isinstance(current, (int, float)):
+                    changes[stat_type] = current + value
+                else:
+                    changes[stat_type] = value
+            
+            if changes:
+                self._commit({'op': 'stats', 'id': user_id, 'set': changes})
     
     def get_global_stats(self) -> Dict:
-        try:
-            with open(self.users_file, 'r') as f:
-                users = json.load(f)
-        except:
-            users = {}
-        
-        stats = self.get_all_stats()
-        total_messages_sent = sum(int(s.get('messages_sent', 0)) for s in stats.values())
-        total_messages_received = sum(int(s.get('messages_received', 0)) for s in stats.values())
-        total_chats = sum(int(s.get('chats_started', 0)) for s in stats.values())
+        with self.lock:
+            totals = dict(self.totals)
+            total_users = len(self.users)
         
         return {
-            'total_users': len(users),
-            'total_messages': total_messages_sent + total_messages_received,
-            'total_chats': total_chats,
-            'total_positive_ratings': sum(int(s.get('ratings_positive', 0)) for s in stats.values()),
-            'total_negative_ratings': sum(int(s.get('ratings_negative', 0)) for s in stats.values())
+            'total_users': total_users,
+            'total_messages': totals['messages_sent'] + totals['messages_received'],
+            'total_chats': totals['chats_started'],
+            'total_positive_ratings': totals['ratings_positive'],
+            'total_negative_ratings': totals['ratings_negative']
         }
     
     def get_all_stats(self) -> Dict:
-        try:
-            with open(self.stats_file, 'r') as f:
-                return json.load(f)
-        except:
-            return {}
+        with self.lock:
+            return {uid: dict(s) for uid, s in self.stats.items()}
     
     # Blocked users
     def get_blocked_users(self, user_id: int) -> Dict:
-        try:
-            with open(self.blocked_file, 'r') as f:
-                blocked = json.load(f)
-                return blocked.get(str(user_id), {})
-        except:
-            return {}
+        with self.lock:
+            return dict(self.blocked.get(str(user_id), {}))
     
     def block_user(self, blocker_id: int, blocked_id: int, blocked_nick: str):
-        try:
-            with open(self.blocked_file, 'r') as f:
-                blocked = json.load(f)
-        except:
-            blocked = {}
-        
-        if str(blocker_id) not in blocked:
-            blocked[str(blocker_id)] = {}
-        
-        blocked[str(blocker_id)][str(blocked_id)] = {
-            'nickname': blocked_nick,
-            'blocked_at': datetime.now().isoformat()
-        }
-        
-        with open(self.blocked_file, 'w') as f:
-            json.dump(blocked, f, indent=2)
+        with self.lock:
+            self._commit({
+                'op': 'block',
+                'id': blocker_id,
+                'target': blocked_id,
+                'data': {'nickname': blocked_nick, 'blocked_at': datetime.now().isoformat()}
+            })
     
     def unblock_user(self, blocker_id: int, blocked_id: int) -> bool:
-        try:
-            with open(self.blocked_file, 'r') as f:
-                blocked = json.load(f)
-        except:
-            return False
-        
-        if str(blocker_id) in blocked and str(blocked_id) in blocked[str(blocker_id)]:
-            del blocked[str(blocker_id)][str(blocked_id)]
-            
-            with open(self.blocked_file, 'w') as f:
-                json.dump(blocked, f, indent=2)
-            return True
+        with self.lock:
+            if str(blocked_id) in self.blocked.get(str(blocker_id), {}):
+                self._commit({'op': 'unblock', 'id': blocker_id, 'target': blocked_id})
+                return True
         
         return False
     
     def is_blocked(self, blocker_id: int, blocked_id: int) -> bool:
-        blocked = self.get_blocked_users(blocker_id)
-        return str(blocked_id) in blocked
+        with self.lock:
+            return str(blocked_id) in self.blocked.get(str(blocker_id), {})
     
     # Chat history
     def save_chat(self, chat_data: Dict):
-        try:
-            with open(self.chats_file, 'r') as f:
-                chats = json.load(f)
-        except:
-            chats = []
-        
-        chats.append(chat_data)
-        
-        with open(self.chats_file, 'w') as f:
-            json.dump(chats, f, indent=2, default=str)
+        self.history.append(chat_data)
+    
+    def iter_chats(self, since: Optional[datetime] = None):
+        return self.history.iter_chats(since)
 
 db = ProfessionalDB()
 
@@ -555,16 +901,9 @@ def register_nickname(update: Update, context: CallbackContext):
         return REG_NICKNAME
     
     # Check if unique
-    try:
-        with open('users.json', 'r') as f:
-            users = json.load(f)
-    except:
-        users = {}
-    
-    for user_data in users.values():
-        if user_data.get('nickname', '').lower() == nick.lower():
-            update.message.reply_text(f"'{nick}' is already taken!\n\nPlease choose another:")
-            return REG_NICKNAME
+    if db.is_nickname_taken(nick):
+        update.message.reply_text(f"'{nick}' is already taken!\n\nPlease choose another:")
+        return REG_NICKNAME
     
     context.user_data['nickname'] = nick
     
@@ -1079,17 +1418,9 @@ def nickname_command(update: Update, context: CallbackContext):
         return
     
     # Check if unique (excluding current user)
-    try:
-        with open('users.json', 'r') as f:
-            users = json.load(f)
-    except:
-        users = {}
-    
-    for uid, data in users.items():
-        # Skip the current user
-        if str(user_id) != uid and data.get('nickname', '').lower() == new_nick.lower():
-            update.message.reply_text(f"'{new_nick}' is already taken!")
-            return
+    if db.is_nickname_taken(new_nick, exclude_user_id=user_id):
+        update.message.reply_text(f"'{new_nick}' is already taken!")
+        return
     
     # Update nickname
     old_nick = user_data.get('nickname', '')
@@ -1561,6 +1892,9 @@ def main():
     # Run bot
     updater.start_polling()
     updater.idle()
+    
+    # Persist anything still waiting for the background flush
+    db.close()
 
 if __name__ == "__main__":
     main()
@@ -11,16 +11,25 @@ import threading
 import logging
 import time
 import asyncio
+import signal
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 import random
+import itertools
+import heapq
+from collections import OrderedDict, deque
 from datetime import datetime, timedelta
-from typing import Dict, Optional, Tuple, List
+from typing import Dict, Optional, Tuple, List, Iterable
 from dotenv import load_dotenv
+from aiohttp import web
 
 # Telegram imports
-from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove, InlineKeyboardMarkup, InlineKeyboardButton
+from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove, InlineKeyboardMarkup, InlineKeyboardButton, MessageEntity
+from telegram import InputMediaPhoto, InputMediaVideo, InputMediaAudio, InputMediaDocument
+from telegram.error import RetryAfter, NetworkError, BadRequest, Forbidden, TimedOut
 from telegram.ext import (
     Application, CommandHandler, MessageHandler, CallbackQueryHandler,
-    ConversationHandler, ContextTypes, filters
+    ConversationHandler, ContextTypes, BaseUpdateProcessor, filters
 )
 
 # Load token
@@ -41,28 +50,181 @@ logger = logging.getLogger(__name__)
 # Bot version
 BOT_VERSION = "1.8"
 
+# ==================== METRICS ====================
+# Latency buckets in seconds, from a cache hit to a Telegram flood wait
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+MATCH_BUCKETS = (0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+def _label_text(labels: Tuple) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+class Metric:
+    """One named series family; values are keyed by their sorted label pairs"""
+    
+    kind = 'untyped'
+    
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help = help_text
+        self.lock = threading.Lock()
+        self.values: Dict[Tuple, float] = {}
+    
+    def samples(self) -> List[str]:
+        with self.lock:
+            return [f"{self.name}{_label_text(labels)} {value}" for labels, value in self.values.items()]
+
+class Counter(Metric):
+    kind = 'counter'
+    
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+    
+    def set(self, value: float, **labels):
+        """Mirror a running total that another component already keeps"""
+        with self.lock:
+            self.values[tuple(sorted(labels.items()))] = value
+
+class Gauge(Metric):
+    kind = 'gauge'
+    
+    def set(self, value: float, **labels):
+        with self.lock:
+            self.values[tuple(sorted(labels.items()))] = value
+
+class Histogram(Metric):
+    """Cumulative buckets plus _sum and _count, as Prometheus expects"""
+    
+    kind = 'histogram'
+    
+    def __init__(self, name: str, help_text: str, buckets: Tuple = LATENCY_BUCKETS):
+        super().__init__(name, help_text)
+        self.buckets = tuple(sorted(buckets))
+    
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.values.get(key)
+            if series is None:
+                series = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+    
+    def samples(self) -> List[str]:
+        lines = []
+        with self.lock:
+            for labels, (counts, total, count) in self.values.items():
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    lines.append(f"{self.name}_bucket{_label_text(labels + (('le', bound),))} {cumulative}")
+                lines.append(f"{self.name}_bucket{_label_text(labels + (('le', '+Inf'),))} {count}")
+                lines.append(f"{self.name}_sum{_label_text(labels)} {total}")
+                lines.append(f"{self.name}_count{_label_text(labels)} {count}")
+        return lines
+
+class MetricsRegistry:
+    """In-process metrics rendered in the Prometheus text format.
+    
+    Hot paths update counters and histograms directly. State other
+    components already track (queue sizes, pool and outbox counters) is read
+    by collectors when ``/metrics`` is scraped, so it costs nothing between
+    scrapes.
+    """
+    
+    def __init__(self, prefix: str = 'bondly_'):
+        self.prefix = prefix
+        self.metrics: Dict[str, Metric] = {}
+        self.collectors = []
+    
+    def _register(self, metric: Metric) -> Metric:
+        return self.metrics.setdefault(metric.name, metric)
+    
+    def counter(self, name: str, help_text: str) -> Counter:
+        return self._register(Counter(self.prefix + name, help_text))
+    
+    def gauge(self, name: str, help_text: str) -> Gauge:
+        return self._register(Gauge(self.prefix + name, help_text))
+    
+    def histogram(self, name: str, help_text: str, buckets: Tuple = LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram(self.prefix + name, help_text, buckets))
+    
+    def collector(self, func):
+        """Register ``func()``, run before every render to refresh gauges"""
+        self.collectors.append(func)
+        return func
+    
+    def render(self) -> str:
+        for collect in self.collectors:
+            try:
+                collect()
+            except Exception as e:
+                logger.error(f"Metrics collector {collect.__name__} failed: {e}")
+        
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+metrics = MetricsRegistry()
+
+match_wait_seconds = metrics.histogram('match_wait_seconds', 'Time from joining the queue to being matched', MATCH_BUCKETS)
+relay_seconds = metrics.histogram('relay_seconds', 'Relay latency by stage: db (profile lookup), telegram (send) and total')
+event_loop_lag_seconds = metrics.histogram('event_loop_lag_seconds', 'How late the event loop woke a sleeping task')
+match_round_seconds = metrics.histogram('match_round_seconds', 'Matchmaker round duration (the event loop is blocked meanwhile)')
+
 # ==================== PROFESSIONAL DATABASE (با Supabase) ====================
 import os
 import psycopg2
 from psycopg2 import pool
+from psycopg2.extras import Json, execute_values
 import threading
 
+# One worker thread per pooled connection
+DB_MAX_CONCURRENCY = int(os.getenv('DB_MAX_CONCURRENCY', '5'))
+
+STAT_COLUMNS = (
+    'messages_sent', 'messages_received', 'media_sent', 'chats_started',
+    'chats_today', 'total_chat_duration', 'ratings_positive', 'ratings_negative'
+)
+
 class ProfessionalDB:
-    def __init__(self):
-        self.db_pool = None
-        self._init_db()
+    """PostgreSQL storage. Every public method is a single statement/round trip.
+    
+    Pass ``db_pool`` (anything with ``getconn``/``putconn``) to run against a
+    local Postgres or a stand-in instead of DATABASE_URL.
+    
+    Failed statements are logged and return their default; ``errors`` counts
+    them so the failure still shows up in AsyncDB.metrics() and /metrics.
+    """
+    
+    def __init__(self, dsn: Optional[str] = None, db_pool=None):
+        self.db_pool = db_pool
+        self.errors = 0
+        self.errors_lock = threading.Lock()
+        if self.db_pool is None:
+            self._init_db(dsn)
         self._ensure_tables()
     
-    def _init_db(self):
+    def _init_db(self, dsn: Optional[str] = None):
         """اتصال به پایگاه داده Supabase"""
         try:
-            DATABASE_URL = os.getenv('DATABASE_URL')
+            DATABASE_URL = dsn or os.getenv('DATABASE_URL')
             if not DATABASE_URL:
                 print("⚠️ DATABASE_URL not found in environment variables!")
                 print("⚠️ Add DATABASE_URL to your Render Environment Variables")
                 return
             
-            self.db_pool = psycopg2.pool.SimpleConnectionPool(1, 5, DATABASE_URL)
+            self.db_pool = psycopg2.pool.ThreadedConnectionPool(1, DB_MAX_CONCURRENCY, DATABASE_URL)
             print("✅ Connected to Supabase database successfully!")
         except Exception as e:
             print(f"❌ Database connection failed: {e}")
@@ -120,6 +282,12 @@ class ProfessionalDB:
                     )
                 """)
                 
+                # Reverse lookups for ON DELETE CASCADE on blocked_id
+                cur.execute("""
+                    CREATE INDEX IF NOT EXISTS blocked_users_blocked_id_idx
+                    ON blocked_users (blocked_id)
+                """)
+                
                 # جدول تاریخچه چت
                 cur.execute("""
                     CREATE TABLE IF NOT EXISTS chat_history (
@@ -139,6 +307,13 @@ class ProfessionalDB:
                     )
                 """)
                 
+                # Users created before stats rows were upserted with them
+                cur.execute("""
+                    INSERT INTO user_stats (user_id)
+                    SELECT user_id FROM users
+                    ON CONFLICT (user_id) DO NOTHING
+                """)
+                
                 conn.commit()
                 print("✅ Database tables created/verified")
         except Exception as e:
@@ -147,321 +322,1983 @@ class ProfessionalDB:
         finally:
             self.db_pool.putconn(conn)
     
-    # User management methods
-    def get_user(self, user_id: int) -> Optional[Dict]:
+    # Query helper
+    def _execute(self, sql: str, params: tuple = (), fetch: Optional[str] = None, default=None,
+                 batch: Optional[List[tuple]] = None, raise_errors: bool = False):
+        """Run one statement in its own transaction (a single round trip).
+        
+        fetch: None -> rowcount, 'one' -> dict or None, 'all' -> list of dicts
+        batch: rows expanded into the statement's ``VALUES %s`` with execute_values
+        raise_errors: re-raise a failure instead of returning ``default``, for
+        callers that must tell "not found" from "could not look"
+        """
         if not self.db_pool:
-            return None
+            return default
         
         conn = self.db_pool.getconn()
         try:
             with conn.cursor() as cur:
-                cur.execute("SELECT * FROM users WHERE user_id = %s", (user_id,))
-                row = cur.fetchone()
-                if row:
+                if batch is not None:
+                    execute_values(cur, sql, batch, page_size=len(batch))
+                else:
+                    cur.execute(sql, params)
+                
+                if fetch == 'one':
+                    row = cur.fetchone()
+                    result = dict(zip([desc[0] for desc in cur.description], row)) if row else None
+                elif fetch == 'all':
                     columns = [desc[0] for desc in cur.description]
-                    return dict(zip(columns, row))
-                return None
+                    result = [dict(zip(columns, row)) for row in cur.fetchall()]
+                else:
+                    result = cur.rowcount
+            
+            conn.commit()
+            return result
         except Exception as e:
-            print(f"Error getting user {user_id}: {e}")
-            return None
+            with self.errors_lock:
+                self.errors += 1
+            logger.error(f"Database error: {e}")
+            try:
+                conn.rollback()
+            except Exception:
+                pass
+            if raise_errors:
+                raise
+            return default
         finally:
             self.db_pool.putconn(conn)
     
+    @staticmethod
+    def _dumps(obj) -> str:
+        return json.dumps(obj, default=str)
+    
+    @staticmethod
+    def _isoformat(row: Dict, *keys: str) -> Dict:
+        """Render timestamp columns the way the JSON storage stored them."""
+        for key in keys:
+            if hasattr(row.get(key), 'isoformat'):
+                row[key] = row[key].isoformat()
+        return row
+    
+    # User management methods
+    def get_user(self, user_id: int) -> Optional[Dict]:
+        """The profile, or None if the user is not registered; raises if the lookup fails"""
+        row = self._execute("SELECT * FROM users WHERE user_id = %s", (user_id,), fetch='one',
+                            raise_errors=True)
+        return self._isoformat(row, 'registered') if row else None
+    
     def save_user(self, user_id: int, user_data: Dict):
-        if not self.db_pool:
-            print("❌ No database connection!")
+        # Upsert the profile and make sure its stats row exists in one statement
+        self._execute("""
+            WITH saved AS (
+                INSERT INTO users
+                (user_id, nickname, gender, gender_display, search_filter,
+                 search_filter_display, telegram_name, username, auto_registered)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+                ON CONFLICT (user_id) DO UPDATE SET
+                    nickname = EXCLUDED.nickname,
+                    gender = EXCLUDED.gender,
+                    gender_display = EXCLUDED.gender_display,
+                    search_filter = EXCLUDED.search_filter,
+                    search_filter_display = EXCLUDED.search_filter_display,
+                    telegram_name = EXCLUDED.telegram_name,
+                    username = EXCLUDED.username,
+                    auto_registered = EXCLUDED.auto_registered
+                RETURNING user_id
+            )
+            INSERT INTO user_stats (user_id)
+            SELECT user_id FROM saved
+            ON CONFLICT (user_id) DO NOTHING
+        """, (
+            user_id,
+            user_data.get('nickname'),
+            user_data.get('gender', 'not_specified'),
+            user_data.get('gender_display', 'Not specified'),
+            user_data.get('search_filter', 'random'),
+            user_data.get('search_filter_display', 'Random'),
+            user_data.get('telegram_name', ''),
+            user_data.get('username', ''),
+            user_data.get('auto_registered', False)
+        ))
+    
+    def delete_user(self, user_id: int):
+        # Stats and blocks go with it through ON DELETE CASCADE
+        self._execute("DELETE FROM users WHERE user_id = %s", (user_id,))
+    
+    # Statistics
+    def get_stats(self, user_id: int) -> Dict:
+        stats = {column: 0 for column in STAT_COLUMNS}
+        stats['last_active'] = datetime.now().isoformat()
+        stats['last_reset'] = datetime.now().date().isoformat()
+        
+        row = self._execute("""
+            SELECT messages_sent, messages_received, media_sent, chats_started,
+                   CASE WHEN last_reset = CURRENT_DATE THEN chats_today ELSE 0 END AS chats_today,
+                   total_chat_duration, ratings_positive, ratings_negative,
+                   last_active, last_reset
+            FROM user_stats WHERE user_id = %s
+        """, (user_id,), fetch='one')
+        
+        if row:
+            stats.update(self._isoformat(row, 'last_active', 'last_reset'))
+        return stats
+    
+    def update_stats(self, user_id: int, stat_type: str, value: int = 1):
+        if stat_type == 'last_active':
+            self._execute(
+                "UPDATE user_stats SET last_active = CURRENT_TIMESTAMP WHERE user_id = %s",
+                (user_id,)
+            )
             return
         
-        conn = self.db_pool.getconn()
+        if stat_type not in STAT_COLUMNS or not value:
+            return
+        
+        # chats_today is reset lazily the first time it is touched on a new day
+        if stat_type == 'chats_today':
+            sql = """
+                UPDATE user_stats SET
+                    chats_today = CASE WHEN last_reset = CURRENT_DATE THEN chats_today ELSE 0 END + %s,
+                    last_reset = CURRENT_DATE
+                WHERE user_id = %s
+            """
+        else:
+            sql = f"""
+                UPDATE user_stats SET
+                    {stat_type} = {stat_type} + %s,
+                    chats_today = CASE WHEN last_reset = CURRENT_DATE THEN chats_today ELSE 0 END,
+                    last_reset = CURRENT_DATE
+                WHERE user_id = %s
+            """
+        
+        self._execute(sql, (value, user_id))
+    
+    def apply_stats_batch(self, rows: List[tuple]) -> bool:
+        """Apply many users' counter deltas in one statement.
+        
+        Each row is ``(user_id, <one delta per STAT_COLUMNS entry>, touch_last_active)``.
+        Rows for users without a stats row are skipped.
+        """
+        if not rows or not self.db_pool:
+            return True
+        
+        assignments = ", ".join(
+            f"{column} = s.{column} + v.{column}"
+            for column in STAT_COLUMNS if column != 'chats_today'
+        )
+        
+        updated = self._execute(f"""
+            UPDATE user_stats AS s SET
+                {assignments},
+                chats_today = CASE WHEN s.last_reset = CURRENT_DATE THEN s.chats_today ELSE 0 END + v.chats_today,
+                last_reset = CURRENT_DATE,
+                last_active = CASE WHEN v.touched THEN CURRENT_TIMESTAMP ELSE s.last_active END
+            FROM (VALUES %s) AS v(user_id, {', '.join(STAT_COLUMNS)}, touched)
+            WHERE s.user_id = v.user_id
+        """, batch=rows)
+        return updated is not None
+    
+    def get_global_stats(self) -> Dict:
+        row = self._execute("""
+            SELECT (SELECT COUNT(*) FROM users) AS total_users,
+                   COALESCE(SUM(messages_sent + messages_received), 0) AS total_messages,
+                   COALESCE(SUM(chats_started), 0) AS total_chats,
+                   COALESCE(SUM(ratings_positive), 0) AS total_positive_ratings,
+                   COALESCE(SUM(ratings_negative), 0) AS total_negative_ratings
+            FROM user_stats
+        """, fetch='one')
+        
+        if not row:
+            return {
+                'total_users': 0,
+                'total_messages': 0,
+                'total_chats': 0,
+                'total_positive_ratings': 0,
+                'total_negative_ratings': 0
+            }
+        return {key: int(value) for key, value in row.items()}
+    
+    # Blocked users
+    def get_blocked_users(self, user_id: int) -> Dict:
+        rows = self._execute(
+            "SELECT blocked_id, nickname, blocked_at FROM blocked_users WHERE blocker_id = %s ORDER BY blocked_at",
+            (user_id,), fetch='all', default=[]
+        )
+        return {
+            str(row['blocked_id']): {
+                'nickname': row['nickname'],
+                'blocked_at': self._isoformat(row, 'blocked_at')['blocked_at']
+            }
+            for row in rows
+        }
+    
+    def get_all_blocks(self) -> List[Dict]:
+        rows = self._execute(
+            "SELECT blocker_id, blocked_id, nickname, blocked_at FROM blocked_users",
+            fetch='all', default=[]
+        )
+        return [self._isoformat(row, 'blocked_at') for row in rows]
+    
+    def block_user(self, blocker_id: int, blocked_id: int, blocked_nick: str):
+        self._execute("""
+            INSERT INTO blocked_users (blocker_id, blocked_id, nickname)
+            VALUES (%s, %s, %s)
+            ON CONFLICT (blocker_id, blocked_id) DO UPDATE SET
+                nickname = EXCLUDED.nickname,
+                blocked_at = CURRENT_TIMESTAMP
+        """, (blocker_id, blocked_id, blocked_nick))
+    
+    def unblock_user(self, blocker_id: int, blocked_id: int) -> bool:
+        deleted = self._execute(
+            "DELETE FROM blocked_users WHERE blocker_id = %s AND blocked_id = %s",
+            (blocker_id, blocked_id), default=0
+        )
+        return deleted > 0
+    
+    def is_blocked(self, blocker_id: int, blocked_id: int) -> bool:
+        row = self._execute(
+            "SELECT 1 AS blocked FROM blocked_users WHERE blocker_id = %s AND blocked_id = %s",
+            (blocker_id, blocked_id), fetch='one'
+        )
+        return row is not None
+    
+    # Chat history
+    def save_chat(self, chat_data: Dict):
+        user1 = chat_data['user1']
+        user2 = chat_data['user2']
+        
+        self._execute("""
+            INSERT INTO chat_history
+            (user1_id, user2_id, user1_data, user2_data, messages_sent_user1,
+             messages_sent_user2, media_sent, active, created, ended, reason, duration)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+        """, (
+            user1['id'],
+            user2['id'],
+            Json(user1.get('data', {}), dumps=self._dumps),
+            Json(user2.get('data', {}), dumps=self._dumps),
+            chat_data.get('messages_sent_user1', 0),
+            chat_data.get('messages_sent_user2', 0),
+            chat_data.get('media_sent', 0),
+            chat_data.get('active', False),
+            chat_data.get('created'),
+            chat_data.get('ended'),
+            chat_data.get('reason'),
+            int(chat_data.get('duration', 0))
+        ))
+
+db = ProfessionalDB()
+
+# ==================== ASYNC DATA ACCESS ====================
+class AsyncDB:
+    """Runs blocking ProfessionalDB calls on a bounded thread pool.
+    
+    ``await user_cache.get(uid)`` runs ``db.get_user(uid)`` on one of
+    DB_MAX_CONCURRENCY worker threads, so a slow query never stalls the event
+    loop and at most that many queries hit the database at once. Extra calls
+    wait in the executor queue; ``metrics()`` reports both.
+    """
+    
+    def __init__(self, database: ProfessionalDB, max_workers: Optional[int] = None):
+        if max_workers is None:
+            max_workers = DB_MAX_CONCURRENCY
+        
+        self.db = database
+        self.max_workers = max_workers
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="db")
+        self.lock = threading.Lock()
+        
+        self.submitted = 0
+        self.running = 0
+        self.completed = 0
+        self.errors = 0
+    
+    def _run(self, func, args, kwargs):
+        with self.lock:
+            self.running += 1
         try:
-            with conn.cursor() as cur:
-                # Check if user exists
-                cur.execute("SELECT user_id FROM users WHERE user_id = %s", (user_id,))
-                exists = cur.fetchone()
+            return func(*args, **kwargs)
+        except Exception:
+            with self.lock:
+                self.errors += 1
+            raise
+        finally:
+            with self.lock:
+                self.running -= 1
+                self.completed += 1
+    
+    async def call(self, func, *args, **kwargs):
+        """Await any blocking callable on the database pool."""
+        with self.lock:
+            self.submitted += 1
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self._run, func, args, kwargs)
+    
+    def submit(self, func, *args, **kwargs):
+        """Fire-and-forget variant, safe to use from synchronous code."""
+        with self.lock:
+            self.submitted += 1
+        future = self.executor.submit(self._run, func, args, kwargs)
+        future.add_done_callback(self._log_failure)
+        return future
+    
+    @staticmethod
+    def _log_failure(future):
+        if future.exception():
+            logger.error(f"Background DB task failed: {future.exception()}")
+    
+    def __getattr__(self, name: str):
+        method = getattr(self.db, name)
+        
+        async def proxy(*args, **kwargs):
+            return await self.call(method, *args, **kwargs)
+        
+        return proxy
+    
+    def metrics(self) -> Dict:
+        with self.lock:
+            in_flight = self.submitted - self.completed
+            return {
+                'max_concurrency': self.max_workers,
+                'running': self.running,
+                'queued': max(0, in_flight - self.running),
+                'completed': self.completed,
+                'errors': self.errors + self.db.errors,
+            }
+    
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+adb = AsyncDB(db)
+
+# ==================== STATS AGGREGATOR ====================
+# Per-user stat column -> global total it feeds
+GLOBAL_TOTALS = {
+    'messages_sent': 'total_messages',
+    'messages_received': 'total_messages',
+    'chats_started': 'total_chats',
+    'ratings_positive': 'total_positive_ratings',
+    'ratings_negative': 'total_negative_ratings',
+}
+
+# Users whose stats version is tracked before the table starts over
+STATS_VERSION_LIMIT = int(os.getenv('STATS_VERSION_LIMIT', '100000'))
+
+class StatsAggregator:
+    """Collects per-user counter deltas in memory and writes them in batches.
+    
+    The relay path only bumps a dict entry; a background task flushes every
+    pending user in one statement every ``flush_interval`` seconds, or as
+    soon as ``flush_threshold`` deltas have piled up. ``stop`` does a final
+    flush on shutdown.
+    
+    The global totals shown by /stats are running counters bumped by the
+    same ``add`` calls. They are read from the database once by
+    ``load_totals`` at startup, so ``global_stats`` never queries storage.
+    
+    Every change also gives the user a new ``stats_version``, which lets
+    rendered profiles be reused until their numbers actually move. Deltas
+    being written stay visible to ``get_stats`` until the batch commits, and
+    the users in it get a new version once it has, so nothing rendered from
+    a read that raced the write is reused.
+    """
+    
+    def __init__(self, database: AsyncDB, flush_interval: Optional[float] = None,
+                 flush_threshold: Optional[int] = None):
+        if flush_interval is None:
+            flush_interval = float(os.getenv('STATS_FLUSH_INTERVAL', '5'))
+        if flush_threshold is None:
+            flush_threshold = int(os.getenv('STATS_FLUSH_THRESHOLD', '500'))
+        
+        self.db = database
+        self.flush_interval = flush_interval
+        self.flush_threshold = flush_threshold
+        self.lock = threading.Lock()
+        
+        self.pending: Dict[int, Dict[str, int]] = {}
+        self.inflight: List[Dict[int, Dict[str, int]]] = []
+        self.touched: set = set()
+        self.pending_count = 0
+        
+        self.totals: Dict[str, int] = {'total_users': 0}
+        self.totals.update((total, 0) for total in GLOBAL_TOTALS.values())
+        
+        self.versions: Dict[int, int] = {}
+        self.version_limit = STATS_VERSION_LIMIT
+        self.epoch = 0
+        self._version_seq = itertools.count(1)
+        
+        self.flushes = 0
+        self.deltas_written = 0
+        
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+    
+    def add(self, user_id: int, stat_type: str, value: int = 1):
+        """Queue a stats update; same arguments as ``ProfessionalDB.update_stats``."""
+        with self.lock:
+            if stat_type == 'last_active':
+                self.touched.add(user_id)
+            elif stat_type in STAT_COLUMNS and value:
+                deltas = self.pending.setdefault(user_id, {})
+                deltas[stat_type] = deltas.get(stat_type, 0) + value
                 
-                if exists:
-                    # Update existing user
-                    cur.execute("""
-                        UPDATE users SET
-                            nickname = %s,
-                            gender = %s,
-                            gender_display = %s,
-                            search_filter = %s,
-                            search_filter_display = %s,
-                            telegram_name = %s,
-                            username = %s,
-                            auto_registered = %s
-                        WHERE user_id = %s
-                    """, (
-                        user_data.get('nickname'),
-                        user_data.get('gender', 'not_specified'),
-                        user_data.get('gender_display', 'Not specified'),
-                        user_data.get('search_filter', 'random'),
-                        user_data.get('search_filter_display', 'Random'),
-                        user_data.get('telegram_name', ''),
-                        user_data.get('username', ''),
-                        user_data.get('auto_registered', False),
-                        user_id
-                    ))
-                else:
-                    # Insert new user
-                    cur.execute("""
-                        INSERT INTO users 
-                        (user_id, nickname, gender, gender_display, search_filter, 
-                         search_filter_display, telegram_name, username, auto_registered)
-                        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-                    """, (
-                        user_id,
-                        user_data.get('nickname'),
-                        user_data.get('gender', 'not_specified'),
-                        user_data.get('gender_display', 'Not specified'),
-                        user_data.get('search_filter', 'random'),
-                        user_data.get('search_filter_display', 'Random'),
-                        user_data.get('telegram_name', ''),
-                        user_data.get('username', ''),
-                        user_data.get('auto_registered', False)
-                    ))
+                total = GLOBAL_TOTALS.get(stat_type)
+                if total:
+                    self.totals[total] += value
                 
-                conn.commit()
-        except Exception as e:
-            print(f"Error saving user {user_id}: {e}")
-            conn.rollback()
+                self._bump(user_id)
+            else:
+                return
+            
+            self.pending_count += 1
+            full = self.pending_count >= self.flush_threshold
+        
+        if full and self._wakeup:
+            self._wakeup.set()
+    
+    def _bump(self, user_id: int):
+        """Give the user a new stats version. Caller holds ``self.lock``."""
+        if len(self.versions) >= self.version_limit:
+            # Forgetting versions must not revive stale renders, so start a new epoch
+            self.versions.clear()
+            self.epoch += 1
+        self.versions[user_id] = next(self._version_seq)
+    
+    async def get_stats(self, user_id: int) -> Dict:
+        """Stored stats with this user's unflushed and uncommitted deltas applied."""
+        stats = await self.db.get_stats(user_id)
+        
+        with self.lock:
+            batches = [batch[user_id] for batch in self.inflight if user_id in batch]
+            batches.append(self.pending.get(user_id, {}))
+            deltas = [item for batch in batches for item in batch.items()]
+        
+        for stat_type, value in deltas:
+            stats[stat_type] = int(stats.get(stat_type, 0)) + value
+        return stats
+    
+    async def load_totals(self):
+        """Seed the global counters from storage plus anything not yet flushed"""
+        totals = await self.db.get_global_stats()
+        
+        with self.lock:
+            for deltas in self.pending.values():
+                for stat_type, value in deltas.items():
+                    total = GLOBAL_TOTALS.get(stat_type)
+                    if total:
+                        totals[total] = totals.get(total, 0) + value
+            self.totals = totals
+    
+    def stats_version(self, user_id: int) -> Tuple[int, int]:
+        """Changes whenever one of the user's counters changes"""
+        with self.lock:
+            return self.epoch, self.versions.get(user_id, 0)
+    
+    def global_stats(self) -> Dict[str, int]:
+        with self.lock:
+            return dict(self.totals)
+    
+    def user_added(self):
+        with self.lock:
+            self.totals['total_users'] += 1
+    
+    def user_removed(self, user_id: int, stats: Dict):
+        """Take a deleted user's stats (as returned by ``get_stats``) out of the totals"""
+        with self.lock:
+            self.pending.pop(user_id, None)
+            self.touched.discard(user_id)
+            self.versions[user_id] = next(self._version_seq)
+            
+            self.totals['total_users'] -= 1
+            for stat_type, total in GLOBAL_TOTALS.items():
+                self.totals[total] -= int(stats.get(stat_type, 0))
+    
+    async def flush(self) -> int:
+        """Write all pending deltas; returns the number of users written."""
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            touched, self.touched = self.touched, set()
+            count, self.pending_count = self.pending_count, 0
+            if not pending and not touched:
+                return 0
+            self.inflight.append(pending)
+        
+        rows = []
+        for user_id in set(pending) | touched:
+            deltas = pending.get(user_id, {})
+            rows.append((user_id, *[deltas.get(column, 0) for column in STAT_COLUMNS], user_id in touched))
+        
+        try:
+            written = await self.db.apply_stats_batch(rows)
         finally:
-            self.db_pool.putconn(conn)
+            with self.lock:
+                self.inflight = [batch for batch in self.inflight if batch is not pending]
+        
+        with self.lock:
+            if not written:
+                # Keep the deltas for the next round instead of dropping them
+                for user_id, deltas in pending.items():
+                    merged = self.pending.setdefault(user_id, {})
+                    for stat_type, value in deltas.items():
+                        merged[stat_type] = merged.get(stat_type, 0) + value
+                self.touched |= touched
+                self.pending_count += count
+                return 0
+            
+            # A render that read the row before the commit must not be reused
+            for user_id in pending:
+                self._bump(user_id)
+        
+        self.flushes += 1
+        self.deltas_written += count
+        return len(rows)
+    
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Stats flush failed: {e}")
     
-    # ادامه متدهای دیگر (get_stats, update_stats, get_blocked_users, block_user, unblock_user, is_blocked, save_chat)
-    # باید همه را به همین شکل به پایگاه داده وصل کنی...
+    async def start(self):
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self.run())
+    
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
 
-db = ProfessionalDB()
-# ==================== PROFESSIONAL CHAT MANAGER ====================
-class ProfessionalChatManager:
+stats_buffer = StatsAggregator(adb)
+
+# ==================== USER PROFILE CACHE ====================
+class UserCache:
+    """LRU cache of user profiles with a TTL, in front of the database.
+    
+    Profile writes go through ``save``/``delete`` which update the cache as
+    well as the database, so a cache hit is never stale for this process.
+    Unregistered users are cached as None too, but only when the database
+    said so: a failed lookup raises and caches nothing, so callers never
+    mistake it for a missing profile and register the user again. A miss
+    that was overtaken by a write while it waited on the database is not
+    cached, so an older row never replaces a newer one.
+    """
+    
+    def __init__(self, database: AsyncDB, max_size: Optional[int] = None, ttl: Optional[float] = None):
+        if max_size is None:
+            max_size = int(os.getenv('USER_CACHE_SIZE', '10000'))
+        if ttl is None:
+            ttl = float(os.getenv('USER_CACHE_TTL', '300'))
+        
+        self.db = database
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries: OrderedDict = OrderedDict()
+        # user_id -> (fetches in flight, write version); only while a fetch runs
+        self.fetches: Dict[int, Tuple[int, int]] = {}
+        
+        self.hits = 0
+        self.misses = 0
+    
+    def _store(self, user_id: int, user_data: Optional[Dict]):
+        self.entries[user_id] = (time.monotonic() + self.ttl, user_data)
+        self.entries.move_to_end(user_id)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+    
+    async def get(self, user_id: int) -> Optional[Dict]:
+        entry = self.entries.get(user_id)
+        if entry and entry[0] > time.monotonic():
+            self.hits += 1
+            self.entries.move_to_end(user_id)
+            user_data = entry[1]
+        else:
+            self.misses += 1
+            count, version = self.fetches.get(user_id, (0, 0))
+            self.fetches[user_id] = (count + 1, version)
+            try:
+                user_data = await self.db.get_user(user_id)
+            finally:
+                count, current = self.fetches.pop(user_id)
+                if count > 1:
+                    self.fetches[user_id] = (count - 1, current)
+            
+            if current == version:
+                self._store(user_id, user_data)
+            elif user_id in self.entries:
+                # A save or delete landed during the fetch; it holds the newer row
+                user_data = self.entries[user_id][1]
+        
+        # Callers edit the dict before saving it; keep the cached copy clean
+        return dict(user_data) if user_data else None
+    
+    async def save(self, user_id: int, user_data: Dict):
+        self.invalidate(user_id)
+        await self.db.save_user(user_id, user_data)
+        self._store(user_id, dict(user_data))
+    
+    async def delete(self, user_id: int):
+        self.invalidate(user_id)
+        await self.db.delete_user(user_id)
+        self._store(user_id, None)
+    
+    def invalidate(self, user_id: int):
+        self.entries.pop(user_id, None)
+        if user_id in self.fetches:
+            count, version = self.fetches[user_id]
+            self.fetches[user_id] = (count, version + 1)
+
+user_cache = UserCache(adb)
+
+# ==================== BLOCK INDEX ====================
+class BlockIndex:
+    """In-memory copy of ``blocked_users`` with a reverse index.
+    
+    Loaded once at startup; block/unblock update it incrementally and write
+    through to the database, so block checks while matching are plain set
+    lookups. Only touched from the event loop thread.
+    """
+    
+    def __init__(self, database: AsyncDB):
+        self.db = database
+        self.blocked: Dict[int, Dict[int, Dict]] = {}
+        self.blocked_by: Dict[int, set] = {}
+    
+    async def load(self):
+        rows = await self.db.get_all_blocks()
+        self.blocked.clear()
+        self.blocked_by.clear()
+        for row in rows:
+            self._add(row['blocker_id'], row['blocked_id'], {
+                'nickname': row['nickname'],
+                'blocked_at': row['blocked_at']
+            })
+        logger.info(f"Loaded {len(rows)} blocks")
+    
+    def _add(self, blocker_id: int, blocked_id: int, info: Dict):
+        self.blocked.setdefault(blocker_id, {})[blocked_id] = info
+        self.blocked_by.setdefault(blocked_id, set()).add(blocker_id)
+    
+    def _remove(self, blocker_id: int, blocked_id: int) -> bool:
+        entries = self.blocked.get(blocker_id)
+        if not entries or blocked_id not in entries:
+            return False
+        
+        del entries[blocked_id]
+        if not entries:
+            del self.blocked[blocker_id]
+        
+        blockers = self.blocked_by.get(blocked_id)
+        if blockers:
+            blockers.discard(blocker_id)
+            if not blockers:
+                del self.blocked_by[blocked_id]
+        return True
+    
+    def is_blocked(self, blocker_id: int, blocked_id: int) -> bool:
+        return blocked_id in self.blocked.get(blocker_id, ())
+    
+    def either(self, user1: int, user2: int) -> bool:
+        """True if either user blocked the other."""
+        return user2 in self.blocked.get(user1, ()) or user1 in self.blocked.get(user2, ())
+    
+    def get_blocked_users(self, user_id: int) -> Dict:
+        return {str(blocked_id): dict(info) for blocked_id, info in self.blocked.get(user_id, {}).items()}
+    
+    async def block_user(self, blocker_id: int, blocked_id: int, blocked_nick: str):
+        self._add(blocker_id, blocked_id, {'nickname': blocked_nick, 'blocked_at': datetime.now().isoformat()})
+        await self.db.block_user(blocker_id, blocked_id, blocked_nick)
+    
+    async def unblock_user(self, blocker_id: int, blocked_id: int) -> bool:
+        if not self._remove(blocker_id, blocked_id):
+            return False
+        await self.db.unblock_user(blocker_id, blocked_id)
+        return True
+    
+    def forget_user(self, user_id: int):
+        """Drop every block involving a deleted user (the DB cascades the same way)."""
+        for blocked_id in list(self.blocked.get(user_id, {})):
+            self._remove(user_id, blocked_id)
+        for blocker_id in list(self.blocked_by.get(user_id, ())):
+            self._remove(blocker_id, user_id)
+
+block_index = BlockIndex(adb)
+
+# ==================== CHAT RECORDS ====================
+class WaitingEntry:
+    """A user in the waiting pool, with everything matching needs"""
+    
+    __slots__ = ('data', 'gender', 'filter', 'chats_started', 'joined')
+    
+    def __init__(self, data: Dict, chats_started: int = 0, joined: Optional[float] = None):
+        self.data = data
+        self.gender = data.get('gender', 'not_specified')
+        self.filter = data.get('search_filter', 'random')
+        self.chats_started = int(chats_started)
+        self.joined = time.monotonic() if joined is None else joined
+
+class Participant:
+    """One side of a chat. ``data`` is the user's profile dict, shared, not copied"""
+    
+    __slots__ = ('id', 'data', 'messages_sent', 'last_active')
+    
+    def __init__(self, user_id: int, data: Dict, now: float):
+        self.id = user_id
+        self.data = data
+        self.messages_sent = 0
+        self.last_active = now
+
+class ChatSession:
+    """An active chat between two users.
+    
+    ``created``, ``last_message`` and ``ended`` are time.monotonic() values;
+    they are only turned into wall clock ISO strings by ``to_dict`` when the
+    chat is persisted.
+    """
+    
+    __slots__ = ('chat_id', 'user1', 'user2', 'active', 'created',
+                 'last_message', 'ended', 'reason', 'media_sent')
+    
+    def __init__(self, chat_id: str, user1: int, data1: Dict, user2: int, data2: Dict):
+        now = time.monotonic()
+        self.chat_id = chat_id
+        self.user1 = Participant(user1, data1, now)
+        self.user2 = Participant(user2, data2, now)
+        self.active = True
+        self.created = now
+        self.last_message = None
+        self.ended = None
+        self.reason = None
+        self.media_sent = 0
+    
+    def participant(self, user_id: int) -> Participant:
+        return self.user1 if self.user1.id == user_id else self.user2
+    
+    def partner(self, user_id: int) -> Participant:
+        return self.user2 if self.user1.id == user_id else self.user1
+    
+    def elapsed(self) -> float:
+        return (self.ended or time.monotonic()) - self.created
+    
+    @property
+    def duration(self) -> float:
+        return self.elapsed() if self.ended else 0.0
+    
+    @property
+    def messages_sent_user1(self) -> int:
+        return self.user1.messages_sent
+    
+    @property
+    def messages_sent_user2(self) -> int:
+        return self.user2.messages_sent
+    
+    @staticmethod
+    def _wall_clock(monotonic: float) -> str:
+        return datetime.fromtimestamp(time.time() - (time.monotonic() - monotonic)).isoformat()
+    
+    def to_dict(self) -> Dict:
+        """Row format expected by ProfessionalDB.save_chat"""
+        return {
+            'user1': {'id': self.user1.id, 'data': self.user1.data, 'messages_sent': self.user1.messages_sent},
+            'user2': {'id': self.user2.id, 'data': self.user2.data, 'messages_sent': self.user2.messages_sent},
+            'active': self.active,
+            'created': self._wall_clock(self.created),
+            'ended': self._wall_clock(self.ended) if self.ended else None,
+            'reason': self.reason,
+            'messages_sent_user1': self.user1.messages_sent,
+            'messages_sent_user2': self.user2.messages_sent,
+            'media_sent': self.media_sent,
+            'duration': self.duration,
+        }
+
+# ==================== MATCH QUEUE ====================
+MATCH_SCAN_LIMIT = int(os.getenv('MATCH_SCAN_LIMIT', '32'))
+
+class MatchQueue:
+    """Waiting users bucketed by (gender, search filter).
+    
+    A search only visits buckets whose gender/filter pair is compatible with
+    the searcher, and at most ``scan_limit`` of the longest-waiting users in
+    each, so finding a partner costs the same with 10 or 10,000 people
+    waiting. Entries carry everything scoring needs (gender, filter, chats
+    started) and blocks come from the in-memory BlockIndex, so no storage
+    is touched while matching.
+    """
+    
+    def __init__(self, blocks: BlockIndex, scan_limit: int = MATCH_SCAN_LIMIT):
+        self.blocks = blocks
+        self.scan_limit = scan_limit
+        self.buckets: Dict[Tuple[str, str], OrderedDict] = {}
+        self.entries: Dict[int, WaitingEntry] = {}
+    
+    @staticmethod
+    def accepts(search_filter: str, gender: str) -> bool:
+        return search_filter not in ('male', 'female') or gender == search_filter
+    
+    def add(self, user_id: int, entry: WaitingEntry):
+        self.remove(user_id)
+        key = (entry.gender, entry.filter)
+        self.buckets.setdefault(key, OrderedDict())[user_id] = entry
+        self.entries[user_id] = entry
+    
+    def remove(self, user_id: int) -> Optional[WaitingEntry]:
+        entry = self.entries.pop(user_id, None)
+        if entry:
+            key = (entry.gender, entry.filter)
+            bucket = self.buckets.get(key)
+            if bucket is not None:
+                bucket.pop(user_id, None)
+                if not bucket:
+                    del self.buckets[key]
+        return entry
+    
+    def pop(self, user_id: int, default=None) -> Optional[WaitingEntry]:
+        entry = self.remove(user_id)
+        return entry if entry is not None else default
+    
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self.entries
+    
+    def __len__(self) -> int:
+        return len(self.entries)
+    
+    def __getitem__(self, user_id: int) -> WaitingEntry:
+        return self.entries[user_id]
+    
+    def get(self, user_id: int, default=None):
+        return self.entries.get(user_id, default)
+    
+    def items(self) -> List[Tuple[int, WaitingEntry]]:
+        return list(self.entries.items())
+    
+    def counts_by_filter(self) -> Dict[str, int]:
+        counts: Dict[str, int] = {}
+        for (gender, search_filter), bucket in self.buckets.items():
+            counts[search_filter] = counts.get(search_filter, 0) + len(bucket)
+        return counts
+    
+    @staticmethod
+    def score(entry: WaitingEntry, partner: WaitingEntry) -> int:
+        compatibility = 50
+        
+        if entry.gender == partner.gender:
+            compatibility += 10
+        
+        if abs(entry.chats_started - partner.chats_started) < 10:
+            compatibility += 15
+        
+        compatibility += random.randint(-10, 10)
+        return max(30, min(95, compatibility))
+    
+    def candidates(self, user_id: int, limit: Optional[int] = None, exclude: Optional[set] = None):
+        """Yield ``(partner_id, partner_entry, compatibility)`` for compatible waiting users.
+        
+        At most ``limit`` (default ``scan_limit``) users are taken from each
+        bucket; users in ``exclude`` are passed over without counting.
+        """
+        entry = self.entries.get(user_id)
+        if not entry:
+            return
+        
+        limit = limit or self.scan_limit
+        
+        for (gender, search_filter), bucket in self.buckets.items():
+            if not self.accepts(entry.filter, gender) or not self.accepts(search_filter, entry.gender):
+                continue
+            
+            scanned = 0
+            for partner_id, partner in bucket.items():
+                if partner_id == user_id:
+                    continue
+                if exclude and partner_id in exclude:
+                    continue
+                if self.blocks.either(user_id, partner_id):
+                    continue
+                
+                yield partner_id, partner, self.score(entry, partner)
+                
+                scanned += 1
+                if scanned >= limit:
+                    break
+    
+    def best_partner(self, user_id: int, exclude: Optional[set] = None) -> Optional[Tuple[int, WaitingEntry, int]]:
+        """Return ``(partner_id, partner_entry, compatibility)`` or None."""
+        best = None
+        for candidate in self.candidates(user_id, exclude=exclude):
+            # Strictly greater keeps the longest-waiting user on ties
+            if best is None or candidate[2] > best[2]:
+                best = candidate
+        return best
+    
+    def plan_round(self, user_ids: Iterable[int], round_limit: int = 4) -> List[Tuple[int, int, int]]:
+        """Find partners for ``user_ids``, most compatible couples first.
+        
+        Candidate pairs (``round_limit`` per bucket and user) are taken in
+        order of compatibility; a second pass then gives every user still
+        alone their best remaining partner. Partners may be anyone waiting.
+        Returns ``(user_id, partner_id, compatibility)`` tuples.
+        
+        Only the given users' candidates are scanned and at most two users
+        per pair are skipped over, so the cost depends on ``len(user_ids)``,
+        not on the size of the pool.
+        """
+        users = [user_id for user_id in dict.fromkeys(user_ids) if user_id in self.entries]
+        
+        edges = []
+        for user_id in users:
+            for partner_id, _, compatibility in self.candidates(user_id, limit=round_limit):
+                edges.append((compatibility, user_id, partner_id))
+        
+        # sort() is stable, so longer-waiting users win ties
+        edges.sort(key=lambda edge: edge[0], reverse=True)
+        
+        paired = set()
+        pairs = []
+        for compatibility, user_id, partner_id in edges:
+            if user_id in paired or partner_id in paired:
+                continue
+            paired.add(user_id)
+            paired.add(partner_id)
+            pairs.append((user_id, partner_id, compatibility))
+        
+        for user_id in users:
+            if user_id in paired:
+                continue
+            
+            best = self.best_partner(user_id, exclude=paired)
+            if best:
+                partner_id, partner, compatibility = best
+                paired.add(user_id)
+                paired.add(partner_id)
+                pairs.append((user_id, partner_id, compatibility))
+        
+        return pairs
+
+# ==================== EXPIRY HEAP ====================
+class ExpiryHeap:
+    """Deadlines keyed by id, where only entries that are due get looked at.
+    
+    ``touch`` just moves the stored deadline, so refreshing it on every
+    message is O(1). A heap entry whose deadline moved is pushed back once
+    with the new deadline when it comes up. Deadlines are time.monotonic()
+    values, so wall clock changes can't expire anything early.
+    """
+    
     def __init__(self):
-        self.waiting: Dict[int, Dict] = {}
-        self.active_chats: Dict[str, Dict] = {}
-        self.user_chats: Dict[int, str] = {}
-        self.search_tasks: Dict[int, asyncio.Task] = {}
         self.lock = threading.Lock()
-        self.chat_counter = 0
+        self.heap: List[Tuple[float, object]] = []
+        self.deadlines: Dict[object, float] = {}
+    
+    def schedule(self, key, deadline: float):
+        with self.lock:
+            current = self.deadlines.get(key)
+            self.deadlines[key] = deadline
+            if current is None or deadline < current:
+                heapq.heappush(self.heap, (deadline, key))
+    
+    def touch(self, key, deadline: float):
+        """Move an existing deadline; unknown keys are ignored"""
+        with self.lock:
+            if key in self.deadlines:
+                self.deadlines[key] = deadline
+    
+    def cancel(self, key):
+        with self.lock:
+            self.deadlines.pop(key, None)
     
-    def add_to_waiting(self, user_id: int, user_data: Dict) -> Tuple[bool, str]:
+    def pop_due(self, now: Optional[float] = None) -> List:
+        if now is None:
+            now = time.monotonic()
+        
+        due = []
         with self.lock:
+            while self.heap and self.heap[0][0] <= now:
+                deadline, key = heapq.heappop(self.heap)
+                current = self.deadlines.get(key)
+                if current is None:
+                    continue
+                if current <= now:
+                    del self.deadlines[key]
+                    due.append(key)
+                elif current > deadline:
+                    heapq.heappush(self.heap, (current, key))
+        return due
+    
+    def __len__(self) -> int:
+        return len(self.deadlines)
+
+# ==================== PROFESSIONAL CHAT MANAGER ====================
+CHAT_SHARDS = int(os.getenv('CHAT_SHARDS', '16'))
+SEARCH_TIMEOUT = float(os.getenv('SEARCH_TIMEOUT', '300'))
+CHAT_IDLE_TIMEOUT = float(os.getenv('CHAT_IDLE_TIMEOUT', '1800'))
+# Ended chats remembered per user so "rate your last partner" still works
+RECENT_CHATS_SIZE = int(os.getenv('RECENT_CHATS_SIZE', '10000'))
+
+class ChatShard:
+    """One partition of the chat state, guarded by its own lock"""
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.chats: Dict[str, ChatSession] = {}
+        self.users: Dict[int, str] = {}
+
+class ProfessionalChatManager:
+    """Waiting pool and chats, partitioned so unrelated work never contends.
+    
+    Chats live in the shard picked by their chat id, user -> chat links in
+    the shard picked by the user id, and the waiting pool sits behind its
+    own ``match_lock``. Locks only ever guard in-memory updates: stats and
+    chat persistence are handed off after they are released.
+    
+    Only active chats are kept. An ended chat is handed to the database and
+    dropped; each user's last partner is remembered in ``recent_chats``, a
+    bounded LRU of RECENT_CHATS_SIZE users.
+    """
+    
+    def __init__(self, shards: int = CHAT_SHARDS, search_timeout: float = SEARCH_TIMEOUT,
+                 chat_idle_timeout: float = CHAT_IDLE_TIMEOUT, recent_size: int = RECENT_CHATS_SIZE):
+        self.waiting = MatchQueue(block_index)
+        self.match_lock = threading.Lock()
+        self.search_tasks: Dict[int, asyncio.Task] = {}
+        self.shards = [ChatShard() for _ in range(shards)]
+        self._chat_ids = itertools.count(1)
+        
+        self.search_timeout = search_timeout
+        self.chat_idle_timeout = chat_idle_timeout
+        self.search_expiry = ExpiryHeap()
+        self.chat_expiry = ExpiryHeap()
+        
+        self.recent_chats: OrderedDict = OrderedDict()
+        self.recent_lock = threading.Lock()
+        self.recent_size = recent_size
+    
+    def _user_shard(self, user_id: int) -> ChatShard:
+        return self.shards[user_id % len(self.shards)]
+    
+    def _chat_shard(self, chat_id: str) -> ChatShard:
+        return self.shards[int(chat_id.rsplit('_', 1)[1]) % len(self.shards)]
+    
+    def _lookup(self, user_id: int) -> Tuple[Optional[str], Optional[ChatSession]]:
+        shard = self._user_shard(user_id)
+        with shard.lock:
+            chat_id = shard.users.get(user_id)
+        if not chat_id:
+            return None, None
+        
+        shard = self._chat_shard(chat_id)
+        with shard.lock:
+            chat = shard.chats.get(chat_id)
+        if chat and chat.active:
+            return chat_id, chat
+        return None, None
+    
+    def _cancel_search_task(self, user_id: int):
+        task = self.search_tasks.pop(user_id, None)
+        if task:
+            try:
+                task.cancel()
+            except:
+                pass
+    
+    def add_to_waiting(self, user_id: int, user_data: Dict, chats_started: int = 0) -> Tuple[bool, str]:
+        if self._lookup(user_id)[1]:
+            return False, "You are already in a chat. Use /leave to exit first."
+        
+        with self.match_lock:
             if user_id in self.waiting:
                 return False, "You are already searching for a partner."
             
-            if user_id in self.user_chats:
-                chat_id = self.user_chats[user_id]
-                if chat_id in self.active_chats and self.active_chats[chat_id].get('active'):
-                    return False, "You are already in a chat. Use /leave to exit first."
-            
-            self.waiting[user_id] = {
-                'data': user_data,
-                'joined': datetime.now().isoformat(),
-                'filter': user_data.get('search_filter', 'random')
-            }
+            self.waiting.add(user_id, WaitingEntry(user_data, chats_started))
+            self.search_expiry.schedule(user_id, time.monotonic() + self.search_timeout)
             
             waiting_count = len(self.waiting) - 1
             return True, f"Searching... {waiting_count} people waiting"
     
     def remove_from_waiting(self, user_id: int):
-        with self.lock:
-            if user_id in self.waiting:
-                del self.waiting[user_id]
-                
-                if user_id in self.search_tasks:
-                    try:
-                        self.search_tasks[user_id].cancel()
-                        del self.search_tasks[user_id]
-                    except:
-                        pass
+        with self.match_lock:
+            if self.waiting.remove(user_id):
+                self._cancel_search_task(user_id)
+        self.search_expiry.cancel(user_id)
     
     def find_match(self, user_id: int) -> Optional[Dict]:
-        with self.lock:
-            if user_id not in self.waiting:
+        with self.match_lock:
+            best = self.waiting.best_partner(user_id)
+            if not best:
                 return None
             
-            user_info = self.waiting[user_id]
-            user_data = user_info['data']
-            user_gender = user_data.get('gender', 'not_specified')
-            user_filter = user_info.get('filter', 'random')
-            
-            candidates = []
+            partner_id, partner_info, compatibility = best
             
-            for partner_id, partner_info in self.waiting.items():
-                if partner_id == user_id:
-                    continue
-                
-                if db.is_blocked(user_id, partner_id) or db.is_blocked(partner_id, user_id):
-                    continue
-                
-                partner_data = partner_info['data']
-                partner_gender = partner_data.get('gender', 'not_specified')
-                partner_filter = partner_info.get('filter', 'random')
-                
-                if user_filter == 'male' and partner_gender != 'male':
-                    continue
-                elif user_filter == 'female' and partner_gender != 'female':
-                    continue
-                
-                if partner_filter == 'male' and user_gender != 'male':
-                    continue
-                elif partner_filter == 'female' and user_gender != 'female':
-                    continue
-                
-                compatibility = 50
-                
-                if user_gender == partner_gender:
-                    compatibility += 10
-                
-                user_chats = db.get_stats(user_id).get('chats_started', 0)
-                partner_chats = db.get_stats(partner_id).get('chats_started', 0)
-                
-                if abs(user_chats - partner_chats) < 10:
-                    compatibility += 15
-                
-                compatibility += random.randint(-10, 10)
-                compatibility = max(30, min(95, compatibility))
-                
-                candidates.append({
-                    'partner_id': partner_id,
-                    'partner_data': partner_data,
-                    'compatibility': compatibility
-                })
+            return {
+                'user1': user_id,
+                'user2': partner_id,
+                'data1': self.waiting[user_id].data,
+                'data2': partner_info.data,
+                'compatibility': compatibility
+            }
+    
+    def requeue(self, user_id: int, user_data: Dict) -> bool:
+        """Re-bucket a waiting user after a gender or filter change"""
+        with self.match_lock:
+            entry = self.waiting.get(user_id)
+            if not entry:
+                return False
             
-            if candidates:
-                candidates.sort(key=lambda x: x['compatibility'], reverse=True)
-                best_match = candidates[0]
-                
-                return {
+            self.waiting.add(user_id, WaitingEntry(user_data, entry.chats_started, entry.joined))
+            return True
+    
+    def waiting_ids(self) -> List[int]:
+        """Everyone waiting, longest-waiting first"""
+        with self.match_lock:
+            return list(self.waiting.entries)
+    
+    def match_round(self, user_ids: Iterable[int]) -> List[Dict]:
+        """Pair as many of ``user_ids`` as possible and open their chats"""
+        with self.match_lock:
+            matches = [
+                {
                     'user1': user_id,
-                    'user2': best_match['partner_id'],
-                    'data1': user_data,
-                    'data2': best_match['partner_data'],
-                    'compatibility': best_match['compatibility']
+                    'user2': partner_id,
+                    'data1': self.waiting[user_id].data,
+                    'data2': self.waiting[partner_id].data,
+                    'compatibility': compatibility
                 }
-            
-            return None
+                for user_id, partner_id, compatibility in self.waiting.plan_round(user_ids)
+            ]
+        
+        for match in matches:
+            match['chat_id'] = self.create_chat(match['user1'], match['user2'], match['data1'], match['data2'])
+        return matches
     
     def create_chat(self, user1: int, user2: int, data1: Dict, data2: Dict) -> str:
-        with self.lock:
-            self.chat_counter += 1
-            chat_id = f"chat_{self.chat_counter}"
+        chat_id = f"chat_{next(self._chat_ids)}"
+        
+        with self.match_lock:
+            entries = [self.waiting.pop(user1, None), self.waiting.pop(user2, None)]
+            for uid in [user1, user2]:
+                self._cancel_search_task(uid)
+        self.search_expiry.cancel(user1)
+        self.search_expiry.cancel(user2)
+        
+        now = time.monotonic()
+        for entry in entries:
+            if entry:
+                match_wait_seconds.observe(now - entry.joined)
+        
+        chat = ChatSession(chat_id, user1, data1, user2, data2)
+        
+        shard = self._chat_shard(chat_id)
+        with shard.lock:
+            shard.chats[chat_id] = chat
+        self.chat_expiry.schedule(chat_id, time.monotonic() + self.chat_idle_timeout)
+        
+        for uid in [user1, user2]:
+            shard = self._user_shard(uid)
+            with shard.lock:
+                shard.users[uid] = chat_id
+        
+        stats_buffer.add(user1, 'chats_started')
+        stats_buffer.add(user2, 'chats_started')
+        stats_buffer.add(user1, 'chats_today')
+        stats_buffer.add(user2, 'chats_today')
+        
+        return chat_id
+    
+    def get_chat(self, user_id: int) -> Tuple[Optional[str], Optional[ChatSession]]:
+        chat_id, chat = self._lookup(user_id)
+        if not chat:
+            return None, None
+        
+        chat.participant(user_id).last_active = time.monotonic()
+        return chat_id, chat
+    
+    def get_partner(self, chat_id: str, user_id: int) -> Optional[Participant]:
+        shard = self._chat_shard(chat_id)
+        with shard.lock:
+            chat = shard.chats.get(chat_id)
+            if not chat or not chat.active:
+                return None
+            return chat.partner(user_id)
+    
+    def partner_id(self, user_id: int) -> Optional[int]:
+        """Id of the user's current partner, without touching activity timestamps"""
+        chat_id, chat = self._lookup(user_id)
+        if not chat:
+            return None
+        return chat.partner(user_id).id
+    
+    def record_message(self, chat_id: str, sender_id: int, is_media: bool = False):
+        shard = self._chat_shard(chat_id)
+        with shard.lock:
+            chat = shard.chats.get(chat_id)
+            if chat and chat.active:
+                chat.last_message = time.monotonic()
+                chat.participant(sender_id).messages_sent += 1
+                if is_media:
+                    chat.media_sent += 1
+        
+        self.chat_expiry.touch(chat_id, time.monotonic() + self.chat_idle_timeout)
+    
+    def end_chat(self, chat_id: str, reason: str = "ended"):
+        shard = self._chat_shard(chat_id)
+        with shard.lock:
+            chat = shard.chats.get(chat_id)
+            if not chat or not chat.active:
+                return None
             
-            self.waiting.pop(user1, None)
-            self.waiting.pop(user2, None)
+            chat.active = False
+            chat.ended = time.monotonic()
+            chat.reason = reason
+            del shard.chats[chat_id]
+        self.chat_expiry.cancel(chat_id)
+        
+        user1_id = chat.user1.id
+        user2_id = chat.user2.id
+        self._remember(user1_id, user2_id, chat_id)
+        self._remember(user2_id, user1_id, chat_id)
+        
+        for uid in [user1_id, user2_id]:
+            user_shard = self._user_shard(uid)
+            with user_shard.lock:
+                if user_shard.users.get(uid) == chat_id:
+                    del user_shard.users[uid]
+        
+        # Persistence happens after every lock is released
+        try:
+            stats_buffer.add(user1_id, 'total_chat_duration', int(chat.duration))
+            stats_buffer.add(user2_id, 'total_chat_duration', int(chat.duration))
             
-            for uid in [user1, user2]:
-                if uid in self.search_tasks:
-                    try:
-                        self.search_tasks[uid].cancel()
-                        del self.search_tasks[uid]
-                    except:
-                        pass
+            adb.submit(db.save_chat, chat.to_dict())
             
-            db.update_stats(user1, 'chats_started')
-            db.update_stats(user2, 'chats_started')
-            db.update_stats(user1, 'chats_today')
-            db.update_stats(user2, 'chats_today')
+        except Exception as e:
+            logger.error(f"Error saving chat: {e}")
+        
+        return chat
+    
+    def _remember(self, user_id: int, partner_id: int, chat_id: str):
+        with self.recent_lock:
+            self.recent_chats[user_id] = (partner_id, chat_id)
+            self.recent_chats.move_to_end(user_id)
+            while len(self.recent_chats) > self.recent_size:
+                self.recent_chats.popitem(last=False)
+    
+    def rating_target(self, user_id: int) -> Optional[int]:
+        """Partner a rating applies to: the current one, else the last one (rated once)"""
+        partner_id = self.partner_id(user_id)
+        if partner_id:
+            return partner_id
+        
+        with self.recent_lock:
+            recent = self.recent_chats.pop(user_id, None)
+        return recent[0] if recent else None
+    
+    def expire_searches(self, now: Optional[float] = None) -> List[int]:
+        """Drop searches that have waited past SEARCH_TIMEOUT"""
+        expired = []
+        for user_id in self.search_expiry.pop_due(now):
+            with self.match_lock:
+                if self.waiting.remove(user_id):
+                    self._cancel_search_task(user_id)
+                    expired.append(user_id)
+        return expired
+    
+    def expire_chats(self, now: Optional[float] = None) -> List[ChatSession]:
+        """End chats with no message for CHAT_IDLE_TIMEOUT"""
+        ended = []
+        for chat_id in self.chat_expiry.pop_due(now):
+            chat = self.end_chat(chat_id, "inactive")
+            if chat:
+                ended.append(chat)
+        return ended
+    
+    def chat_items(self) -> List[Tuple[str, ChatSession]]:
+        """Snapshot of the active chats, one shard at a time"""
+        items = []
+        for shard in self.shards:
+            with shard.lock:
+                items.extend(shard.chats.items())
+        return items
+    
+    def get_waiting_count(self) -> int:
+        with self.match_lock:
+            return len(self.waiting)
+    
+    def get_active_chat_count(self) -> int:
+        count = 0
+        for shard in self.shards:
+            with shard.lock:
+                count += len(shard.chats)
+        return count
+
+cm = ProfessionalChatManager()
+
+# ==================== OUTBOUND SEND SCHEDULER ====================
+# Lower value goes out first
+PRIORITY_RELAY = 0
+PRIORITY_NOTICE = 1
+PRIORITY_BULK = 2
+
+class TokenBucket:
+    """Classic token bucket; ``delay`` says how long until a token is free"""
+    
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+    
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+    
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def delay(self, now: float) -> float:
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+    
+    def consume(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+    
+    def available(self, now: float) -> float:
+        self._refill(now)
+        return self.tokens
+    
+    def full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.burst
+
+class SendJob:
+    __slots__ = ('func', 'chat_id', 'args', 'kwargs', 'priority', 'future', 'attempts')
+    
+    def __init__(self, func, chat_id, args, kwargs, priority, future):
+        self.func = func
+        self.chat_id = chat_id
+        self.args = args
+        self.kwargs = kwargs
+        self.priority = priority
+        self.future = future
+        self.attempts = 0
+
+class SendScheduler:
+    """Single outbound queue for Bot API sends.
+    
+    A global bucket keeps the bot under Telegram's ~30 msg/s limit and each
+    chat has its own bucket (bursts for private chats, ~1 msg/s for groups).
+    Sends to one chat go out one at a time and in order; across chats the
+    lowest priority value wins, so live relays overtake bulk notices.
+    ``RetryAfter`` pauses the chat for the time Telegram asks and
+    connection failures are retried with backoff. ``BadRequest`` (a
+    ``NetworkError`` subclass in PTB 20) and ``Forbidden`` are permanent and
+    fail at once. So does ``TimedOut``: the message may already have been
+    delivered, and sending it again would duplicate it.
+    """
+    
+    def __init__(self, global_rate: Optional[float] = None, chat_rate: Optional[float] = None,
+                 chat_burst: Optional[float] = None, group_rate: Optional[float] = None,
+                 max_retries: Optional[int] = None, max_in_flight: Optional[int] = None):
+        if global_rate is None:
+            global_rate = float(os.getenv('SEND_GLOBAL_RATE', '30'))
+        if chat_rate is None:
+            chat_rate = float(os.getenv('SEND_CHAT_RATE', '1'))
+        if chat_burst is None:
+            chat_burst = float(os.getenv('SEND_CHAT_BURST', '3'))
+        if group_rate is None:
+            group_rate = float(os.getenv('SEND_GROUP_RATE', '1'))
+        if max_retries is None:
+            max_retries = int(os.getenv('SEND_MAX_RETRIES', '3'))
+        if max_in_flight is None:
+            max_in_flight = int(os.getenv('SEND_MAX_IN_FLIGHT', '64'))
+        
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        self.max_in_flight = max_in_flight
+        
+        self.queues: Dict[int, 'deque'] = {}
+        self.buckets: Dict[int, TokenBucket] = {}
+        self.busy = set()
+        self.tasks = set()                 # _deliver tasks on the wire
+        self.ready: List[Tuple] = []       # (priority, seq, chat_id)
+        self.delayed: List[Tuple] = []     # (ready_at, seq, chat_id)
+        self._seq = itertools.count()
+        
+        self.queued = 0
+        self.in_flight = 0
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.retry_after_hits = 0
+        self.errors: Dict[str, int] = {}
+        
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+    
+    def _bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self.buckets.get(chat_id)
+        if bucket is None:
+            if chat_id < 0:
+                bucket = TokenBucket(self.group_rate, 1)
+            else:
+                bucket = TokenBucket(self.chat_rate, self.chat_burst)
+            self.buckets[chat_id] = bucket
+        return bucket
+    
+    def try_acquire(self, chat_id: int, spare: int = 1) -> bool:
+        """Charge a best-effort call made outside the queue to both buckets.
+        
+        Only succeeds while each bucket holds ``spare`` tokens beyond the one
+        taken, so such calls never hold up a queued send.
+        """
+        now = time.monotonic()
+        bucket = self._bucket(chat_id)
+        if self.global_bucket.available(now) < 1 + spare or bucket.available(now) < 1 + spare:
+            return False
+        self.global_bucket.consume(now)
+        bucket.consume(now)
+        return True
+    
+    def _schedule(self, chat_id: int, not_before: float = 0.0):
+        """Put a chat with pending jobs back in line"""
+        now = time.monotonic()
+        ready_at = max(not_before, now + self._bucket(chat_id).delay(now))
+        if ready_at <= now:
+            priority = min(job.priority for job in self.queues[chat_id])
+            heapq.heappush(self.ready, (priority, next(self._seq), chat_id))
+        else:
+            heapq.heappush(self.delayed, (ready_at, next(self._seq), chat_id))
+        if self._wakeup:
+            self._wakeup.set()
+    
+    def _enqueue(self, func, chat_id: int, args, kwargs, priority: int) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        job = SendJob(func, chat_id, args, kwargs, priority, future)
+        
+        queue = self.queues.get(chat_id)
+        if queue is None:
+            queue = self.queues[chat_id] = deque()
+        queue.append(job)
+        self.queued += 1
+        
+        # A busy chat is rescheduled when its current send finishes
+        if len(queue) == 1 and chat_id not in self.busy:
+            self._schedule(chat_id)
+        return future
+    
+    def post(self, func, chat_id: int, *args, priority: int = PRIORITY_BULK, **kwargs) -> asyncio.Future:
+        """Queue ``func(chat_id, *args, **kwargs)`` without waiting; failures are logged"""
+        future = self._enqueue(func, chat_id, args, kwargs, priority)
+        future.add_done_callback(lambda f: self._log_failure(f, chat_id))
+        return future
+    
+    async def send(self, func, chat_id: int, *args, priority: int = PRIORITY_RELAY, **kwargs):
+        """Queue a send and wait for Telegram's answer (errors are re-raised)"""
+        return await self._enqueue(func, chat_id, args, kwargs, priority)
+    
+    @staticmethod
+    def _log_failure(future: asyncio.Future, chat_id: int):
+        if not future.cancelled() and future.exception() is not None:
+            e = future.exception()
+            logger.warning(f"Outbound send to {chat_id} failed: {type(e).__name__}: {e}")
+    
+    @staticmethod
+    def _settle(job: SendJob, result=None, error: Optional[Exception] = None):
+        if job.future.done():
+            return
+        if error is not None:
+            job.future.set_exception(error)
+        else:
+            job.future.set_result(result)
+    
+    def _fail(self, job: SendJob, error: Exception):
+        self.failed += 1
+        name = type(error).__name__
+        self.errors[name] = self.errors.get(name, 0) + 1
+        self._settle(job, error=error)
+    
+    async def _deliver(self, job: SendJob):
+        chat_id = job.chat_id
+        not_before = 0.0
+        job.attempts += 1
+        
+        try:
+            result = await job.func(chat_id, *job.args, **job.kwargs)
+        except RetryAfter as e:
+            self.retry_after_hits += 1
+            retry_after = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else e.retry_after
+            if job.attempts <= self.max_retries:
+                self.retried += 1
+                self.queues[chat_id].appendleft(job)
+                self.queued += 1
+                not_before = time.monotonic() + retry_after
+            else:
+                self._fail(job, e)
+        except (BadRequest, Forbidden, TimedOut) as e:
+            self._fail(job, e)
+        except asyncio.CancelledError:
+            job.future.cancel()
+            raise
+        except NetworkError as e:
+            if job.attempts <= self.max_retries:
+                self.retried += 1
+                self.queues[chat_id].appendleft(job)
+                self.queued += 1
+                not_before = time.monotonic() + min(30, 2 ** job.attempts)
+            else:
+                self._fail(job, e)
+        except Exception as e:
+            self._fail(job, e)
+        else:
+            self.sent += 1
+            self._settle(job, result)
+        finally:
+            self.in_flight -= 1
+            self.busy.discard(chat_id)
+            if self.queues[chat_id]:
+                self._schedule(chat_id, not_before)
+            else:
+                del self.queues[chat_id]
+            if self._wakeup:
+                self._wakeup.set()
+    
+    def _prune_buckets(self):
+        now = time.monotonic()
+        for chat_id in [c for c, b in self.buckets.items() if c not in self.queues and b.full(now)]:
+            del self.buckets[chat_id]
+    
+    async def run(self):
+        last_prune = time.monotonic()
+        while True:
+            now = time.monotonic()
+            while self.delayed and self.delayed[0][0] <= now:
+                _, _, chat_id = heapq.heappop(self.delayed)
+                priority = min(job.priority for job in self.queues[chat_id])
+                heapq.heappush(self.ready, (priority, next(self._seq), chat_id))
             
-            self.active_chats[chat_id] = {
-                'user1': {'id': user1, 'data': data1, 'messages_sent': 0, 'last_active': datetime.now().isoformat()},
-                'user2': {'id': user2, 'data': data2, 'messages_sent': 0, 'last_active': datetime.now().isoformat()},
-                'active': True,
-                'created': datetime.now().isoformat(),
-                'messages_sent_user1': 0,
-                'messages_sent_user2': 0,
-                'media_sent': 0,
-                'last_message': None
-            }
+            if now - last_prune > 60:
+                self._prune_buckets()
+                last_prune = now
             
-            self.user_chats[user1] = chat_id
-            self.user_chats[user2] = chat_id
+            if self.ready and self.in_flight < self.max_in_flight:
+                wait = self.global_bucket.delay(now)
+            elif self.delayed:
+                wait = self.delayed[0][0] - now
+            else:
+                wait = None
             
-            return chat_id
-    
-    def get_chat(self, user_id: int) -> Tuple[Optional[str], Optional[Dict]]:
-        with self.lock:
-            chat_id = self.user_chats.get(user_id)
-            if chat_id and chat_id in self.active_chats:
-                chat = self.active_chats[chat_id]
-                if chat.get('active'):
-                    if chat['user1']['id'] == user_id:
-                        chat['user1']['last_active'] = datetime.now().isoformat()
-                    else:
-                        chat['user2']['last_active'] = datetime.now().isoformat()
-                    return chat_id, chat
-            return None, None
+            if not self.ready or self.in_flight >= self.max_in_flight or wait > 0:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            
+            _, _, chat_id = heapq.heappop(self.ready)
+            job = self.queues[chat_id].popleft()
+            self.queued -= 1
+            
+            if job.future.cancelled():
+                if self.queues[chat_id]:
+                    self._schedule(chat_id)
+                else:
+                    del self.queues[chat_id]
+                continue
+            
+            self.global_bucket.consume(now)
+            self._bucket(chat_id).consume(now)
+            self.busy.add(chat_id)
+            self.in_flight += 1
+            task = asyncio.create_task(self._deliver(job))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+    
+    async def start(self):
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self.run())
+        if self.queues:
+            self._wakeup.set()
+    
+    async def stop(self, timeout: float = 5.0):
+        """Give queued sends a moment to drain, then stop the dispatcher.
+        
+        Sends still in flight after ``timeout`` are cancelled.
+        """
+        deadline = time.monotonic() + timeout
+        while (self.queued or self.in_flight) and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        
+        for task in self.tasks:
+            task.cancel()
+        if self.tasks:
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+    
+    def metrics(self) -> Dict:
+        return {
+            'queued': self.queued,
+            'in_flight': self.in_flight,
+            'sent': self.sent,
+            'failed': self.failed,
+            'retried': self.retried,
+            'retry_after': self.retry_after_hits,
+            'errors': dict(self.errors),
+        }
+
+outbox = SendScheduler()
+
+# ==================== TYPING INDICATOR ====================
+class TypingIndicator:
+    """Coalesces "typing..." chat actions to at most one per chat per interval.
+    
+    Actions are fired in the background and never delay the relay itself.
+    Each one is charged to the outbox's global and per-chat buckets, and is
+    dropped when they run low or the chat already has sends queued. Set
+    TYPING_INDICATOR=0 to turn them off completely.
+    """
+    
+    def __init__(self, enabled: Optional[bool] = None, interval: Optional[float] = None):
+        if enabled is None:
+            enabled = os.getenv('TYPING_INDICATOR', '1') not in ('0', 'false', 'no')
+        if interval is None:
+            interval = float(os.getenv('TYPING_INTERVAL', '4'))
+        
+        self.enabled = enabled
+        self.interval = interval
+        self.last_sent: Dict[int, float] = {}
+        self.tasks = set()
+        self.sent = 0
+        self.skipped = 0
+    
+    def ping(self, bot, chat_id: int):
+        if not self.enabled:
+            return
+        
+        now = time.monotonic()
+        if now - self.last_sent.get(chat_id, 0.0) < self.interval:
+            self.skipped += 1
+            return
+        if outbox.queues.get(chat_id) or not outbox.try_acquire(chat_id):
+            self.skipped += 1
+            return
+        
+        if len(self.last_sent) > 10000:
+            self.last_sent = {c: t for c, t in self.last_sent.items() if now - t < self.interval}
+        self.last_sent[chat_id] = now
+        self.sent += 1
+        
+        task = asyncio.create_task(self._send(bot, chat_id))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
     
-    def get_partner(self, chat_id: str, user_id: int) -> Optional[Dict]:
-        with self.lock:
-            chat = self.active_chats.get(chat_id)
-            if not chat or not chat.get('active'):
-                return None
-            
-            if chat['user1']['id'] == user_id:
-                return chat['user2']
-            return chat['user1']
+    @staticmethod
+    async def _send(bot, chat_id: int):
+        try:
+            await bot.send_chat_action(chat_id=chat_id, action="typing")
+        except Exception as e:
+            logger.debug(f"Typing indicator for {chat_id} failed: {e}")
     
-    def record_message(self, chat_id: str, sender_id: int, is_media: bool = False):
-        with self.lock:
-            if chat_id in self.active_chats:
-                chat = self.active_chats[chat_id]
-                if chat.get('active'):
-                    chat['last_message'] = datetime.now().isoformat()
-                    
-                    if chat['user1']['id'] == sender_id:
-                        chat['messages_sent_user1'] += 1
-                        chat['user1']['messages_sent'] += 1
-                    else:
-                        chat['messages_sent_user2'] += 1
-                        chat['user2']['messages_sent'] += 1
-                    
-                    if is_media:
-                        chat['media_sent'] += 1
+    async def stop(self):
+        """Let actions already on the wire finish"""
+        if self.tasks:
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+
+typing_indicator = TypingIndicator()
+
+# ==================== MEDIA ALBUMS ====================
+class MediaGroupBuffer:
+    """Relays a whole album with one send_media_group call.
+    
+    Telegram delivers each album item as its own update sharing a
+    media_group_id. Items are held until none has arrived for
+    MEDIA_GROUP_WINDOW seconds (or the album hits Telegram's 10 item limit)
+    and then go out together. Every item keeps its own caption and
+    formatting; the sender attribution is added to the first one.
+    """
+    
+    MAX_ITEMS = 10
+    
+    def __init__(self, chat_manager, window: Optional[float] = None):
+        if window is None:
+            window = float(os.getenv('MEDIA_GROUP_WINDOW', '0.8'))
+        
+        self.cm = chat_manager
+        self.window = window
+        self.groups: Dict[str, Dict] = {}
+        self.by_sender: Dict[int, set] = {}
+        self.tasks = set()
+        
+        self.albums_sent = 0
+        self.items_sent = 0
+    
+    def add(self, bot, message, sender_id: int, partner_id: int, chat_id: str, nickname: str):
+        group_id = message.media_group_id
+        group = self.groups.get(group_id)
+        if group is None:
+            group = self.groups[group_id] = {
+                'bot': bot,
+                'sender': sender_id,
+                'partner': partner_id,
+                'chat_id': chat_id,
+                'nickname': nickname,
+                'messages': [],
+                'timer': None,
+            }
+            self.by_sender.setdefault(sender_id, set()).add(group_id)
+        
+        group['messages'].append(message)
+        if group['timer']:
+            group['timer'].cancel()
+        
+        delay = 0 if len(group['messages']) >= self.MAX_ITEMS else self.window
+        group['timer'] = asyncio.get_running_loop().call_later(delay, self._spawn_flush, group_id)
+    
+    def _spawn_flush(self, group_id: str):
+        task = asyncio.create_task(self.flush(group_id))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+    
+    @staticmethod
+    def _input_media(message, caption: Optional[str] = None, entities=None):
+        if message.photo:
+            return InputMediaPhoto(message.photo[-1].file_id, caption=caption, caption_entities=entities)
+        if message.video:
+            return InputMediaVideo(message.video.file_id, caption=caption, caption_entities=entities)
+        if message.audio:
+            return InputMediaAudio(message.audio.file_id, caption=caption, caption_entities=entities)
+        if message.document:
+            return InputMediaDocument(message.document.file_id, caption=caption, caption_entities=entities)
+        return None
+    
+    @staticmethod
+    def _attributed(message, attribution: str):
+        """Caption and entities for the first item, with the attribution in front if it fits"""
+        if not message.caption:
+            return attribution, None
+        
+        prefix = f"{attribution}: "
+        if _utf16_len(prefix + message.caption) <= CAPTION_LIMIT:
+            return prefix + message.caption, _shift_entities(message.caption_entities, _utf16_len(prefix))
+        return message.caption, message.caption_entities
+    
+    async def flush(self, group_id: str):
+        group = self.groups.pop(group_id, None)
+        if group is None:
+            return
+        if group['timer']:
+            group['timer'].cancel()
+        
+        sender_id = group['sender']
+        pending = self.by_sender.get(sender_id)
+        if pending:
+            pending.discard(group_id)
+            if not pending:
+                del self.by_sender[sender_id]
+        
+        # The chat may have ended while the album was still arriving
+        if self.cm.partner_id(sender_id) != group['partner']:
+            return
+        
+        messages = sorted(group['messages'], key=lambda m: m.message_id)
+        attribution = f"📎 Album from {group['nickname']}"
+        
+        media = []
+        for message in messages:
+            if media:
+                caption, entities = message.caption, message.caption_entities
+            else:
+                caption, entities = self._attributed(message, attribution)
+            item = self._input_media(message, caption, entities)
+            if item is not None:
+                media.append(item)
+        if not media:
+            return
+        
+        bot = group['bot']
+        try:
+            await outbox.send(bot.send_media_group, group['partner'], media)
+        except Exception as e:
+            logger.error(f"Failed to send album: {e}")
+            outbox.post(bot.send_message, sender_id, "❌ Failed to send media.", priority=PRIORITY_NOTICE)
+            return
+        
+        self.albums_sent += 1
+        self.items_sent += len(media)
+        for _ in media:
+            self.cm.record_message(group['chat_id'], sender_id, is_media=True)
+            stats_buffer.add(sender_id, 'media_sent')
+            stats_buffer.add(group['partner'], 'messages_received')
+    
+    async def flush_sender(self, sender_id: int):
+        """Send anything still buffered from this user so later relays can't overtake it"""
+        for group_id in list(self.by_sender.get(sender_id, ())):
+            await self.flush(group_id)
+    
+    async def stop(self):
+        """Send every buffered album and wait for flushes already under way"""
+        for group_id in list(self.groups):
+            await self.flush(group_id)
+        if self.tasks:
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+
+media_groups = MediaGroupBuffer(cm)
+
+# ==================== MATCHMAKER ====================
+def match_buttons() -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("🔄 Next Partner", callback_data="next"),
+         InlineKeyboardButton("🚫 Block", callback_data="block")],
+        [InlineKeyboardButton("👍 Rate Good", callback_data="rate_good"),
+         InlineKeyboardButton("👎 Rate Bad", callback_data="rate_bad")],
+        [InlineKeyboardButton("❌ Leave Chat", callback_data="leave")]
+    ])
+
+async def announce_match(bot, match: Dict):
+    """Tell both users about a match made outside their own search request"""
+    buttons = match_buttons()
+    
+    for user_id, partner_data in [(match['user1'], match['data2']), (match['user2'], match['data1'])]:
+        outbox.post(
+            bot.send_message,
+            user_id,
+            f"""
+🎉 Match Found!
+
+👤 Partner: {partner_data.get('nickname', 'Anonymous')}
+🤝 Compatibility: {match.get('compatibility', 50)}%
+
+💬 Start chatting now!
+""",
+            reply_markup=buttons,
+            priority=PRIORITY_NOTICE
+        )
+
+class Matchmaker:
+    """Background task that pairs waiting users in bounded rounds.
+    
+    ``find_match`` already gives a newcomer the best partner in reach, so
+    joining the queue does not start a round. ``notify(user_id, ...)`` does,
+    for users whose chances changed: a gender or filter change, or an
+    unblock. Every MATCHMAKER_INTERVAL seconds a round also takes the next
+    slice of the pool, so everyone is looked at again now and then.
+    
+    A round plans at most MATCHMAKER_BATCH users, greedily pairing the most
+    compatible couples first, and runs on the event loop under the match
+    lock; its duration is exported as ``match_round_seconds``.
+    """
+    
+    def __init__(self, chat_manager, interval: Optional[float] = None, batch: Optional[int] = None):
+        if interval is None:
+            interval = float(os.getenv('MATCHMAKER_INTERVAL', '2'))
+        if batch is None:
+            batch = int(os.getenv('MATCHMAKER_BATCH', '200'))
+        
+        self.cm = chat_manager
+        self.interval = interval
+        self.batch = max(1, batch)
+        self.bot = None
+        
+        self.pending: OrderedDict = OrderedDict()
+        self.sweep: deque = deque()
+        
+        self.rounds = 0
+        self.pairs_made = 0
+        self.last_round_ms = 0.0
+        
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+    
+    def notify(self, *user_ids: int):
+        """Plan these users in the next round, which starts right away"""
+        for user_id in user_ids:
+            self.pending[user_id] = None
+        if self._wakeup:
+            self._wakeup.set()
+    
+    def _next_batch(self) -> List[int]:
+        """Notified users first, then the next slice of the pool"""
+        batch = []
+        while self.pending and len(batch) < self.batch:
+            batch.append(self.pending.popitem(last=False)[0])
+        
+        if not self.sweep:
+            self.sweep.extend(self.cm.waiting_ids())
+        while self.sweep and len(batch) < self.batch:
+            batch.append(self.sweep.popleft())
+        return batch
+    
+    async def run_round(self) -> int:
+        started = time.perf_counter()
+        matches = self.cm.match_round(self._next_batch())
+        elapsed = time.perf_counter() - started
+        self.last_round_ms = elapsed * 1000
+        match_round_seconds.observe(elapsed)
+        
+        self.rounds += 1
+        self.pairs_made += len(matches)
+        
+        for match in matches:
+            await announce_match(self.bot, match)
+        
+        if matches:
+            logger.info(f"Matchmaker: paired {len(matches)} couples in {self.last_round_ms:.1f} ms")
+        return len(matches)
     
-    def end_chat(self, chat_id: str, reason: str = "ended"):
-        with self.lock:
-            if chat_id in self.active_chats:
-                chat = self.active_chats[chat_id]
-                chat['active'] = False
-                chat['ended'] = datetime.now().isoformat()
-                chat['reason'] = reason
-                
-                try:
-                    start = datetime.fromisoformat(chat['created'])
-                    end = datetime.fromisoformat(chat['ended'])
-                    duration = (end - start).total_seconds()
-                    chat['duration'] = duration
-                    
-                    user1_id = chat['user1']['id']
-                    user2_id = chat['user2']['id']
-                    
-                    db.update_stats(user1_id, 'total_chat_duration', int(duration))
-                    db.update_stats(user2_id, 'total_chat_duration', int(duration))
-                    
-                    db.save_chat(chat)
-                    
-                except Exception as e:
-                    logger.error(f"Error saving chat: {e}")
-                
-                user1_id = chat['user1']['id']
-                user2_id = chat['user2']['id']
-                
-                self.user_chats.pop(user1_id, None)
-                self.user_chats.pop(user2_id, None)
-                
-                return chat
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
             
-            return None
-    
-    def get_waiting_count(self) -> int:
-        with self.lock:
-            return len(self.waiting)
-    
-    def get_active_chat_count(self) -> int:
-        with self.lock:
-            return len([c for c in self.active_chats.values() if c.get('active')])
+            try:
+                await self.run_round()
+            except Exception as e:
+                logger.error(f"Matchmaker round failed: {e}")
+            
+            if self.pending:
+                # More notified users than one round takes; let handlers run, then go on
+                await asyncio.sleep(0)
+                self._wakeup.set()
+    
+    async def start(self, bot):
+        self.bot = bot
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self.run())
+    
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
 
-cm = ProfessionalChatManager()
+matchmaker = Matchmaker(cm)
 
 # ==================== IMPROVED USERNAME CONVERSION ====================
 def clean_nickname(nickname: str) -> str:
@@ -511,7 +2348,7 @@ def generate_nickname(user: Update.effective_user) -> str:
     
     return nickname
 
-def auto_register_user(user_id: int, user: Update.effective_user) -> Dict:
+async def auto_register_user(user_id: int, user: Update.effective_user) -> Dict:
     """Automatically register a user with improved nickname system"""
     # Generate nickname from username/name
     nickname = generate_nickname(user)
@@ -530,14 +2367,74 @@ def auto_register_user(user_id: int, user: Update.effective_user) -> Dict:
         'auto_registered': True
     }
     
-    # Save user
-    db.save_user(user_id, user_data)
-    
-    # Initialize stats
-    db.update_stats(user_id, 'chats_started', 0)
+    # Save user (this also creates the stats row)
+    await user_cache.save(user_id, user_data)
+    stats_buffer.user_added()
     
     return user_data
 
+# ==================== RENDER CACHE ====================
+class RenderCache:
+    """Rendered /profile and /stats text, reused until its inputs change.
+    
+    Per-user blocks are stored with the key they were rendered from (stats
+    version, day and the profile fields shown) and only returned while that
+    key still matches. The global statistics block is shared by every user
+    and re-rendered at most once per GLOBAL_STATS_TTL seconds. Only the event
+    loop touches it, so it needs no lock.
+    """
+    
+    def __init__(self, max_size: Optional[int] = None, global_ttl: Optional[float] = None):
+        if max_size is None:
+            max_size = int(os.getenv('RENDER_CACHE_SIZE', '10000'))
+        if global_ttl is None:
+            global_ttl = float(os.getenv('GLOBAL_STATS_TTL', '10'))
+        
+        self.max_size = max_size
+        self.global_ttl = global_ttl
+        self.entries: OrderedDict = OrderedDict()
+        self.global_text: Optional[str] = None
+        self.global_expiry = 0.0
+        
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, kind: str, user_id: int, key) -> Optional[str]:
+        entry = self.entries.get((kind, user_id))
+        if entry is None or entry[0] != key:
+            self.misses += 1
+            return None
+        self.entries.move_to_end((kind, user_id))
+        self.hits += 1
+        return entry[1]
+    
+    def put(self, kind: str, user_id: int, key, text: str):
+        self.entries[(kind, user_id)] = (key, text)
+        self.entries.move_to_end((kind, user_id))
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+    
+    def global_section(self, render) -> str:
+        now = time.monotonic()
+        if self.global_text is None or now >= self.global_expiry:
+            self.global_text = render()
+            self.global_expiry = now + self.global_ttl
+        return self.global_text
+
+render_cache = RenderCache()
+
+def render_key(user_id: int, user_data: Dict) -> Tuple:
+    """Everything a cached profile/stats block depends on"""
+    return (
+        stats_buffer.stats_version(user_id),
+        datetime.now().date(),  # chats_today resets at midnight
+        user_data.get('nickname'),
+        user_data.get('gender_display'),
+        user_data.get('search_filter_display'),
+        user_data.get('auto_registered'),
+        user_data.get('registered'),
+    )
+
 # ==================== FORMATTING FUNCTIONS ====================
 def format_duration(seconds: int) -> str:
     """Format duration in days, hours, minutes"""
@@ -556,9 +2453,14 @@ def format_number(num: int) -> str:
     """Format number with commas"""
     return f"{num:,}"
 
-def format_profile(user_id: int, user_data: Dict) -> str:
+async def format_profile(user_id: int, user_data: Dict) -> str:
     """Format profile in clean style"""
-    stats = db.get_stats(user_id)
+    key = render_key(user_id, user_data)
+    cached = render_cache.get('profile', user_id, key)
+    if cached is not None:
+        return cached
+    
+    stats = await stats_buffer.get_stats(user_id)
     
     # Format registration date
     reg_date = user_data.get('registered', '')
@@ -602,16 +2504,12 @@ def format_profile(user_id: int, user_data: Dict) -> str:
 ⭐ Ratings: {positive_ratings}👍 {negative_ratings}👎
 """
     
-    return profile.strip()
+    profile = profile.strip()
+    render_cache.put('profile', user_id, key, profile)
+    return profile
 
-def format_stats(user_id: int, user_data: Dict) -> str:
-    """Format statistics in clean style"""
-    stats = db.get_stats(user_id)
-    global_stats = db.get_global_stats()
-    
-    chat_id, chat = cm.get_chat(user_id)
-    in_chat = "✅ In chat" if chat else "❌ Not in chat"
-    in_queue = "🔍 Searching" if user_id in cm.waiting else "⏸️ Not searching"
+def format_global_stats() -> str:
+    global_stats = stats_buffer.global_stats()
     
     total_users = format_number(global_stats.get('total_users', 0))
     total_messages = format_number(global_stats.get('total_messages', 0))
@@ -619,7 +2517,22 @@ def format_stats(user_id: int, user_data: Dict) -> str:
     total_positive = format_number(global_stats.get('total_positive_ratings', 0))
     total_negative = format_number(global_stats.get('total_negative_ratings', 0))
     
-    stats_text = f"""
+    return f"""
+🌐 Global Statistics:
+  • Total users: {total_users}
+  • Total messages: {total_messages}
+  • Total chats: {total_chats}
+  • Positive ratings: {total_positive}
+  • Negative ratings: {total_negative}
+"""
+
+async def format_stats(user_id: int, user_data: Dict) -> str:
+    """Format statistics in clean style"""
+    key = render_key(user_id, user_data)
+    activity = render_cache.get('stats', user_id, key)
+    if activity is None:
+        stats = await stats_buffer.get_stats(user_id)
+        activity = f"""
 📊 Statistics
 
 👤 Nickname: {user_data.get('nickname', 'Unknown')}
@@ -632,36 +2545,30 @@ def format_stats(user_id: int, user_data: Dict) -> str:
   • Chats started: {format_number(int(stats.get('chats_started', 0)))}
   • Chats today: {format_number(int(stats.get('chats_today', 0)))}
   • Chat duration: {format_duration(int(stats.get('total_chat_duration', 0)))}
-
+"""
+        render_cache.put('stats', user_id, key, activity)
+    
+    # Live status: one chat lookup; the waiting count is read without the match lock
+    chat_id, chat = cm.get_chat(user_id)
+    in_chat = "✅ In chat" if chat else "❌ Not in chat"
+    in_queue = "🔍 Searching" if user_id in cm.waiting else "⏸️ Not searching"
+    
+    stats_text = activity + f"""
 📱 Current Status:
   • {in_chat}
   • {in_queue}
-  • People waiting: {cm.get_waiting_count()}
-
-🌐 Global Statistics:
-  • Total users: {total_users}
-  • Total messages: {total_messages}
-  • Total chats: {total_chats}
-  • Positive ratings: {total_positive}
-  • Negative ratings: {total_negative}
-"""
+  • People waiting: {len(cm.waiting)}
+""" + render_cache.global_section(format_global_stats)
     
     if chat:
-        partner = cm.get_partner(chat_id, user_id)
-        if partner:
-            partner_nick = partner['data'].get('nickname', 'Anonymous')
-            chat_duration = 0
-            try:
-                start = datetime.fromisoformat(chat.get('created', ''))
-                now = datetime.now()
-                chat_duration = int((now - start).total_seconds())
-            except:
-                pass
-            
-            messages_sent = chat.get('messages_sent_user1', 0) if chat['user1']['id'] == user_id else chat.get('messages_sent_user2', 0)
-            messages_received = chat.get('messages_sent_user2', 0) if chat['user1']['id'] == user_id else chat.get('messages_sent_user1', 0)
-            
-            stats_text += f"""
+        partner = chat.partner(user_id)
+        partner_nick = partner.data.get('nickname', 'Anonymous')
+        chat_duration = int(chat.elapsed())
+        
+        messages_sent = chat.participant(user_id).messages_sent
+        messages_received = partner.messages_sent
+        
+        stats_text += f"""
 💬 Current Chat:
   • Partner: {partner_nick}
   • Duration: {format_duration(chat_duration)}
@@ -686,18 +2593,17 @@ async def leave_chat_from_callback(user_id: int, context: ContextTypes.DEFAULT_T
     ended_chat = cm.end_chat(chat_id, "left")
     
     if ended_chat:
-        duration = ended_chat.get('duration', 0)
-        messages_sent = ended_chat.get('messages_sent_user1', 0) if ended_chat['user1']['id'] == user_id else ended_chat.get('messages_sent_user2', 0)
+        duration = ended_chat.duration
+        messages_sent = ended_chat.participant(user_id).messages_sent
         
         if partner:
-            try:
-                await context.bot.send_message(
-                    partner['id'],
-                    "❌ Your partner left the chat.\n\n"
-                    "Press 'Find Partner' to find someone new."
-                )
-            except:
-                pass
+            outbox.post(
+                context.bot.send_message,
+                partner.id,
+                "❌ Your partner left the chat.\n\n"
+                "Press 'Find Partner' to find someone new.",
+                priority=PRIORITY_NOTICE
+            )
         
         # Send response based on how function was called
         if query:
@@ -729,7 +2635,7 @@ Press 'Find Partner' to find someone new.
 # ==================== SEARCH HELPER FUNCTIONS ====================
 async def start_search_for_user(user_id: int, context: ContextTypes.DEFAULT_TYPE, query=None):
     """Helper function to start search for a user"""
-    user_data = db.get_user(user_id)
+    user_data = await user_cache.get(user_id)
     if not user_data:
         if query:
             await query.answer("Please register first!", show_alert=True)
@@ -751,7 +2657,9 @@ async def start_search_for_user(user_id: int, context: ContextTypes.DEFAULT_TYPE
         return False
     
     # Add to waiting list
-    success, message = cm.add_to_waiting(user_id, user_data)
+    # Everything matching needs is fetched up front so find_match does no I/O
+    stats = await stats_buffer.get_stats(user_id)
+    success, message = cm.add_to_waiting(user_id, user_data, stats.get('chats_started', 0))
     if not success:
         if query:
             await query.answer(message, show_alert=True)
@@ -797,7 +2705,8 @@ async def start_search_for_user(user_id: int, context: ContextTypes.DEFAULT_TYPE
                 reply_markup=buttons
             )
         else:
-            await context.bot.send_message(
+            await outbox.send(
+                context.bot.send_message,
                 user_id,
                 f"""
 🎉 New Partner Found!
@@ -807,14 +2716,15 @@ async def start_search_for_user(user_id: int, context: ContextTypes.DEFAULT_TYPE
 
 💬 Start chatting now!
 """,
-                reply_markup=buttons
+                reply_markup=buttons,
+                priority=PRIORITY_NOTICE
             )
         
         # Notify partner
-        try:
-            await context.bot.send_message(
-                partner_id,
-                f"""
+        outbox.post(
+            context.bot.send_message,
+            partner_id,
+            f"""
 🎉 Match Found!
 
 👤 Partner: {my_nick}
@@ -822,14 +2732,13 @@ async def start_search_for_user(user_id: int, context: ContextTypes.DEFAULT_TYPE
 
 💬 Start chatting now!
 """,
-                reply_markup=buttons
-            )
-        except:
-            pass
+            reply_markup=buttons,
+            priority=PRIORITY_NOTICE
+        )
         
         return True
     else:
-        # No match found, show waiting message
+        # No match yet; the matchmaker's sweep tries again in the background
         waiting_count = cm.get_waiting_count() - 1
         filter_display = user_data.get('search_filter_display', 'Random')
         
@@ -850,7 +2759,8 @@ Please wait...
                 reply_markup=cancel_btn
             )
         else:
-            await context.bot.send_message(
+            await outbox.send(
+                context.bot.send_message,
                 user_id,
                 f"""
 🔍 Searching ({filter_display})
@@ -860,10 +2770,79 @@ Please wait...
 
 Please wait...
 """,
-                reply_markup=cancel_btn
+                reply_markup=cancel_btn,
+                priority=PRIORITY_NOTICE
             )
         return False
 
+# ==================== MESSAGE RELAY ====================
+# 'nickname' prefixes relayed texts and captions with the sender's nickname,
+# 'none' relays every message exactly as it was sent
+RELAY_ATTRIBUTION = os.getenv('RELAY_ATTRIBUTION', 'nickname').lower()
+
+TEXT_LIMIT = 4096
+CAPTION_LIMIT = 1024
+
+def _utf16_len(text: str) -> int:
+    """Telegram measures entity offsets in UTF-16 code units"""
+    return len(text.encode('utf-16-le')) // 2
+
+def _shift_entities(entities, shift: int) -> Optional[List[MessageEntity]]:
+    if not entities:
+        return None
+    return [
+        MessageEntity(
+            type=entity.type,
+            offset=entity.offset + shift,
+            length=entity.length,
+            url=entity.url,
+            user=entity.user,
+            language=entity.language,
+            custom_emoji_id=entity.custom_emoji_id
+        )
+        for entity in entities
+    ]
+
+async def relay_message(bot, message, partner_id: int, nickname: str):
+    """Relay any kind of message to the partner with a single API call.
+    
+    Everything goes through copy_message, which keeps formatting and works for
+    every message type. The nickname is only added where the message can carry
+    it (text or caption) and the result still fits Telegram's length limits.
+    """
+    prefix = f"{nickname}: " if RELAY_ATTRIBUTION == 'nickname' else ""
+    
+    if prefix and message.text is not None:
+        if _utf16_len(prefix + message.text) <= TEXT_LIMIT:
+            return await outbox.send(
+                bot.send_message,
+                partner_id,
+                prefix + message.text,
+                entities=_shift_entities(message.entities, _utf16_len(prefix))
+            )
+    
+    elif prefix and (message.photo or message.video or message.animation or
+                     message.document or message.audio or message.voice):
+        caption = prefix + message.caption if message.caption else nickname
+        if _utf16_len(caption) <= CAPTION_LIMIT:
+            return await outbox.send(
+                bot.copy_message,
+                partner_id,
+                message.chat_id,
+                message.message_id,
+                caption=caption,
+                caption_entities=_shift_entities(message.caption_entities, _utf16_len(prefix))
+            )
+    
+    return await outbox.send(bot.copy_message, partner_id, message.chat_id, message.message_id)
+
+def observe_relay(started: float, db_time: float, sending: float):
+    """Record one relay: profile lookup, the send itself and the whole handler"""
+    now = time.monotonic()
+    relay_seconds.observe(db_time, stage='db')
+    relay_seconds.observe(now - sending, stage='telegram')
+    relay_seconds.observe(now - started, stage='total')
+
 # ==================== MAIN COMMANDS - SIMPLIFIED ====================
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Start command with auto-registration"""
@@ -871,13 +2850,13 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     
     # Update last active
-    db.update_stats(user_id, 'last_active')
+    stats_buffer.add(user_id, 'last_active')
     
-    user_data = db.get_user(user_id)
+    user_data = await user_cache.get(user_id)
     
     if not user_data:
         # Auto-register the user
-        user_data = auto_register_user(user_id, user)
+        user_data = await auto_register_user(user_id, user)
         
         message = f"""
 🎉 Welcome to Bondly Bot v{BOT_VERSION}
@@ -931,11 +2910,11 @@ Ready to chat with new people?
 async def search(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Search for partner - with auto-registration if needed"""
     user_id = update.effective_user.id
-    user_data = db.get_user(user_id)
+    user_data = await user_cache.get(user_id)
     
     # Auto-register if not registered
     if not user_data:
-        user_data = auto_register_user(user_id, update.effective_user)
+        user_data = await auto_register_user(user_id, update.effective_user)
         await update.message.reply_text("✅ You have been automatically registered!")
     
     chat_id, chat = cm.get_chat(user_id)
@@ -951,7 +2930,9 @@ async def search(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     search_msg = await update.message.reply_text("🔄 Starting search...")
     
-    success, message = cm.add_to_waiting(user_id, user_data)
+    # Everything matching needs is fetched up front so find_match does no I/O
+    stats = await stats_buffer.get_stats(user_id)
+    success, message = cm.add_to_waiting(user_id, user_data, stats.get('chats_started', 0))
     
     if not success:
         await search_msg.edit_text(f"❌ {message}")
@@ -995,10 +2976,10 @@ async def search(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         
         # Notify partner
-        try:
-            await context.bot.send_message(
-                partner_id,
-                f"""
+        outbox.post(
+            context.bot.send_message,
+            partner_id,
+            f"""
 🎉 Match Found!
 
 👤 Partner: {my_nick}
@@ -1006,11 +2987,11 @@ async def search(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 💬 Start chatting now!
 """,
-                reply_markup=buttons
-            )
-        except:
-            pass
+            reply_markup=buttons,
+            priority=PRIORITY_NOTICE
+        )
     else:
+        # No match yet; the matchmaker's sweep tries again in the background
         waiting_count = cm.get_waiting_count() - 1
         filter_display = user_data.get('search_filter_display', 'Random')
         
@@ -1033,6 +3014,7 @@ Please wait...
 async def handle_media(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle media messages"""
     user_id = update.effective_user.id
+    started = time.monotonic()
     
     chat_id, chat = cm.get_chat(user_id)
     if not chat:
@@ -1044,56 +3026,28 @@ async def handle_media(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ Partner not found. The chat may have ended.")
         return
     
-    user_data = db.get_user(user_id)
+    db_started = time.monotonic()
+    user_data = await user_cache.get(user_id)
     nickname = user_data.get('nickname', 'User') if user_data else 'User'
+    db_time = time.monotonic() - db_started
     
     try:
-        await context.bot.send_chat_action(chat_id=partner['id'], action="typing")
+        typing_indicator.ping(context.bot, partner.id)
         
-        if update.message.photo:
-            photo = update.message.photo[-1]
-            caption = update.message.caption or ""
-            
-            await context.bot.send_photo(
-                partner['id'],
-                photo.file_id,
-                caption=f"📸 Photo from {nickname}: {caption}" if caption else f"📸 Photo from {nickname}"
-            )
-            
-            cm.record_message(chat_id, user_id, is_media=True)
-            db.update_stats(user_id, 'media_sent')
-            
-        elif update.message.video:
-            video = update.message.video
-            caption = update.message.caption or ""
-            
-            await context.bot.send_video(
-                partner['id'],
-                video.file_id,
-                caption=f"🎬 Video from {nickname}: {caption}" if caption else f"🎬 Video from {nickname}"
-            )
-            
-            cm.record_message(chat_id, user_id, is_media=True)
-            db.update_stats(user_id, 'media_sent')
-            
-        elif update.message.voice:
-            voice = update.message.voice
-            
-            await context.bot.send_voice(
-                partner['id'],
-                voice.file_id,
-                caption=f"🎤 Voice message from {nickname}"
-            )
-            
-            cm.record_message(chat_id, user_id, is_media=True)
-            db.update_stats(user_id, 'media_sent')
-            
-        elif update.message.sticker:
-            await context.bot.send_sticker(partner['id'], update.message.sticker.file_id)
-            cm.record_message(chat_id, user_id, is_media=True)
-            db.update_stats(user_id, 'media_sent')
+        if update.message.media_group_id:
+            media_groups.add(context.bot, update.message, user_id, partner.id, chat_id, nickname)
+            return
+        
+        # A buffered album from this user must reach the partner first
+        await media_groups.flush_sender(user_id)
         
-        db.update_stats(partner['id'], 'messages_received')
+        sending = time.monotonic()
+        await relay_message(context.bot, update.message, partner.id, nickname)
+        observe_relay(started, db_time, sending)
+        
+        cm.record_message(chat_id, user_id, is_media=True)
+        stats_buffer.add(user_id, 'media_sent')
+        stats_buffer.add(partner.id, 'messages_received')
         
     except Exception as e:
         logger.error(f"Failed to send media: {e}")
@@ -1103,6 +3057,7 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle text messages"""
     user_id = update.effective_user.id
     text = update.message.text
+    started = time.monotonic()
     
     if text in ["🔍 Find Partner", "📊 Statistics", "👤 Profile", "⚙️ Settings", "❓ Help"]:
         await handle_menu(update, context)
@@ -1118,18 +3073,23 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ Partner not found. The chat may have ended.")
         return
     
-    user_data = db.get_user(user_id)
+    db_started = time.monotonic()
+    user_data = await user_cache.get(user_id)
     nickname = user_data.get('nickname', 'User') if user_data else 'User'
+    db_time = time.monotonic() - db_started
     
     try:
-        await context.bot.send_chat_action(chat_id=partner['id'], action="typing")
+        typing_indicator.ping(context.bot, partner.id)
+        await media_groups.flush_sender(user_id)
         
-        await context.bot.send_message(partner['id'], f"{nickname}: {text}")
+        sending = time.monotonic()
+        await relay_message(context.bot, update.message, partner.id, nickname)
+        observe_relay(started, db_time, sending)
         
         cm.record_message(chat_id, user_id)
         
-        db.update_stats(user_id, 'messages_sent')
-        db.update_stats(partner['id'], 'messages_received')
+        stats_buffer.add(user_id, 'messages_sent')
+        stats_buffer.add(partner.id, 'messages_received')
         
     except Exception as e:
         logger.error(f"Failed to send message: {e}")
@@ -1146,37 +3106,37 @@ async def leave(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show profile - with auto-registration if needed"""
     user_id = update.effective_user.id
-    user_data = db.get_user(user_id)
+    user_data = await user_cache.get(user_id)
     
     # Auto-register if not registered
     if not user_data:
-        user_data = auto_register_user(user_id, update.effective_user)
+        user_data = await auto_register_user(user_id, update.effective_user)
         await update.message.reply_text("✅ You have been automatically registered!")
     
-    profile_text = format_profile(user_id, user_data)
+    profile_text = await format_profile(user_id, user_data)
     await update.message.reply_text(profile_text)
 
 async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show statistics - with auto-registration if needed"""
     user_id = update.effective_user.id
-    user_data = db.get_user(user_id)
+    user_data = await user_cache.get(user_id)
     
     # Auto-register if not registered
     if not user_data:
-        user_data = auto_register_user(user_id, update.effective_user)
+        user_data = await auto_register_user(user_id, update.effective_user)
         await update.message.reply_text("✅ You have been automatically registered!")
     
-    stats_text = format_stats(user_id, user_data)
+    stats_text = await format_stats(user_id, user_data)
     await update.message.reply_text(stats_text)
 
 async def nickname_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Change nickname - with auto-registration if needed"""
     user_id = update.effective_user.id
-    user_data = db.get_user(user_id)
+    user_data = await user_cache.get(user_id)
     
     # Auto-register if not registered
     if not user_data:
-        user_data = auto_register_user(user_id, update.effective_user)
+        user_data = await auto_register_user(user_id, update.effective_user)
         await update.message.reply_text("✅ You have been automatically registered!")
     
     if not context.args:
@@ -1205,18 +3165,18 @@ async def nickname_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_data['nickname'] = new_nick
     
     # Save the updated user data
-    db.save_user(user_id, user_data)
+    await user_cache.save(user_id, user_data)
     
     await update.message.reply_text(f"✅ Nickname updated from '{old_nick}' to '{new_nick}'")
 
 async def gender_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Set or change gender - OPTIONAL command"""
     user_id = update.effective_user.id
-    user_data = db.get_user(user_id)
+    user_data = await user_cache.get(user_id)
     
     # Auto-register if not registered
     if not user_data:
-        user_data = auto_register_user(user_id, update.effective_user)
+        user_data = await auto_register_user(user_id, update.effective_user)
         await update.message.reply_text("✅ You have been automatically registered!")
     
     if not context.args:
@@ -1261,7 +3221,9 @@ async def gender_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_data['gender'] = gender_map[gender_text]['value']
     user_data['gender_display'] = gender_map[gender_text]['display']
     user_data['auto_registered'] = False
-    db.save_user(user_id, user_data)
+    await user_cache.save(user_id, user_data)
+    if cm.requeue(user_id, user_data):
+        matchmaker.notify(user_id)
     
     await update.message.reply_text(
         f"✅ Gender Updated!\n\n"
@@ -1271,11 +3233,11 @@ async def gender_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def filter_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Change search filter - with auto-registration if needed"""
     user_id = update.effective_user.id
-    user_data = db.get_user(user_id)
+    user_data = await user_cache.get(user_id)
     
     # Auto-register if not registered
     if not user_data:
-        user_data = auto_register_user(user_id, update.effective_user)
+        user_data = await auto_register_user(user_id, update.effective_user)
         await update.message.reply_text("✅ You have been automatically registered!")
     
     if not context.args:
@@ -1313,7 +3275,9 @@ async def filter_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     user_data['search_filter'] = filter_map[filter_text]['value']
     user_data['search_filter_display'] = filter_map[filter_text]['display']
-    db.save_user(user_id, user_data)
+    await user_cache.save(user_id, user_data)
+    if cm.requeue(user_id, user_data):
+        matchmaker.notify(user_id)
     
     await update.message.reply_text(
         f"✅ Filter Updated!\n\n"
@@ -1323,7 +3287,7 @@ async def filter_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def delete_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Delete account"""
     user_id = update.effective_user.id
-    user_data = db.get_user(user_id)
+    user_data = await user_cache.get(user_id)
     
     if not user_data:
         await update.message.reply_text("❌ You don't have an account!")
@@ -1346,15 +3310,15 @@ async def delete_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def blocked_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show blocked users - with auto-registration if needed"""
     user_id = update.effective_user.id
-    user_data = db.get_user(user_id)
+    user_data = await user_cache.get(user_id)
     
     # Auto-register if not registered
     if not user_data:
-        user_data = auto_register_user(user_id, update.effective_user)
+        user_data = await auto_register_user(user_id, update.effective_user)
         await update.message.reply_text("✅ You have been automatically registered!")
         return
     
-    blocked = db.get_blocked_users(user_id)
+    blocked = block_index.get_blocked_users(user_id)
     
     if not blocked:
         await update.message.reply_text("✅ You haven't blocked anyone yet.")
@@ -1379,11 +3343,11 @@ async def blocked_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def settings_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Settings menu - with auto-registration if needed"""
     user_id = update.effective_user.id
-    user_data = db.get_user(user_id)
+    user_data = await user_cache.get(user_id)
     
     # Auto-register if not registered
     if not user_data:
-        user_data = auto_register_user(user_id, update.effective_user)
+        user_data = await auto_register_user(user_id, update.effective_user)
         await update.message.reply_text("✅ You have been automatically registered!")
     
     settings_text = f"""
@@ -1501,13 +3465,12 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 # Notify current partner
                 partner = cm.get_partner(chat_id, user_id)
                 if partner:
-                    try:
-                        await context.bot.send_message(
-                            partner['id'],
-                            "🔄 Your partner wants to talk to someone else.\n\nPress 'Find Partner' to find someone new."
-                        )
-                    except:
-                        pass
+                    outbox.post(
+                        context.bot.send_message,
+                        partner.id,
+                        "🔄 Your partner wants to talk to someone else.\n\nPress 'Find Partner' to find someone new.",
+                        priority=PRIORITY_NOTICE
+                    )
                 
                 # End current chat
                 cm.end_chat(chat_id, "next")
@@ -1522,18 +3485,17 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             if chat:
                 partner = cm.get_partner(chat_id, user_id)
                 if partner:
-                    partner_nick = partner['data'].get('nickname', 'Unknown')
-                    db.block_user(user_id, partner['id'], partner_nick)
+                    partner_nick = partner.data.get('nickname', 'Unknown')
+                    await block_index.block_user(user_id, partner.id, partner_nick)
                 
                 # Notify partner
                 if partner:
-                    try:
-                        await context.bot.send_message(
-                            partner['id'],
-                            "🚫 Your partner blocked you.\n\nPress 'Find Partner' to find someone new."
-                        )
-                    except:
-                        pass
+                    outbox.post(
+                        context.bot.send_message,
+                        partner.id,
+                        "🚫 Your partner blocked you.\n\nPress 'Find Partner' to find someone new.",
+                        priority=PRIORITY_NOTICE
+                    )
                 
                 # End current chat
                 cm.end_chat(chat_id, "blocked")
@@ -1549,23 +3511,23 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await leave_chat_from_callback(user_id, context, query)
         
         elif data == "rate_good":
-            chat_id, chat = cm.get_chat(user_id)
-            if chat:
-                partner = cm.get_partner(chat_id, user_id)
-                if partner:
-                    db.update_stats(partner['id'], 'ratings_positive')
-                    await query.edit_message_text("✅ Rating submitted: Good 👍")
+            partner_id = cm.rating_target(user_id)
+            if partner_id:
+                stats_buffer.add(partner_id, 'ratings_positive')
+                await query.edit_message_text("✅ Rating submitted: Good 👍")
+            else:
+                await query.answer("No recent partner to rate.", show_alert=True)
         
         elif data == "rate_bad":
-            chat_id, chat = cm.get_chat(user_id)
-            if chat:
-                partner = cm.get_partner(chat_id, user_id)
-                if partner:
-                    db.update_stats(partner['id'], 'ratings_negative')
-                    await query.edit_message_text("✅ Rating submitted: Bad 👎")
+            partner_id = cm.rating_target(user_id)
+            if partner_id:
+                stats_buffer.add(partner_id, 'ratings_negative')
+                await query.edit_message_text("✅ Rating submitted: Bad 👎")
+            else:
+                await query.answer("No recent partner to rate.", show_alert=True)
         
         elif data == "confirm_delete":
-            user_data = db.get_user(user_id)
+            user_data = await user_cache.get(user_id)
             nickname = user_data.get('nickname', 'User') if user_data else 'User'
             
             cm.remove_from_waiting(user_id)
@@ -1574,7 +3536,12 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             if chat:
                 cm.end_chat(chat_id, "deleted")
             
-            db.delete_user(user_id)
+            # Stats rows go with the user, so they leave the global totals too
+            stats = await stats_buffer.get_stats(user_id) if user_data else None
+            await user_cache.delete(user_id)
+            block_index.forget_user(user_id)
+            if stats is not None:
+                stats_buffer.user_removed(user_id, stats)
             
             await query.edit_message_text(
                 f"✅ Account '{nickname}' deleted.\n\n"
@@ -1587,7 +3554,8 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         elif data.startswith("unblock_"):
             blocked_id = data.split("_")[1]
             
-            if db.unblock_user(user_id, int(blocked_id)):
+            if await block_index.unblock_user(user_id, int(blocked_id)):
+                matchmaker.notify(user_id, int(blocked_id))
                 await query.edit_message_text("✅ User unblocked.")
             else:
                 await query.edit_message_text("❌ User not found in blocked list.")
@@ -1602,13 +3570,15 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             }
             
             if filter_type in filter_map:
-                user_data = db.get_user(user_id)
+                user_data = await user_cache.get(user_id)
                 if not user_data:
-                    user_data = auto_register_user(user_id, query.from_user)
+                    user_data = await auto_register_user(user_id, query.from_user)
                 
                 user_data['search_filter'] = filter_map[filter_type]['value']
                 user_data['search_filter_display'] = filter_map[filter_type]['display']
-                db.save_user(user_id, user_data)
+                await user_cache.save(user_id, user_data)
+                if cm.requeue(user_id, user_data):
+                    matchmaker.notify(user_id)
                 
                 await query.edit_message_text(
                     f"✅ Filter updated to {filter_map[filter_type]['display']}"
@@ -1625,14 +3595,16 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             }
             
             if gender_type in gender_map:
-                user_data = db.get_user(user_id)
+                user_data = await user_cache.get(user_id)
                 if not user_data:
-                    user_data = auto_register_user(user_id, query.from_user)
+                    user_data = await auto_register_user(user_id, query.from_user)
                 
                 user_data['gender'] = gender_map[gender_type]['value']
                 user_data['gender_display'] = gender_map[gender_type]['display']
                 user_data['auto_registered'] = False
-                db.save_user(user_id, user_data)
+                await user_cache.save(user_id, user_data)
+                if cm.requeue(user_id, user_data):
+                    matchmaker.notify(user_id)
                 
                 await query.edit_message_text(
                     f"✅ Gender updated to {gender_map[gender_type]['display']}"
@@ -1646,66 +3618,408 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             pass
 
 # ==================== CLEANUP TASK ====================
-async def cleanup_task(context: ContextTypes.DEFAULT_TYPE):
-    """Periodic cleanup"""
+CLEANUP_INTERVAL = float(os.getenv('CLEANUP_INTERVAL', '1'))
+
+async def cleanup_task(bot):
+    """Expire searches and chats whose deadline has passed"""
     try:
-        now = datetime.now()
-        users_to_remove = []
-        
-        for user_id, user_info in cm.waiting.items():
-            try:
-                joined_time = datetime.fromisoformat(user_info.get('joined', ''))
-                if (now - joined_time).seconds > 300:
-                    users_to_remove.append(user_id)
-            except:
-                pass
-        
+        users_to_remove = cm.expire_searches()
         for user_id in users_to_remove:
-            cm.remove_from_waiting(user_id)
-            
-            try:
-                await context.bot.send_message(
-                    user_id,
-                    "❌ Search cancelled due to inactivity.\n"
-                    "Press 'Find Partner' to search again."
-                )
-            except:
-                pass
+            outbox.post(
+                bot.send_message,
+                user_id,
+                "❌ Search cancelled due to inactivity.\n"
+                "Press 'Find Partner' to search again.",
+                priority=PRIORITY_BULK
+            )
         
-        chats_to_end = []
-        for chat_id, chat in cm.active_chats.items():
-            if not chat.get('active'):
-                continue
-            
-            try:
-                last_message = chat.get('last_message', chat.get('created', ''))
-                last_time = datetime.fromisoformat(last_message)
-                if (now - last_time).seconds > 1800:
-                    chats_to_end.append(chat_id)
-            except:
-                pass
+        chats_ended = cm.expire_chats()
+        for chat in chats_ended:
+            for user_info in [chat.user1, chat.user2]:
+                outbox.post(
+                    bot.send_message,
+                    user_info.id,
+                    "❌ Chat ended due to inactivity.",
+                    priority=PRIORITY_BULK
+                )
         
-        for chat_id in chats_to_end:
-            cm.end_chat(chat_id, "inactive")
-            
-            chat = cm.active_chats.get(chat_id)
-            if chat:
-                for user_info in [chat['user1'], chat['user2']]:
-                    try:
-                        await context.bot.send_message(
-                            user_info['id'],
-                            "❌ Chat ended due to inactivity."
-                        )
-                    except:
-                        pass
-        
-        if users_to_remove or chats_to_end:
-            logger.info(f"Cleanup: Removed {len(users_to_remove)} users, ended {len(chats_to_end)} chats")
+        if users_to_remove or chats_ended:
+            logger.info(f"Cleanup: Removed {len(users_to_remove)} users, ended {len(chats_ended)} chats")
     
     except Exception as e:
         logger.error(f"Cleanup error: {e}")
 
+async def cleanup_loop(bot):
+    """Runs cleanup_task every CLEANUP_INTERVAL seconds; each tick only touches due entries"""
+    last_pool_check = time.monotonic()
+    while True:
+        await asyncio.sleep(CLEANUP_INTERVAL)
+        await cleanup_task(bot)
+        
+        if time.monotonic() - last_pool_check >= 60:
+            last_pool_check = time.monotonic()
+            db_metrics = adb.metrics()
+            if db_metrics['queued']:
+                logger.warning(f"DB pool saturated: {db_metrics}")
+
+# ==================== UPDATE PROCESSOR ====================
+# How many updates may be handled at once (1 restores strictly sequential handling)
+UPDATE_CONCURRENCY = int(os.getenv('UPDATE_CONCURRENCY', '64'))
+
+class PairOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Runs updates concurrently while keeping each chat pair in order.
+    
+    An update holds the lock of its sender and, while they are chatting, of
+    their partner. Locks are taken in ascending user id order, so two updates
+    from the same pair never overlap and relayed messages keep their order,
+    while unrelated users are handled in parallel.
+    
+    The pair locks are taken before one of the ``max_concurrent_updates``
+    slots, so updates queued behind a busy pair (a user flooding a chat
+    whose sends wait on the outbox) cannot fill every slot and stall
+    unrelated pairs.
+    """
+    
+    def __init__(self, chat_manager, max_concurrent_updates: int = UPDATE_CONCURRENCY):
+        super().__init__(max(1, max_concurrent_updates))
+        self.chat_manager = chat_manager
+        self.locks: Dict[int, asyncio.Lock] = {}
+        self.lock_users: Dict[int, int] = {}
+        self.running = 0
+        self.waiting = 0
+        self.peak_running = 0
+        self.processed = 0
+        self.errors = 0
+        self.wait_time = 0.0
+    
+    def _keys(self, update) -> List[int]:
+        user = getattr(update, 'effective_user', None)
+        if user is None:
+            return []
+        keys = {user.id}
+        partner_id = self.chat_manager.partner_id(user.id)
+        if partner_id:
+            keys.add(partner_id)
+        return sorted(keys)
+    
+    def _acquire_ref(self, key: int) -> asyncio.Lock:
+        lock = self.locks.get(key)
+        if lock is None:
+            lock = self.locks[key] = asyncio.Lock()
+        self.lock_users[key] = self.lock_users.get(key, 0) + 1
+        return lock
+    
+    def _release_ref(self, key: int):
+        remaining = self.lock_users[key] - 1
+        if remaining:
+            self.lock_users[key] = remaining
+        else:
+            del self.lock_users[key]
+            del self.locks[key]
+    
+    async def process_update(self, update, coroutine):
+        keys = self._keys(update)
+        locks = [self._acquire_ref(key) for key in keys]
+        held = []
+        
+        started = time.monotonic()
+        self.waiting += 1
+        try:
+            try:
+                for lock in locks:
+                    await lock.acquire()
+                    held.append(lock)
+            finally:
+                self.waiting -= 1
+                self.wait_time += time.monotonic() - started
+            
+            # Only now wait for a concurrency slot (do_process_update runs in it)
+            await super().process_update(update, coroutine)
+        finally:
+            for lock in reversed(held):
+                lock.release()
+            for key in keys:
+                self._release_ref(key)
+            if len(held) < len(locks):
+                # Cancelled while queued for the pair; never ran
+                coroutine.close()
+    
+    async def do_process_update(self, update, coroutine):
+        self.running += 1
+        self.peak_running = max(self.peak_running, self.running)
+        try:
+            await coroutine
+        except Exception:
+            self.errors += 1
+            raise
+        finally:
+            self.running -= 1
+            self.processed += 1
+    
+    async def initialize(self):
+        pass
+    
+    async def shutdown(self):
+        pass
+    
+    def metrics(self) -> Dict:
+        return {
+            'max_concurrency': self.max_concurrent_updates,
+            'running': self.running,
+            'waiting_for_order': self.waiting,
+            'peak_running': self.peak_running,
+            'processed': self.processed,
+            'errors': self.errors,
+            'avg_order_wait_ms': round(self.wait_time / self.processed * 1000, 2) if self.processed else 0.0,
+        }
+
+update_processor = PairOrderedUpdateProcessor(cm)
+
+# ==================== METRICS COLLECTION ====================
+METRICS_SAMPLE_INTERVAL = float(os.getenv('METRICS_SAMPLE_INTERVAL', '0.5'))
+METRICS_RATE_WINDOW = float(os.getenv('METRICS_RATE_WINDOW', '10'))
+# /metrics gets its own listener, only when METRICS_PORT is set and never on
+# the public webhook port; keep METRICS_HOST on loopback unless it is firewalled
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+
+waiting_users = metrics.gauge('waiting_users', 'Users searching for a partner, by search filter')
+active_chats = metrics.gauge('active_chats', 'Chats currently open')
+db_ops_total = metrics.counter('db_ops_total', 'Database calls completed')
+db_errors_total = metrics.counter('db_errors_total', 'Database statements that failed')
+db_ops_per_second = metrics.gauge('db_ops_per_second', 'Database calls completed per second over METRICS_RATE_WINDOW')
+db_pool_busy = metrics.gauge('db_pool_busy', 'Database calls running or queued for a worker, by state')
+sends_total = metrics.counter('sends_total', 'Bot API sends delivered by the outbox')
+send_errors_total = metrics.counter('send_errors_total', 'Bot API sends given up on, by error type')
+send_retries_total = metrics.counter('send_retries_total', 'Bot API sends retried after RetryAfter or a connection error')
+send_queue = metrics.gauge('send_queue', 'Outbound sends queued or in flight, by state')
+updates_total = metrics.counter('updates_total', 'Updates handled')
+updates_running = metrics.gauge('updates_running', 'Updates running or waiting for their chat pair, by state')
+event_loop_lag_max_seconds = metrics.gauge('event_loop_lag_max_seconds', 'Worst event-loop lag over METRICS_RATE_WINDOW')
+
+@metrics.collector
+def collect_state():
+    with cm.match_lock:
+        counts = cm.waiting.counts_by_filter()
+    # Filters that emptied since the last scrape must read 0, not their old value
+    for search_filter in {'random', 'male', 'female', *counts}:
+        waiting_users.set(counts.get(search_filter, 0), filter=search_filter)
+    active_chats.set(cm.get_active_chat_count())
+    
+    db_metrics = adb.metrics()
+    db_ops_total.set(db_metrics['completed'])
+    db_errors_total.set(db_metrics['errors'])
+    db_pool_busy.set(db_metrics['running'], state='running')
+    db_pool_busy.set(db_metrics['queued'], state='queued')
+    
+    send_metrics = outbox.metrics()
+    sends_total.set(send_metrics['sent'])
+    send_retries_total.set(send_metrics['retried'])
+    for error, count in send_metrics['errors'].items():
+        send_errors_total.set(count, error=error)
+    send_queue.set(send_metrics['queued'], state='queued')
+    send_queue.set(send_metrics['in_flight'], state='in_flight')
+    
+    updates_total.set(update_processor.processed)
+    updates_running.set(update_processor.running, state='running')
+    updates_running.set(update_processor.waiting, state='waiting_for_order')
+
+async def metrics_sampler(interval: float = METRICS_SAMPLE_INTERVAL, window: float = METRICS_RATE_WINDOW):
+    """Measure event-loop lag and the database call rate.
+    
+    The task asks to wake up every ``interval`` seconds; how late it actually
+    wakes is the time other callbacks held the loop.
+    """
+    loop = asyncio.get_running_loop()
+    samples = deque(maxlen=max(2, int(window / interval) + 1))
+    
+    while True:
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        now = loop.time()
+        lag = max(0.0, now - expected)
+        event_loop_lag_seconds.observe(lag)
+        
+        samples.append((now, lag, adb.metrics()['completed']))
+        event_loop_lag_max_seconds.set(max(sample[1] for sample in samples))
+        first, last = samples[0], samples[-1]
+        if last[0] > first[0]:
+            db_ops_per_second.set(round((last[2] - first[2]) / (last[0] - first[0]), 2))
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(
+        text=metrics.render(),
+        headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+    )
+
+async def start_metrics_server(host: str = METRICS_HOST, port: int = METRICS_PORT) -> web.AppRunner:
+    """Serve /metrics on its own port, apart from the public webhook server"""
+    web_app = web.Application()
+    web_app.router.add_get('/metrics', handle_metrics)
+    runner = web.AppRunner(web_app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Metrics served on {host}:{port}/metrics")
+    return runner
+
+# ==================== WEBHOOK SERVER ====================
+# BOT_MODE=webhook serves updates over HTTP instead of long polling
+BOT_MODE = os.getenv('BOT_MODE', 'polling').lower()
+WEBHOOK_URL = os.getenv('WEBHOOK_URL') or os.getenv('RENDER_EXTERNAL_URL')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+# Telegram only accepts [A-Za-z0-9_-] in secret_token, and generated values
+# (base64 on Render) may contain +, / or =; send a hex digest of it instead
+if WEBHOOK_SECRET:
+    WEBHOOK_SECRET = hashlib.sha256(WEBHOOK_SECRET.encode()).hexdigest()
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('PORT', '8080'))
+
+class WebhookServer:
+    """aiohttp server that hands Telegram updates to the application queue.
+    
+    Requests are acknowledged as soon as the update is queued, so a slow
+    handler never holds up Telegram's delivery of the next one.
+    """
+    
+    def __init__(self, application: Application, path: str = WEBHOOK_PATH,
+                 secret: Optional[str] = WEBHOOK_SECRET,
+                 host: str = WEBHOOK_HOST, port: int = WEBHOOK_PORT):
+        self.application = application
+        self.path = path
+        self.secret = secret
+        self.host = host
+        self.port = port
+        self.runner = None
+        self.updates_received = 0
+        self.updates_rejected = 0
+        
+        self.web_app = web.Application()
+        self.web_app.router.add_post(self.path, self.handle_update)
+        self.web_app.router.add_get('/health', self.handle_health)
+        self.web_app.router.add_get('/', self.handle_health)
+    
+    async def handle_update(self, request: web.Request) -> web.Response:
+        if self.secret and request.headers.get('X-Telegram-Bot-Api-Secret-Token') != self.secret:
+            self.updates_rejected += 1
+            return web.Response(status=403)
+        
+        try:
+            data = await request.json()
+            update = Update.de_json(data, self.application.bot)
+        except Exception as e:
+            self.updates_rejected += 1
+            logger.warning(f"Rejected malformed webhook payload: {e}")
+            return web.Response(status=400)
+        
+        self.updates_received += 1
+        await self.application.update_queue.put(update)
+        return web.Response()
+    
+    async def handle_health(self, request: web.Request) -> web.Response:
+        return web.json_response({
+            'status': 'ok',
+            'version': BOT_VERSION,
+            'waiting': cm.get_waiting_count(),
+            'active_chats': cm.get_active_chat_count(),
+            'pending_updates': self.application.update_queue.qsize(),
+            'updates_received': self.updates_received,
+            'updates_rejected': self.updates_rejected,
+            'processing': update_processor.metrics(),
+            'outbox': outbox.metrics(),
+        })
+    
+    async def start(self):
+        self.runner = web.AppRunner(self.web_app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, self.host, self.port)
+        await site.start()
+        logger.info(f"Webhook server listening on {self.host}:{self.port}{self.path}")
+    
+    async def stop(self):
+        if self.runner:
+            await self.runner.cleanup()
+            self.runner = None
+
+async def run_webhook(app: Application):
+    """Run the application behind the embedded webhook server until SIGINT/SIGTERM"""
+    server = WebhookServer(app)
+    stop_event = asyncio.Event()
+    
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:
+            pass
+    
+    # run_polling normally drives these hooks; here we call them ourselves
+    try:
+        async with app:
+            await post_init(app)
+            await app.start()
+            try:
+                await server.start()
+                
+                if WEBHOOK_URL:
+                    await app.bot.set_webhook(
+                        url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+                        secret_token=WEBHOOK_SECRET,
+                        allowed_updates=Update.ALL_TYPES,
+                        drop_pending_updates=True
+                    )
+                    print(f"✅ Webhook set to {WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}")
+                else:
+                    print("⚠️ WEBHOOK_URL not set - serving locally without registering a webhook")
+                
+                await stop_event.wait()
+            finally:
+                await server.stop()
+                # Handlers still running await their sends, so the outbox
+                # drains once app.stop() has waited for them, as run_polling does
+                await app.stop()
+                await post_stop(app)
+    finally:
+        await post_shutdown(app)
+
 # ==================== MAIN ====================
+async def post_init(app: Application):
+    """Start background workers once the event loop is running"""
+    await block_index.load()
+    await stats_buffer.load_totals()
+    await outbox.start()
+    await matchmaker.start(app.bot)
+    await stats_buffer.start()
+    app.bot_data['cleanup_task'] = asyncio.create_task(cleanup_loop(app.bot))
+    app.bot_data['metrics_task'] = asyncio.create_task(metrics_sampler())
+    if METRICS_PORT:
+        app.bot_data['metrics_server'] = await start_metrics_server()
+
+async def post_stop(app: Application):
+    """Stop everything that sends, then drain the outbox.
+    
+    Runs after the last handler finished but before Application.shutdown()
+    closes the bot's HTTP client, so queued messages can still go out.
+    """
+    cleanup = app.bot_data.pop('cleanup_task', None)
+    if cleanup:
+        cleanup.cancel()
+    await matchmaker.stop()
+    await typing_indicator.stop()
+    await media_groups.stop()
+    await outbox.stop()
+
+async def post_shutdown(app: Application):
+    """Flush buffered state before the process exits"""
+    task = app.bot_data.pop('metrics_task', None)
+    if task:
+        task.cancel()
+    metrics_server = app.bot_data.pop('metrics_server', None)
+    if metrics_server:
+        await metrics_server.cleanup()
+    await stats_buffer.stop()
+    adb.shutdown()
+
 def main():
     import sys
     
@@ -1746,7 +4060,8 @@ def main():
     print("="*60)
     
     # ===== بخش جدید: بررسی وجود بات دیگر =====
-    print("🔍 Checking for other bot instances...")
+    if BOT_MODE != 'webhook':
+        print("🔍 Checking for other bot instances...")
     import asyncio
     from telegram import Bot
     
@@ -1766,7 +4081,8 @@ def main():
                 print(f"✅ Connection test passed: {e}")
                 return False
     
-    if asyncio.run(check_conflict()):
+    # Webhook mode never calls getUpdates, so there is nothing to conflict with
+    if BOT_MODE != 'webhook' and asyncio.run(check_conflict()):
         print("\n❌ STOPPING: Another bot instance detected!")
         print("Please:")
         print("1. Stop bot on your local computer (Ctrl+C)")
@@ -1776,7 +4092,15 @@ def main():
     
     # ===== ادامه کد اصلی =====
     # Create application
-    app = Application.builder().token(TOKEN).build()
+    app = (
+        Application.builder()
+        .token(TOKEN)
+        .concurrent_updates(update_processor)
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
     
     # Add handlers (همان کدهای قبلی...)
     app.add_handler(CommandHandler("start", start))
@@ -1803,7 +4127,7 @@ def main():
     
     # Media handlers
     app.add_handler(MessageHandler(
-        filters.PHOTO | filters.VIDEO | filters.VOICE | filters.Sticker.ALL,
+        filters.UpdateType.MESSAGE & ~filters.TEXT & ~filters.StatusUpdate.ALL,
         handle_media
     ))
     
@@ -1813,11 +4137,6 @@ def main():
         handle_text
     ))
     
-    # Add job queue for cleanup
-    job_queue = app.job_queue
-    if job_queue:
-        job_queue.run_repeating(cleanup_task, interval=60, first=30)
-    
     print("✅ Bot is ready!")
     print("="*60)
     print("🎯 Fixed Issues:")
@@ -1833,6 +4152,10 @@ def main():
     print("- If bot crashes, wait 60s before restarting")
     print("- Check logs in Render dashboard")
     
+    if BOT_MODE == 'webhook':
+        asyncio.run(run_webhook(app))
+        return
+    
     # Run bot با drop_pending_updates=True برای پاک کردن صف قدیمی
     app.run_polling(
         drop_pending_updates=True,  # این مهم است!
@@ -0,0 +1,55 @@
+"""Shared fixtures for the test suite.
+
+The bots are single-file scripts, so they are imported by path. v1.5 needs
+python-telegram-bot 13 and v1.6 needs 20; tests for a bot that cannot be
+imported in the current environment are skipped.
+
+    python -m pytest tests
+"""
+
+import importlib.util
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_bot(version: str, workdir: str):
+    """Import bondly_v<version>.py once per session, with ``workdir`` as its data directory"""
+    name = 'bondly_v' + version.replace('.', '_')
+    if name in sys.modules:
+        return sys.modules[name]
+    
+    os.environ.setdefault('BOT_TOKEN', '123456:test')
+    os.environ['DATABASE_URL'] = ''
+    
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        spec = importlib.util.spec_from_file_location(name, os.path.join(ROOT, f'bondly_v{version}.py'))
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[name] = module
+        try:
+            spec.loader.exec_module(module)
+        except Exception as e:
+            del sys.modules[name]
+            pytest.skip(f"bondly_v{version}.py could not be imported ({type(e).__name__}: {e})")
+        
+        if version == '1.5':
+            # The module-level store uses relative paths; stop it before leaving its directory
+            module.db.close()
+    finally:
+        os.chdir(cwd)
+    return module
+
+
+@pytest.fixture(scope='session')
+def bot15(tmp_path_factory):
+    return load_bot('1.5', str(tmp_path_factory.mktemp('bondly_v1_5')))
+
+
+@pytest.fixture(scope='session')
+def bot16(tmp_path_factory):
+    return load_bot('1.6', str(tmp_path_factory.mktemp('bondly_v1_6')))
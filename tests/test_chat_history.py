@@ -0,0 +1,48 @@
+import gzip
+import json
+import os
+from datetime import datetime
+
+
+def write_segment(directory, name, chats):
+    with open(os.path.join(directory, name), 'w') as f:
+        for chat in chats:
+            f.write(json.dumps(chat) + '\n')
+
+
+def test_segment_being_compressed_is_read_once(bot15, tmp_path):
+    directory = str(tmp_path / 'chat_history')
+    os.makedirs(directory)
+    chats = [{'chat_id': f'chat_{n}', 'ended': f'2024-01-01T10:0{n}:00'} for n in range(3)]
+    write_segment(directory, 'chats-20240101-0001.jsonl', chats)
+    # Compression finished but the plain file is not removed yet
+    with gzip.open(os.path.join(directory, 'chats-20240101-0001.jsonl.gz'), 'wt') as f:
+        f.writelines(json.dumps(chat) + '\n' for chat in chats)
+    
+    log = bot15.ChatHistoryLog(directory, legacy_file=str(tmp_path / 'none.json'), compress=False)
+    try:
+        assert [chat['chat_id'] for chat in log.iter_chats()] == ['chat_0', 'chat_1', 'chat_2']
+    finally:
+        log.close()
+
+
+def test_since_filters_each_chat(bot15, tmp_path):
+    directory = str(tmp_path / 'chat_history')
+    os.makedirs(directory)
+    write_segment(directory, 'chats-20240101-0001.jsonl', [
+        {'chat_id': 'old', 'ended': '2024-01-01T09:00:00'},
+        {'chat_id': 'new', 'ended': '2024-01-01T15:00:00'},
+    ])
+    write_segment(directory, 'chats-20231231-0001.jsonl', [
+        {'chat_id': 'older', 'ended': '2023-12-31T23:00:00'},
+    ])
+    with open(tmp_path / 'legacy.json', 'w') as f:
+        json.dump([{'chat_id': 'legacy', 'ended': '2024-01-01T12:00:00'}], f)
+    
+    log = bot15.ChatHistoryLog(directory, legacy_file=str(tmp_path / 'legacy.json'), compress=False)
+    try:
+        since = datetime(2024, 1, 1, 12, 0)
+        assert [chat['chat_id'] for chat in log.iter_chats(since)] == ['legacy', 'new']
+        assert len(list(log.iter_chats())) == 4
+    finally:
+        log.close()
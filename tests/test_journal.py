@@ -0,0 +1,82 @@
+import os
+import threading
+import time
+
+
+def open_db(bot15):
+    return bot15.ProfessionalDB(flush_interval=3600, flush_threshold=10**9)
+
+
+def crash(db):
+    """Abandon the store like a killed process: no final compaction, files just closed"""
+    db._closed.set()
+    db._journal.close()
+    db.history.close()
+
+
+def test_torn_tail_is_cut_before_the_next_append(bot15, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    with open('db.journal', 'w') as f:
+        f.write('{"op": "user", "id": 1, "da')
+    
+    db = open_db(bot15)
+    assert db.get_user(1) is None
+    db.save_user(2, {'nickname': 'two'})
+    crash(db)
+    
+    db = open_db(bot15)
+    assert db.get_user(2) == {'nickname': 'two'}
+    db.save_user(3, {'nickname': 'three'})
+    crash(db)
+    
+    db = open_db(bot15)
+    assert db.get_user(2) == {'nickname': 'two'}
+    assert db.get_user(3) == {'nickname': 'three'}
+    db.close()
+
+
+def test_records_are_replayed_after_a_crash(bot15, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    db = open_db(bot15)
+    db.save_user(1, {'nickname': 'one'})
+    db.update_stats(1, 'messages_sent', 3)
+    db.block_user(1, 2, 'two')
+    crash(db)
+    
+    db = open_db(bot15)
+    assert db.get_user(1) == {'nickname': 'one'}
+    assert db.get_stats(1)['messages_sent'] == 3
+    assert db.is_blocked(1, 2)
+    assert not os.path.exists('db.journal.old')
+    db.close()
+
+
+def test_close_waits_for_a_running_compaction(bot15, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    db = open_db(bot15)
+    write_snapshot = db._write_snapshot
+    running = []
+    overlaps = []
+    
+    def slow_write(path, snapshot):
+        overlaps.append(len(running))
+        running.append(path)
+        time.sleep(0.05)
+        write_snapshot(path, snapshot)
+        running.remove(path)
+    
+    db._write_snapshot = slow_write
+    db.save_user(1, {'nickname': 'one'})
+    flusher = threading.Thread(target=db.flush)
+    flusher.start()
+    time.sleep(0.01)
+    db.save_user(2, {'nickname': 'two'})
+    db.close()
+    flusher.join()
+    
+    assert overlaps and not any(overlaps)
+    assert not os.path.exists('db.journal.old')
+    db = open_db(bot15)
+    assert db.get_user(1) == {'nickname': 'one'}
+    assert db.get_user(2) == {'nickname': 'two'}
+    db.close()
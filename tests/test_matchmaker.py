@@ -0,0 +1,32 @@
+def waiting_pool(bot16, profiles):
+    manager = bot16.ProfessionalChatManager()
+    for user_id, (gender, search_filter) in profiles.items():
+        manager.add_to_waiting(user_id, {'gender': gender, 'search_filter': search_filter})
+    return manager
+
+
+def test_round_pairs_a_user_after_a_filter_change(bot16):
+    manager = waiting_pool(bot16, {1: ('male', 'female'), 2: ('male', 'random')})
+    matchmaker = bot16.Matchmaker(manager, batch=10)
+    
+    assert manager.find_match(1) is None
+    manager.requeue(1, {'gender': 'male', 'search_filter': 'random'})
+    matchmaker.notify(1)
+    
+    matches = manager.match_round(matchmaker._next_batch())
+    assert [{match['user1'], match['user2']} for match in matches] == [{1, 2}]
+    assert manager.partner_id(1) == 2
+
+
+def test_round_plans_at_most_one_batch(bot16):
+    # Nobody can pair: everyone wants a woman and only men are waiting
+    manager = waiting_pool(bot16, {uid: ('male', 'female') for uid in range(1, 101)})
+    matchmaker = bot16.Matchmaker(manager, batch=30)
+    matchmaker.notify(7)
+    
+    batch = matchmaker._next_batch()
+    assert len(batch) == 30
+    assert batch[0] == 7
+    assert len(matchmaker.sweep) == 71
+    
+    assert manager.waiting.plan_round(batch) == []
@@ -0,0 +1,72 @@
+import asyncio
+
+import pytest
+
+
+def run_send(bot16, send_message):
+    async def main():
+        outbox = bot16.SendScheduler(global_rate=100, chat_rate=100, chat_burst=10, max_retries=3)
+        await outbox.start()
+        try:
+            return await asyncio.wait_for(outbox.send(send_message, 1, 'hello'), timeout=5)
+        finally:
+            await outbox.stop()
+    
+    return asyncio.run(main())
+
+
+def test_timed_out_send_is_attempted_once(bot16):
+    calls = []
+    
+    async def send_message(chat_id, text):
+        calls.append(text)
+        raise bot16.TimedOut()
+    
+    with pytest.raises(bot16.TimedOut):
+        run_send(bot16, send_message)
+    assert calls == ['hello']
+
+
+def test_forbidden_send_is_attempted_once(bot16):
+    calls = []
+    
+    async def send_message(chat_id, text):
+        calls.append(text)
+        raise bot16.Forbidden('blocked by the user')
+    
+    with pytest.raises(bot16.Forbidden):
+        run_send(bot16, send_message)
+    assert calls == ['hello']
+
+
+def test_retry_after_is_retried(bot16):
+    calls = []
+    
+    async def send_message(chat_id, text):
+        calls.append(text)
+        if len(calls) == 1:
+            raise bot16.RetryAfter(0)
+        return 'sent'
+    
+    assert run_send(bot16, send_message) == 'sent'
+    assert calls == ['hello', 'hello']
+
+
+def test_stop_cancels_sends_still_in_flight(bot16):
+    async def send_message(chat_id, text):
+        await asyncio.sleep(3600)
+    
+    async def main():
+        outbox = bot16.SendScheduler(global_rate=100, chat_rate=100, chat_burst=10)
+        await outbox.start()
+        sent = outbox.post(send_message, 1, 'hello')
+        await asyncio.sleep(0.05)
+        assert len(outbox.tasks) == 1
+        
+        await asyncio.wait_for(outbox.stop(timeout=0.1), timeout=5)
+        return outbox, sent
+    
+    outbox, sent = asyncio.run(main())
+    assert sent.cancelled()
+    assert not outbox.tasks
+    assert outbox.in_flight == 0
@@ -0,0 +1,67 @@
+import asyncio
+
+
+class SlowStatsDB:
+    """Stands in for AsyncDB: stats rows in a dict, batches held until released"""
+    
+    def __init__(self, columns):
+        self.columns = columns
+        self.rows = {}
+        self.release = asyncio.Event()
+    
+    async def get_stats(self, user_id):
+        return dict(self.rows.get(user_id, {}))
+    
+    async def apply_stats_batch(self, rows):
+        await self.release.wait()
+        for user_id, *deltas, _touched in rows:
+            row = self.rows.setdefault(user_id, {})
+            for column, value in zip(self.columns, deltas):
+                row[column] = row.get(column, 0) + value
+        return True
+
+
+def test_render_during_a_slow_flush_is_not_undercounted(bot16, monkeypatch):
+    user = {'nickname': 'one', 'registered': '2024-01-01T00:00:00'}
+    
+    async def main():
+        database = SlowStatsDB(bot16.STAT_COLUMNS)
+        stats = bot16.StatsAggregator(database, flush_interval=3600, flush_threshold=10**9)
+        monkeypatch.setattr(bot16, 'stats_buffer', stats)
+        monkeypatch.setattr(bot16, 'render_cache', bot16.RenderCache())
+        
+        for _ in range(3):
+            stats.add(1, 'messages_sent')
+        flush = asyncio.create_task(stats.flush())
+        await asyncio.sleep(0)
+        
+        during = await bot16.format_profile(1, user)
+        database.release.set()
+        assert await flush == 1
+        after = await bot16.format_profile(1, user)
+        
+        stats.add(1, 'messages_sent')
+        latest = await bot16.format_profile(1, user)
+        return during, after, latest
+    
+    during, after, latest = asyncio.run(main())
+    assert 'Sent: 3' in during
+    assert 'Sent: 3' in after
+    assert 'Sent: 4' in latest
+
+
+def test_failed_flush_keeps_the_deltas(bot16):
+    class FailingDB(SlowStatsDB):
+        async def apply_stats_batch(self, rows):
+            return False
+    
+    async def main():
+        stats = bot16.StatsAggregator(FailingDB(bot16.STAT_COLUMNS), flush_interval=3600,
+                                      flush_threshold=10**9)
+        stats.add(1, 'messages_sent', 2)
+        assert await stats.flush() == 0
+        return await stats.get_stats(1), stats.pending_count
+    
+    row, pending_count = asyncio.run(main())
+    assert row['messages_sent'] == 2
+    assert pending_count == 1
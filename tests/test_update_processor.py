@@ -0,0 +1,55 @@
+import asyncio
+from types import SimpleNamespace
+
+
+def make_update(user_id):
+    return SimpleNamespace(effective_user=SimpleNamespace(id=user_id))
+
+
+def test_flooding_pair_does_not_delay_other_pairs(bot16):
+    partners = {1: 2, 2: 1, 3: 4, 4: 3}
+    processor = bot16.PairOrderedUpdateProcessor(SimpleNamespace(partner_id=partners.get),
+                                                 max_concurrent_updates=4)
+    
+    async def main():
+        release = asyncio.Event()
+        
+        async def stuck():
+            # A handler waiting on its chat's outbox
+            await release.wait()
+        
+        async def quick():
+            pass
+        
+        flood = [asyncio.create_task(processor.process_update(make_update(1), stuck()))
+                 for _ in range(20)]
+        await asyncio.sleep(0.01)
+        
+        await asyncio.wait_for(processor.process_update(make_update(3), quick()), timeout=1)
+        
+        release.set()
+        await asyncio.gather(*flood)
+        return processor.metrics()
+    
+    metrics = asyncio.run(main())
+    assert metrics['processed'] == 21
+    assert metrics['peak_running'] == 2
+    assert not processor.locks
+
+
+def test_pair_updates_run_in_order(bot16):
+    partners = {1: 2, 2: 1}
+    processor = bot16.PairOrderedUpdateProcessor(SimpleNamespace(partner_id=partners.get),
+                                                 max_concurrent_updates=8)
+    order = []
+    
+    async def handler(n):
+        await asyncio.sleep(0.001 * (10 - n))
+        order.append(n)
+    
+    async def main():
+        await asyncio.gather(*(processor.process_update(make_update(1 + n % 2), handler(n))
+                               for n in range(10)))
+    
+    asyncio.run(main())
+    assert order == list(range(10))
@@ -0,0 +1,60 @@
+import asyncio
+
+import pytest
+
+
+class BrokenConnection:
+    def cursor(self):
+        raise ConnectionError('server closed the connection unexpectedly')
+    
+    def rollback(self):
+        pass
+
+
+class BrokenPool:
+    def getconn(self):
+        return BrokenConnection()
+    
+    def putconn(self, conn):
+        pass
+
+
+class ProfileDB:
+    """Stands in for AsyncDB with one row per user id"""
+    
+    def __init__(self, rows):
+        self.rows = rows
+        self.lookups = 0
+    
+    async def get_user(self, user_id):
+        self.lookups += 1
+        return self.rows.get(user_id)
+
+
+def test_failed_lookup_raises_and_is_not_cached(bot16):
+    database = bot16.ProfessionalDB(db_pool=BrokenPool())
+    adb = bot16.AsyncDB(database, max_workers=1)
+    cache = bot16.UserCache(adb)
+    
+    async def main():
+        with pytest.raises(ConnectionError):
+            await cache.get(1)
+    
+    try:
+        asyncio.run(main())
+    finally:
+        adb.shutdown()
+    assert 1 not in cache.entries
+    assert not cache.fetches
+    assert database.errors == 1
+
+
+def test_missing_user_is_cached(bot16):
+    database = ProfileDB({2: {'nickname': 'two'}})
+    cache = bot16.UserCache(database)
+    
+    async def main():
+        return [await cache.get(1), await cache.get(1), await cache.get(2)]
+    
+    assert asyncio.run(main()) == [None, None, {'nickname': 'two'}]
+    assert database.lookups == 2